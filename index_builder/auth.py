@@ -14,3 +14,13 @@ def requires_auth(f):
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated
+
+
+def requires_admin(f):
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if session.get('username') != 'admin':
+            return redirect(url_for('index'))
+        return f(*args, **kwargs)
+    return decorated
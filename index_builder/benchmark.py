@@ -0,0 +1,206 @@
+"""
+Benchmarks for the model & view hot paths run across a grid of user counts, factor counts & history lengths.
+
+    python -m index_builder.benchmark --users 10,100,500 --factors 13,100 --days 500,2086 --save baseline.json
+    python -m index_builder.benchmark --users 10,100,500 --factors 13,100 --days 500,2086 --compare baseline.json
+
+Results are saved as JSON so they can be kept as baselines.  When comparing against a baseline any case whose
+median time has grown by more than the threshold is reported as a regression and the command exits with a
+non-zero status.
+"""
+import argparse
+import itertools
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+from datetime import datetime
+
+import numpy as np
+from flask import Flask
+
+import cache
+import dataset
+import model
+import utils
+import views
+
+logger = utils.get_logger()
+
+DEFAULT_GRID = dict(users=[10, 100], factors=[13, 50], days=[500, 2086])
+
+
+def build_app(path):
+    app = Flask('index_builder_benchmark')
+    app.config['DATA_PATH'] = path
+    app.config['SECRET_KEY'] = 'IndexBuilderBenchmark'
+    app.register_blueprint(views.index_builder)
+    return app
+
+
+def time_case(func, repeat, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = timeit.default_timer()
+        func()
+        timings.append(timeit.default_timer() - start)
+    return dict(min=min(timings), median=float(np.median(timings)), repeat=repeat)
+
+
+def reset_state():
+    """
+    Clears memoized results along with the user store's scans & the summary aggregates built from them, so the next
+    run rescans every user's settings.
+    """
+    cache.RESULTS_CACHE.clear()
+    utils.get_user_store().reset()
+    utils.get_summary_aggregates().reset()
+
+
+def build_cases(app, user_settings):
+    """
+    Builds the benchmarked functions for a loaded dataset.  :meth:`reset_state` is run before every run so each
+    timing measures a full computation, including scanning the users' settings.
+    """
+    factors, indices = views.load_factors(app.config['DATA_PATH']), views.load_indexes(app.config['DATA_PATH'])
+    user, factor_settings = sorted(user_settings.items())[0]
+    client = app.test_client()
+
+    def get(url):
+        def _get():
+            response = client.get(url)
+            assert 'error' not in json.loads(response.data), 'error returned by {}'.format(url)
+        return _get
+
+    return [
+        ('load_all_results_stats', lambda: model.load_all_results_stats(factors, indices, user_settings)),
+        ('load_results_stats', lambda: model.load_results_stats(factors, indices, factor_settings)),
+        ('load_user_results', lambda: model.load_user_results(factors, indices, factor_settings)),
+        ('load_cumulative_returns', lambda: model.load_cumulative_returns(factors, indices, factor_settings)),
+        ('user_settings_scan', lambda: list(utils.get_all_user_factor_settings(locked=False))),
+        ('find_results_stats', get('/index-builder/results-stats')),
+        ('find_summary_data', get('/index-builder/summary-data')),
+        ('find_sample_indexes', get('/index-builder/sample-indexes')),
+    ]
+
+
+def run_grid(grid, repeat=5, seed=0):
+    """
+    Runs every benchmark case against a synthetic dataset for each combination of users, factors & days.
+
+    Returns
+    -------
+    list of dict
+        one result per case & grid point
+    """
+    results = []
+    try:
+        for users, factors, days in itertools.product(grid['users'], grid['factors'], grid['days']):
+            path = tempfile.mkdtemp()
+            try:
+                dataset.write_dataset(path, factor_count=factors, days=days, user_count=users, seed=seed)
+                # each grid point's users are served from a fresh store of the configured type
+                utils.set_user_store(dataset.build_user_store(path))
+                cache.clear_all_caches()
+                app = build_app(path)
+                user_settings = dict(utils.get_all_user_factors(locked=False))
+                for case, func in build_cases(app, user_settings):
+                    timing = time_case(func, repeat, setup=reset_state)
+                    logger.info('{} (users: {}, factors: {}, days: {}): {:.4f}s'.format(
+                        case, users, factors, days, timing['median']
+                    ))
+                    results.append(dict(timing, case=case, users=users, factors=factors, days=days))
+            finally:
+                shutil.rmtree(path)
+    finally:
+        utils.set_user_store(None)
+        cache.clear_all_caches()
+    return results
+
+
+def build_result_key(result):
+    return result['case'], result['users'], result['factors'], result['days']
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Compares median timings against a baseline.
+
+    Parameters
+    ----------
+    results: list of dict
+        results from :meth:`run_grid`
+    baseline: list of dict
+        previously saved results
+    threshold: float, optional
+        allowed fractional slowdown before a case is flagged as a regression
+
+    Returns
+    -------
+    list of dict
+        regressions, each result along with its baseline median & change ratio
+    """
+    baseline = {build_result_key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        base = baseline.get(build_result_key(result))
+        if base is None or not base['median']:
+            continue
+        ratio = result['median'] / base['median']
+        if ratio > 1 + threshold:
+            regressions.append(dict(result, baseline=base['median'], ratio=ratio))
+    return regressions
+
+
+def save_results(results, fname):
+    with open(fname, 'w') as f:
+        json.dump(dict(
+            created=datetime.now().isoformat(),
+            python=platform.python_version(),
+            numpy=np.__version__,
+            results=results
+        ), f, indent=2, sort_keys=True)
+
+
+def load_results(fname):
+    with open(fname) as f:
+        return json.load(f)['results']
+
+
+def parse_ints(val):
+    return [int(v) for v in val.split(',')]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the index builder model & view hot paths')
+    parser.add_argument('--users', type=parse_ints, default=DEFAULT_GRID['users'], help='comma-separated user counts')
+    parser.add_argument('--factors', type=parse_ints, default=DEFAULT_GRID['factors'],
+                        help='comma-separated factor counts')
+    parser.add_argument('--days', type=parse_ints, default=DEFAULT_GRID['days'],
+                        help='comma-separated business days of history')
+    parser.add_argument('--repeat', type=int, default=5, help='timings per case')
+    parser.add_argument('--save', help='file to save results to')
+    parser.add_argument('--compare', help='baseline file to compare results against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown before flagging a regression')
+    args = parser.parse_args(sys.argv[1:] if args is None else args)
+
+    grid = dict(users=args.users, factors=args.factors, days=args.days)
+    results = run_grid(grid, repeat=args.repeat)
+    if args.save:
+        save_results(results, args.save)
+    if args.compare:
+        regressions = compare(results, load_results(args.compare), threshold=args.threshold)
+        for r in regressions:
+            logger.error('REGRESSION {} (users: {}, factors: {}, days: {}): {:.4f}s -> {:.4f}s ({:.0%})'.format(
+                r['case'], r['users'], r['factors'], r['days'], r['baseline'], r['median'], r['ratio'] - 1
+            ))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,23 @@
 from dateutil import rrule
 import datetime as dt
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+from collections import OrderedDict
 from decorator import decorator
 from inspect import getargspec as _getargspec
+from timeit import default_timer
 
-from utils import get_logger
+import numpy as np
+import pandas as pd
+
+import timing
+from utils import get_logger, mkdir_p, run_native
 
 
 def getargspec(func):
@@ -39,30 +53,166 @@ def ismethod(func):
     return False
 
 
+def _load(func, cache, *args, **kw):
+    start = default_timer()
+    value = func(*args, **kw)
+    if hasattr(cache, 'record_load'):
+        cache.record_load(default_timer() - start)
+    return value
+
+
+class SingleFlightTimeout(RuntimeError):
+    """
+    Raised when a caller gives up waiting on another caller's in-flight computation of the same value.
+    """
+    pass
+
+
+class _Flight(object):
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+# in-flight computations keyed by (cache id, key), under gevent's monkey-patching these primitives are greenlet-aware
+_flights = {}
+_refreshes = {}
+_flights_lock = threading.Lock()
+
+
 def _get_fn_value(func, cache, key, *args, **kw):
     try:
-        return cache[key]
+        value = cache[key]
+        timing.count('memo_hit')
+        if getattr(cache, 'stale_while_revalidate', False) and cache.is_stale(key):
+            _revalidate(func, cache, key, *args, **kw)
+        return value
     except KeyError:
-        cache[key] = value = func(*args, **kw)
+        timing.count('memo_miss')
+        if getattr(func, '_single_flight', False):
+            return _get_single_flight_value(func, cache, key, *args, **kw)
+        cache[key] = value = _load(func, cache, *args, **kw)
         return value
     except TypeError:
         # Case where key is not hashable, can't use this memoize implementation
         raise
 
 
+def _get_single_flight_value(func, cache, key, *args, **kw):
+    """
+    Computes a missing value so that only one concurrent caller runs `func`, the rest wait for its result (or
+    exception) for up to `func._single_flight_timeout` seconds.
+    """
+    flight_key = id(cache), key
+    with _flights_lock:
+        flight = _flights.get(flight_key)
+        leader = flight is None
+        if leader:
+            flight = _flights[flight_key] = _Flight()
+
+    if not leader:
+        if not flight.event.wait(func._single_flight_timeout):
+            raise SingleFlightTimeout('timed out waiting for {} to be loaded'.format(func.__name__))
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    try:
+        try:
+            # a previous flight may have finished between our cache miss & taking the lead
+            flight.value = cache[key]
+        except KeyError:
+            cache[key] = flight.value = _load(func, cache, *args, **kw)
+        return flight.value
+    except Exception as ex:
+        flight.error = ex
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[flight_key]
+        flight.event.set()
+
+
+def _revalidate(func, cache, key, *args, **kw):
+    """
+    Rebuilds a stale value in the background, the stale value keeps being served until the new one is swapped in.
+    Only one rebuild per key runs at a time.  Under gevent the thread is a greenlet so the rebuild itself is run on
+    gevent's native threadpool (see :meth:`utils.run_native`), otherwise it would block every request in the worker.
+    """
+    refresh_key = id(cache), key
+    with _flights_lock:
+        if refresh_key in _refreshes:
+            return
+        thread = _refreshes[refresh_key] = threading.Thread(
+            target=_refresh, args=(func, cache, key, refresh_key) + args, kwargs=kw
+        )
+    thread.daemon = True
+    thread.start()
+
+
+def _refresh(func, cache, key, refresh_key, *args, **kw):
+    try:
+        logger.info('refreshing stale value for {}...'.format(func.__name__))
+        value = run_native(_load, func, cache, *args, **kw)
+        # swapped in from this thread (or greenlet) rather than the native one so it doesn't race requests
+        cache[key] = value
+    except Exception:
+        # keep serving the stale value, once it exceeds the cache's max_stale callers will load it themselves
+        logger.exception('failed to refresh stale value for {}'.format(func.__name__))
+    finally:
+        with _flights_lock:
+            del _refreshes[refresh_key]
+
+
+def settings_hash(settings):
+    """
+    Builds a canonical hash of a JSON-serializable dictionary (such as a user's factor settings) so it can be
+    used as part of a cache key.  Dictionaries with the same contents will produce the same hash regardless of
+    insertion order.
+    """
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str)).hexdigest()
+
+
+def _hashable_arg(arg):
+    if isinstance(arg, list):
+        return tuple(arg)
+    if isinstance(arg, dict):
+        return settings_hash(arg)
+    return arg
+
+
 def _memoize_function(func, *args, **kw):
-    arglist = tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args)
-    key = arglist, frozenset(kw.items())  # frozenset is used to ensure hashability
+    arglist = tuple(_hashable_arg(arg) for arg in args)
+    # frozenset is used to ensure hashability
+    key = arglist, frozenset((k, _hashable_arg(v)) for k, v in kw.items())
     cache = func._cache  # attribute added by memoize
     return _get_fn_value(func, cache, key, *args, **kw)
 
 
-def custom_memoize(cache):
+def custom_memoize(cache, single_flight=False, timeout=None):
+    """
+    Memoizes a function's results in `cache`.
+
+    Parameters
+    ----------
+    cache: `ExpiryCache`
+    single_flight: bool, optional
+        when several callers miss on the same key at once only the first computes the value, the others wait for
+        its result (or exception)
+    timeout: float, optional
+        seconds callers wait on another's computation before raising :class:`SingleFlightTimeout`, defaults to
+        waiting indefinitely
+    """
     def inner(func):
         if not ismethod(func):
             # Only initialize cache if it is a functions; methods need
             # to provide their own cache on the object.
             func._cache = cache
+            func._single_flight = single_flight
+            func._single_flight_timeout = timeout
             decorated_func = decorator(_memoize_function, func)
             copy_wrapped_attributes(func, decorated_func)
             return decorated_func
@@ -71,13 +221,142 @@ def custom_memoize(cache):
     return inner
 
 
+def _memoize_results(func, factors, indices, factor_settings):
+    # factors & indices are too large to hash so they are keyed by identity along with the dataset version in
+    # case a reload re-uses the same object ids
+    key = func.__name__, id(factors), id(indices), dataset_version(), settings_hash(factor_settings)
+    return _get_fn_value(func, func._cache, key, factors, indices, factor_settings)
+
+
+def results_memoize(cache):
+    """
+    Memoization for model functions with the signature (factors, indices, factor_settings).  Results are
+    keyed by a canonical hash of the factor settings and the current dataset version.
+    """
+    def inner(func):
+        func._cache = cache
+        decorated_func = decorator(_memoize_results, func)
+        copy_wrapped_attributes(func, decorated_func)
+        return decorated_func
+    return inner
+
+
+# number of items sized when estimating the size of a large list or tuple
+SIZE_SAMPLE = 100
+
+
+def estimate_size(value):
+    """
+    Cheap estimate of the bytes held by a cached value.  Arrays & frames report the size of their buffers and
+    containers are summed recursively, unlike :meth:`pympler.asizeof.asizeof` this doesn't walk every object
+    referenced by the value.  Large lists (e.g. records) are extrapolated from a sample of their items and the
+    contents of object columns aren't counted.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True).sum())
+    if isinstance(value, pd.Series):
+        return value.values.nbytes + value.index.nbytes
+    if isinstance(value, pd.Index):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)) and len(value) > SIZE_SAMPLE:
+        sample = value[:SIZE_SAMPLE]
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in sample) * len(value) // SIZE_SAMPLE
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class SharedGenerations(object):
+    """
+    Generation counters shared between processes (e.g. gunicorn workers) through a small memory-mapped file.  Each
+    named slot is bumped when its cache is invalidated and every process compares it against the generation it
+    last saw on each cache access, clearing its own copy when they differ.  Reading a slot is a read from the
+    shared mapping so it doesn't cost a system call.  Until it's given a file (see :meth:`init`) nothing is shared
+    and every slot stays at generation 0.
+    """
+    SLOT = struct.Struct('<Q')
+
+    def __init__(self, names, fname=None):
+        self.fname = fname
+        self.names = list(names)
+        self._mm = None
+        self._lock = threading.Lock()
+
+    def init(self, fname):
+        """
+        Shares the generations through a file, it's created on first use.
+        """
+        with self._lock:
+            self.fname, self._mm = fname, None
+
+    def _map(self):
+        if self._mm is None:
+            with self._lock:
+                if self._mm is None:
+                    mkdir_p(os.path.dirname(self.fname))
+                    size = self.SLOT.size * len(self.names)
+                    fd = os.open(self.fname, os.O_RDWR | os.O_CREAT, 0o666)
+                    try:
+                        if os.fstat(fd).st_size < size:
+                            os.ftruncate(fd, size)
+                        self._mm = mmap.mmap(fd, size)
+                    finally:
+                        os.close(fd)
+        return self._mm
+
+    def _offset(self, name):
+        return self.names.index(name) * self.SLOT.size
+
+    def get(self, name):
+        if self.fname is None:
+            return 0
+        return self.SLOT.unpack_from(self._map(), self._offset(name))[0]
+
+    def bump(self, name):
+        if self.fname is None:
+            return 0
+        mm, offset = self._map(), self._offset(name)
+        with self._lock:
+            # lockf locks are per-process (unlike flock ones which forked workers would share) so they serialize
+            # the read-modify-write between workers, the thread lock covers greenlets within one
+            fd = os.open(self.fname, os.O_RDWR)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+                generation = self.SLOT.unpack_from(mm, offset)[0] + 1
+                self.SLOT.pack_into(mm, offset, generation)
+            finally:
+                os.close(fd)
+        return generation
+
+    def slot(self, name):
+        return GenerationSlot(self, name)
+
+
+class GenerationSlot(object):
+
+    def __init__(self, generations, name):
+        self.generations = generations
+        self.name = name
+
+    def get(self):
+        return self.generations.get(self.name)
+
+    def bump(self):
+        return self.generations.bump(self.name)
+
+
 class ExpiryCache(object):
     """
     A dictionary based cache where entries expire based on an a user specified
     rrule (recurrence rule). See the python-dateutil module for more details
     on defining recurrence rules.
     """
-    def __init__(self, expiry):
+    def __init__(self, expiry, max_entries=None, dependents=None, stale_while_revalidate=False, max_stale=None,
+                 max_bytes=None, generation=None):
         """
         Constructor.
 
@@ -85,10 +364,99 @@ class ExpiryCache(object):
         ----------
         expiry : `rrule`
             A user defined dateutil recurrency rule object.
+        max_entries : int, optional
+            Maximum number of entries to hold, once exceeded the least recently used entry will be evicted.
+        dependents : list of `ExpiryCache`, optional
+            Caches holding values derived from this one, they will be cleared whenever this cache changes.
+        stale_while_revalidate : bool, optional
+            Keep serving expired entries while memoized functions rebuild them in the background.
+        max_stale : `timedelta`, optional
+            How long past its expiry an entry can still be served, defaults to no limit.
+        max_bytes : int, optional
+            Maximum estimated size (see :meth:`estimate_size`) of all entries, once exceeded the least recently used
+            entries will be evicted.  The most recent entry is always kept.
+        generation : `GenerationSlot`, optional
+            Generation shared with other processes, when another process invalidates the cache this one is cleared
+            on its next access.
         """
-        self._cache = {}
+        self._cache = OrderedDict()
+        self._sizes = {}
+        self.total_bytes = 0
         self.rrule = iter(expiry)
         self.dt_current = next(self.rrule)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.dependents = dependents or []
+        self.stale_while_revalidate = stale_while_revalidate
+        self.max_stale = max_stale
+        self.version = 0
+        self.generation = generation
+        self._generation_seen = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = dict(hits=0, misses=0, evictions=0, loads=0, load_time=0.0)
+
+    def record_load(self, seconds):
+        """
+        Records the time taken by a memoized function to compute a missing value.
+        """
+        self.stats['loads'] += 1
+        self.stats['load_time'] += seconds
+
+    def size(self, name):
+        return self._sizes.get(name, 0)
+
+    def _changed(self):
+        self.version += 1
+        for dependent in self.dependents:
+            dependent.clear()
+
+    def _remove(self, name):
+        del self._cache[name]
+        self.total_bytes -= self._sizes.pop(name, 0)
+
+    def _evict(self):
+        over_entries = lambda: self.max_entries is not None and len(self._cache) > self.max_entries
+        over_bytes = lambda: self.max_bytes is not None and self.total_bytes > self.max_bytes
+        while len(self._cache) > 1 and (over_entries() or over_bytes()):
+            self._remove(next(iter(self._cache)))
+            self.stats['evictions'] += 1
+
+    def check_generation(self):
+        """
+        Clears the cache if another process has invalidated it since it was last accessed.
+        """
+        if self.generation is None:
+            return
+        try:
+            current = self.generation.get()
+        except EnvironmentError:
+            logger.exception('unable to read shared cache generation, disabling cross-process invalidation')
+            self.generation = None
+            return
+        if current != self._generation_seen:
+            if self._generation_seen is not None:
+                logger.info('cache invalidated by another process, clearing...')
+                self.clear()
+            self._generation_seen = current
+
+    def publish(self):
+        """
+        Clears the cache in every other process sharing its generation, keeping this process's entries.
+        """
+        if self.generation is not None:
+            try:
+                self._generation_seen = self.generation.bump()
+            except EnvironmentError:
+                logger.exception('unable to bump shared cache generation')
+
+    def invalidate(self):
+        """
+        Clears the cache in this process and every other process sharing its generation.
+        """
+        self.publish()
+        self.clear()
 
     def check_rrule_timeout(self):
         """
@@ -108,26 +476,56 @@ class ExpiryCache(object):
         return rrule.rrule(rrule.DAILY, dtstart=dt_midnight)
 
     def __getitem__(self, name):
+        self.check_generation()
         self.check_rrule_timeout()
 
         try:
             dt_timeout, insert_time, value = self._cache[name]
         except KeyError:
+            self.stats['misses'] += 1
             raise KeyError('no key %s!' % str(name))
 
-        if dt.datetime.now() >= dt_timeout:
-            del self._cache[name]
+        now = dt.datetime.now()
+        if now >= dt_timeout and not self._can_serve_stale(now, dt_timeout):
+            self._remove(name)
+            self.stats['misses'] += 1
+            self.stats['evictions'] += 1
+            self._changed()
             raise KeyError('no key %s!' % str(name))
 
+        self.stats['hits'] += 1
+
+        if self.max_entries is not None or self.max_bytes is not None:
+            # mark as most recently used
+            self._cache[name] = self._cache.pop(name)
         return value
 
+    def _can_serve_stale(self, now, dt_timeout):
+        return self.stale_while_revalidate and (self.max_stale is None or now - dt_timeout < self.max_stale)
+
+    def is_stale(self, name):
+        """
+        Whether an entry has expired but is still being served.
+        """
+        entry = self._cache.get(name)
+        return entry is not None and dt.datetime.now() >= entry[0]
+
     def __setitem__(self, name, value):
+        self.check_generation()
         self.check_rrule_timeout()
+        size = estimate_size(value)
+        if name in self._cache:
+            self._remove(name)
         self._cache[name] = self.dt_current, dt.datetime.now(), value
+        self._sizes[name] = size
+        self.total_bytes += size
+        self._evict()
+        self._changed()
 
     def __delitem__(self, name):
         self.check_rrule_timeout()
-        del self._cache[name]
+        self._remove(name)
+        self._changed()
 
     def __len__(self):
         return len(self._cache)
@@ -135,24 +533,73 @@ class ExpiryCache(object):
     def clear(self):
         self.check_rrule_timeout()
         self._cache.clear()
+        self._sizes.clear()
+        self.total_bytes = 0
+        self._changed()
 
 
 logger = get_logger()
 
 PROD_SCHEDULE = rrule.rrule(rrule.DAILY, byhour=(13, 22), byminute=(0,))
-FACTOR_CACHE = ExpiryCache(PROD_SCHEDULE)
-INDEXES_CACHE = ExpiryCache(PROD_SCHEDULE)
-GICS_CACHE = ExpiryCache(PROD_SCHEDULE)
+# scheduled reloads happen in the background so expired data is served for up to this long while they run
+MAX_STALE = dt.timedelta(hours=1)
+# lets /force-refresh & /clear-cache reach every gunicorn worker once it's given a file under the data path
+GENERATIONS = SharedGenerations(['FACTOR_CACHE', 'INDEXES_CACHE', 'GICS_CACHE', 'RESULTS_CACHE', 'DATASETS'])
+# bumped once a refreshed dataset has been snapshotted, other workers then load it before swapping it in
+DATASETS_GENERATION = GENERATIONS.slot('DATASETS')
+RESULTS_CACHE = ExpiryCache(
+    PROD_SCHEDULE, max_entries=1024, max_bytes=256 * 1024 ** 2, generation=GENERATIONS.slot('RESULTS_CACHE')
+)
+FACTOR_CACHE = ExpiryCache(
+    PROD_SCHEDULE, dependents=[RESULTS_CACHE], stale_while_revalidate=True, max_stale=MAX_STALE,
+    generation=GENERATIONS.slot('FACTOR_CACHE')
+)
+INDEXES_CACHE = ExpiryCache(
+    PROD_SCHEDULE, dependents=[RESULTS_CACHE], stale_while_revalidate=True, max_stale=MAX_STALE,
+    generation=GENERATIONS.slot('INDEXES_CACHE')
+)
+GICS_CACHE = ExpiryCache(
+    PROD_SCHEDULE, stale_while_revalidate=True, max_stale=MAX_STALE, generation=GENERATIONS.slot('GICS_CACHE')
+)
+
+
+def init_generations(path):
+    GENERATIONS.init(os.path.join(path, 'cache_generations'))
+
+
+def dataset_version():
+    return FACTOR_CACHE.version, INDEXES_CACHE.version
 
 
 def clear_cache(cache):
-    globals()[cache].clear()
+    globals()[cache].invalidate()
 
 
 def clear_all_caches():
-    FACTOR_CACHE.clear()
-    INDEXES_CACHE.clear()
-    GICS_CACHE.clear()
+    FACTOR_CACHE.invalidate()
+    INDEXES_CACHE.invalidate()
+    GICS_CACHE.invalidate()
+    RESULTS_CACHE.invalidate()
+
+
+_swap_lock = threading.Lock()
+
+
+def swap_values(entries):
+    """
+    Replaces memoized values with ones built elsewhere, e.g. a refreshed dataset.  The assignments don't yield to
+    other greenlets so requests see either all of the old values or all of the new ones, and each replacement
+    bumps its cache's version (clearing dependent results).  Other processes keep their copies, bump
+    DATASETS_GENERATION to have them load the new values too.
+
+    Parameters
+    ----------
+    entries: list of tuple
+        (cache, args of the memoized function, value)
+    """
+    with _swap_lock:
+        for c, args, value in entries:
+            c[create_memory_cache_key(args)] = value
 
 
 def create_memory_cache_key(args):
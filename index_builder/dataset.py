@@ -0,0 +1,135 @@
+"""
+Command-line tool for writing a synthetic dataset of a configurable size so the application can be load & capacity
+tested against realistic universes and user counts.
+
+    python -m index_builder.dataset --path $DATA_PATH --factors 250 --samples 10 --days 5000 --users 1000
+
+Factors & indexes are written under the data path (see :mod:`store`) and the users' factor settings are saved to a
+user settings store of the configured type (USER_STORE, see :mod:`users`) under it: a "users" folder (or
+--users-path) or a users.db database.  A server started with the same DATA_PATH serves them since the users'
+settings follow DATA_PATH unless USERS_PATH or USER_DB say otherwise (see :meth:`utils.build_user_data_paths`).
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import model
+import store
+import users
+import utils
+
+logger = utils.get_logger()
+
+REASONS = dict(
+    HI=['futureRet', 'riskReduce', 'ethics', 'affectChange', 'material', 'demand'],
+    LO=['hurtProfits', 'irrelevant'],
+)
+DEFAULT_END = '20171231'
+
+
+def build_user_settings(factor_ids, user_count, max_factors=5, locked_pct=0.9, seed=None):
+    """
+    Builds randomized factor settings for a number of users.  Each user selects up to `max_factors` factors with
+    integer weights totalling 100.
+
+    Returns
+    -------
+    dict
+        factor settings keyed by user
+    """
+    rs = np.random.RandomState(seed)
+    max_factors = min(max_factors, len(factor_ids))
+    user_settings = {}
+    for i in range(1, user_count + 1):
+        count = rs.randint(1, max_factors + 1)
+        selections = [factor_ids[j] for j in rs.choice(len(factor_ids), count, replace=False)]
+        weights = 1 + rs.multinomial(100 - count, np.ones(count) / count)
+        factors = {}
+        for factor_id, weight in zip(selections, weights):
+            strength = 'HI' if rs.rand() < 0.75 else 'LO'
+            reasons = REASONS[strength]
+            reasons = [reasons[j] for j in sorted(rs.choice(len(reasons), rs.randint(1, len(reasons) + 1), False))]
+            factors[factor_id] = dict(strength=strength, weight=int(weight), reasons=reasons)
+        user_settings['user_{}'.format(i)] = dict(factors=factors, locked=bool(rs.rand() < locked_pct))
+    return user_settings
+
+
+def build_user_store(path, users_path=None):
+    """
+    User settings store of the configured type for a dataset written to `path`.
+
+    Parameters
+    ----------
+    path: str
+        data path the dataset was written to
+    users_path: str, optional
+        folder of the YAML users, defaults to a "users" folder under `path` so synthetic users are never mixed into
+        the application's real users by accident
+    """
+    return users.build_store(
+        utils.USER_STORE_BACKEND, users_path=users_path or os.path.join(path, 'users'),
+        db_fname=os.path.join(path, 'users.db')
+    )
+
+
+def write_user_settings(user_settings, user_store):
+    for user, factor_settings in sorted(user_settings.items()):
+        user_store.save(user, factor_settings)
+    logger.info('wrote settings for {} users'.format(len(user_settings)))
+
+
+def write_dataset(path, factor_count=13, sample_count=4, days=2086, user_count=0, users_path=None, seed=None):
+    """
+    Writes a synthetic dataset which :meth:`model.load_factors` & :meth:`model.load_indexes` will load from `path`.
+
+    Parameters
+    ----------
+    path: str
+        data path (DATA_PATH) to write factors & indexes to
+    factor_count: int, optional
+        number of factors, each factor gets a HI & LO index
+    sample_count: int, optional
+        number of sample indexes
+    days: int, optional
+        business days of index return history
+    user_count: int, optional
+        number of users to write factor settings for
+    users_path: str, optional
+        folder to write YAML user settings to, see :meth:`build_user_store`
+    seed: int, optional
+        seed for the random number generators
+    """
+    dates = pd.bdate_range(end=DEFAULT_END, periods=days)
+    factors_seed, indexes_seed, users_seed = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, size=3)
+    factors = model.build_factors(factor_count, start=dates[0], end=dates[-1], seed=factors_seed)
+    store.write_factor_store(factors, path)
+    indexes = model.build_indexes(factor_count, sample_count, start=dates[0], end=dates[-1], seed=indexes_seed)
+    store.write_index_store(indexes, path)
+    if user_count:
+        user_settings = build_user_settings(model.build_factor_ids(factor_count), user_count, seed=users_seed)
+        write_user_settings(user_settings, build_user_store(path, users_path))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic index builder dataset')
+    parser.add_argument('--path', default=os.environ.get('DATA_PATH'), help='data path (defaults to $DATA_PATH)')
+    parser.add_argument('--factors', type=int, default=13, help='number of factors')
+    parser.add_argument('--samples', type=int, default=4, help='number of sample indexes')
+    parser.add_argument('--days', type=int, default=2086, help='business days of index return history')
+    parser.add_argument('--users', type=int, default=0, help='number of users to write factor settings for')
+    parser.add_argument('--users-path', help='folder to write YAML user settings to (defaults to <path>/users)')
+    parser.add_argument('--seed', type=int, help='random seed')
+    args = parser.parse_args(sys.argv[1:] if args is None else args)
+    if not args.path:
+        parser.error('--path or $DATA_PATH is required')
+    write_dataset(
+        args.path, factor_count=args.factors, sample_count=args.samples, days=args.days, user_count=args.users,
+        users_path=args.users_path, seed=args.seed
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,8 @@
 # Sample Gunicorn configuration file.
+import gc
+import os
+import shutil
+import tempfile
 
 # Security
 #
@@ -82,6 +86,40 @@ worker_connections = 1000
 timeout = 120
 keepalive = 2
 
+#
+#   preload_app - Load the application code (and with it the factor, index
+#       & GICS data) in the master process before forking the workers.
+#       Workers then share the loaded data copy-on-write rather than each
+#       building their own copy.
+#
+#       True or False, enabled by setting the PRELOAD_APP environment
+#       variable to "true"
+#
+
+preload_app = os.environ.get('PRELOAD_APP', 'false').lower() == 'true'
+
+#   When preloading, the app is imported in the master before the gevent
+#   workers monkey-patch, so its module-level thread locals & locks would
+#   be real ones shared by every greenlet in a worker. Patch before the
+#   app is imported instead.
+
+if preload_app and worker_class == 'gevent':
+    from gevent import monkey
+
+    monkey.patch_all()
+
+#
+#   METRICS_DIR - Folder the workers flush their metrics to so /metrics
+#       reports totals across all of them. A fresh folder is created for
+#       each server unless one is passed in through the environment, it's
+#       removed again when the server exits (see on_exit). The folder that
+#       was created is kept in the environment too so reloading this config
+#       doesn't mistake it for one that was passed in.
+#
+
+if 'METRICS_DIR' not in os.environ:
+    os.environ['METRICS_DIR'] = os.environ['CREATED_METRICS_DIR'] = tempfile.mkdtemp(prefix='index_builder_metrics_')
+
 #
 #   spew - Install a trace function that spews every line of Python
 #       that is executed when running the server. This is the
@@ -189,10 +227,32 @@ proc_name = None
 #
 #       A callable that takes a server instance as the sole argument.
 #
+#   on_exit - Called just before exiting gunicorn.
+#
+#       A callable that takes a server instance as the sole argument.
+#
 
 
 def post_fork(server, worker):
+    import metrics
+
     server.log.info("Worker spawned (pid: %s)", worker.pid)
+    # the master's metrics (e.g. preloading the data) are already reported from its own file
+    metrics.reset()
+
+
+def worker_exit(server, worker):
+    import metrics
+
+    # runs in the worker so the counts since its last flush are in its file before the master retires it
+    metrics.stop_flusher()
+    metrics.flush(force=True)
+
+
+def child_exit(server, worker):
+    import metrics
+
+    metrics.retire_worker(worker.pid)
 
 
 def pre_fork(server, worker):
@@ -205,8 +265,35 @@ def pre_exec(server):
     server.log.info("Forked child, re-executing.")
 
 
+def on_exit(server):
+    created = os.environ.get('CREATED_METRICS_DIR')
+    # a master re-executed through USR2 inherits the folder & removes it when it exits instead
+    if created and created == os.environ.get('METRICS_DIR') and not getattr(server, 'reexec_pid', 0):
+        shutil.rmtree(created, ignore_errors=True)
+
+
 def when_ready(server):
     server.log.info("Server is ready. Spawning workers")
+    if preload_app:
+        # collect any garbage from loading the data now so the first collection in each worker doesn't
+        # touch (and therefore copy) the pages holding the preloaded data
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+
+def post_worker_init(worker):
+    import metrics
+    from utils import process_memory
+
+    # started once the gevent worker has patched threading so it flushes from a greenlet
+    metrics.start_flusher()
+
+    memory = process_memory()
+    worker.log.info(
+        "Worker initialized (pid: %s, shared: %.1fMB, private: %.1fMB)",
+        worker.pid, memory['shared'] / 1048576.0, memory['private'] / 1048576.0
+    )
 
 
 def worker_int(worker):
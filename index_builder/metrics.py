@@ -0,0 +1,285 @@
+"""
+Prometheus-style metrics: per-route request counts, latencies & response sizes, cache hits/misses/evictions, data
+load durations & worker memory.
+
+Each process keeps its own counters & histograms in memory and periodically flushes them to a JSON file in a
+directory shared by all the gunicorn workers (the METRICS_DIR environment variable, set up by gunicorn_config.py).
+Workers flush after requests (at most every FLUSH_INTERVAL seconds), from a background thread (see
+:meth:`start_flusher`) so an idle worker's last requests aren't left unreported & once more as they exit.
+When ``/metrics`` is scraped every worker's file is summed so the numbers cover the whole server rather than
+whichever worker happened to handle the scrape.
+
+    <METRICS_DIR>/worker_<pid>.json     latest snapshot of a running process
+    <METRICS_DIR>/retired.json          totals carried over from workers which have exited
+"""
+import glob
+import json
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from timeit import default_timer
+
+import cache
+from utils import get_logger, process_memory
+
+logger = get_logger()
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+LOAD_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+FLUSH_INTERVAL = 5
+RETIRED_FILE = 'retired.json'
+
+METRICS = OrderedDict([
+    ('index_builder_requests_total', dict(type='counter', help='Requests handled by route, method & status')),
+    ('index_builder_request_duration_seconds', dict(
+        type='histogram', help='Request latency by route', buckets=DURATION_BUCKETS
+    )),
+    ('index_builder_response_size_bytes', dict(
+        type='histogram', help='Uncompressed response body size by route', buckets=SIZE_BUCKETS
+    )),
+    ('index_builder_cache_hits_total', dict(type='counter', help='Memoized cache hits')),
+    ('index_builder_cache_misses_total', dict(type='counter', help='Memoized cache misses')),
+    ('index_builder_cache_evictions_total', dict(type='counter', help='Entries evicted or expired from a cache')),
+    ('index_builder_cache_load_seconds_total', dict(
+        type='counter', help='Time spent computing missing cache values'
+    )),
+    ('index_builder_data_load_seconds', dict(
+        type='histogram', help='Time taken to load a dataset at startup or on refresh', buckets=LOAD_BUCKETS
+    )),
+    ('index_builder_worker_rss_bytes', dict(type='gauge', help='Resident memory of each worker')),
+])
+
+CACHES = [
+    ('FACTOR_CACHE', cache.FACTOR_CACHE),
+    ('INDEXES_CACHE', cache.INDEXES_CACHE),
+    ('GICS_CACHE', cache.GICS_CACHE),
+]
+CACHE_STATS = [
+    ('index_builder_cache_hits_total', 'hits'),
+    ('index_builder_cache_misses_total', 'misses'),
+    ('index_builder_cache_evictions_total', 'evictions'),
+    ('index_builder_cache_load_seconds_total', 'load_time'),
+]
+
+_lock = threading.Lock()
+_values = defaultdict(dict)
+_last_flush = [0]
+_flusher = dict(pid=None, stop=None, thread=None)
+
+
+def metrics_dir():
+    return os.environ.get('METRICS_DIR')
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def reset():
+    """
+    Clears this process's metrics, called in each gunicorn worker after it's forked so it doesn't report the
+    master's values a second time.
+    """
+    with _lock:
+        _values.clear()
+    _last_flush[0] = 0
+    for _, c in CACHES:
+        c.reset_stats()
+
+
+def inc(name, amount=1, **labels):
+    key = _labels(labels)
+    with _lock:
+        values = _values[name]
+        values[key] = values.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    key = _labels(labels)
+    buckets = METRICS[name]['buckets']
+    with _lock:
+        values = _values[name]
+        # per-bucket (non-cumulative) counts followed by the sum & count of observations
+        hist = values.get(key)
+        if hist is None:
+            hist = values[key] = [0] * (len(buckets) + 3)
+        idx = next((i for i, b in enumerate(buckets) if value <= b), len(buckets))
+        hist[idx] += 1
+        hist[-2] += value
+        hist[-1] += 1
+
+
+@contextmanager
+def time_load(dataset, trigger):
+    start = default_timer()
+    yield
+    observe('index_builder_data_load_seconds', default_timer() - start, dataset=dataset, trigger=trigger)
+
+
+def record_request(route, method, status, duration, size):
+    inc('index_builder_requests_total', route=route, method=method, status=str(status))
+    observe('index_builder_request_duration_seconds', duration, route=route)
+    observe('index_builder_response_size_bytes', size or 0, route=route)
+
+
+def snapshot():
+    """
+    Current values for this process including cache statistics & memory usage.
+
+    Returns
+    -------
+    dict
+        metric name -> list of [labels, value] pairs (JSON-serializable)
+    """
+    with _lock:
+        values = {name: dict(v) for name, v in _values.items()}
+    for name, stat in CACHE_STATS:
+        values[name] = {_labels(dict(cache=cache_name)): c.stats[stat] for cache_name, c in CACHES}
+    try:
+        rss = process_memory()['rss']
+        values['index_builder_worker_rss_bytes'] = {_labels(dict(pid=str(os.getpid()))): rss}
+    except (IOError, OSError):
+        pass  # /proc not available
+    return {name: [[list(map(list, k)), v] for k, v in v.items()] for name, v in values.items()}
+
+
+def _write(fname, data):
+    tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp_fname, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_fname, fname)
+
+
+def _read(fname):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        # worker retired between listing & reading or a partially written file from a crash
+        return {}
+
+
+def flush(force=False):
+    path = metrics_dir()
+    if path is None:
+        return
+    now = default_timer()
+    if not force and now - _last_flush[0] < FLUSH_INTERVAL:
+        return
+    _last_flush[0] = now
+    try:
+        _write(os.path.join(path, 'worker_{}.json'.format(os.getpid())), snapshot())
+    except (IOError, OSError) as ex:
+        logger.error('unable to flush metrics to {}: {}'.format(path, ex))
+
+
+def _flush_periodically(interval, stop):
+    while not stop.wait(interval):
+        flush(force=True)
+
+
+def start_flusher(interval=FLUSH_INTERVAL):
+    """
+    Flushes this process's metrics every interval seconds from a daemon thread (a greenlet under gevent), called in
+    each gunicorn worker once it's initialized.
+    """
+    if metrics_dir() is None or _flusher['pid'] == os.getpid():
+        return
+    stop = threading.Event()
+    thread = threading.Thread(target=_flush_periodically, args=(interval, stop), name='metrics-flusher')
+    thread.daemon = True
+    thread.start()
+    _flusher.update(pid=os.getpid(), stop=stop, thread=thread)
+
+
+def stop_flusher():
+    if _flusher['pid'] == os.getpid():
+        _flusher['stop'].set()
+        _flusher['thread'].join()
+        _flusher.update(pid=None, stop=None, thread=None)
+
+
+def merge(snapshots, include_gauges=True):
+    merged = defaultdict(dict)
+    for data in snapshots:
+        for name, values in data.items():
+            metric = METRICS.get(name)
+            if metric is None or (metric['type'] == 'gauge' and not include_gauges):
+                continue
+            for labels, value in values:
+                key = tuple(map(tuple, labels))
+                current = merged[name].get(key)
+                if current is None:
+                    merged[name][key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    merged[name][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    merged[name][key] = current + value
+    return merged
+
+
+def collect():
+    """
+    Sums the metrics of every worker sharing the metrics directory.
+    """
+    path = metrics_dir()
+    if path is None:
+        return merge([snapshot()])
+    flush(force=True)
+    return merge(_read(fname) for fname in sorted(glob.glob(os.path.join(path, '*.json'))))
+
+
+def retire_worker(pid):
+    """
+    Folds an exited worker's counters into the retired totals so they don't drop when the worker is replaced.
+    Called from the gunicorn master, the only process writing the retired totals, after the worker has flushed its
+    final counts on the way out.
+    """
+    path = metrics_dir()
+    if path is None:
+        return
+    fname = os.path.join(path, 'worker_{}.json'.format(pid))
+    if not os.path.isfile(fname):
+        return
+    retired_fname = os.path.join(path, RETIRED_FILE)
+    retired = merge([_read(retired_fname), _read(fname)], include_gauges=False)
+    _write(retired_fname, {name: [[list(map(list, k)), v] for k, v in v.items()] for name, v in retired.items()})
+    os.remove(fname)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    ) for k, v in labels))
+
+
+def _format_value(value):
+    if isinstance(value, float) and value == int(value):
+        value = int(value)
+    return repr(value)
+
+
+def render(merged):
+    """
+    Renders metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, metric in METRICS.items():
+        lines.append('# HELP {} {}'.format(name, metric['help']))
+        lines.append('# TYPE {} {}'.format(name, metric['type']))
+        for labels, value in sorted(merged.get(name, {}).items()):
+            if metric['type'] != 'histogram':
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric['buckets']) + ['+Inf'], value[:-2]):
+                cumulative += count
+                bucket_labels = labels + (('le', bound if bound == '+Inf' else _format_value(bound)),)
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(bucket_labels), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(value[-2])))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), _format_value(value[-1])))
+    return '\n'.join(lines) + '\n'
@@ -1,183 +1,306 @@
 import pandas as pd
 import numpy as np
-import random
-import os
+from collections import defaultdict
 
-from utils import get_logger, dict_merge
+import cache
+import store
+import timing
+from utils import get_logger, dict_merge, run_parallel
 
 logger = get_logger()
 
 
-def build_percentages(count):
-    return np.random.dirichlet(np.ones(count), size=1)[0]
+SECTOR_IDS = map(str, range(10, 61, 5))
+BARRA_FACTORS = map(lambda i: 'Barra Factor {}'.format(i), range(1, 12))
+SECURITIES = map(lambda i: 'Company {}'.format(i), range(1, 11))
+POSSIBLE_SCORE_COLS = [3, 5, 6]
+POSSIBLE_SCORES = [20, 25, 40, 50, 60, 75, 80]
+RETURN_SUFFIXES = ['totret_mtd_usd_mean_cumulative', 'totret_mtd_usd_sect_adj_mean_cumulative']
+
+
+def build_random_states(seed, count):
+    """
+    Builds independent random number generators for each block of synthetic data so each block is
+    reproducible from the seed regardless of the order in which they are built.
+    """
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, size=count)
+    return [np.random.RandomState(s) for s in seeds]
+
+
+def build_percentages(count, size=1, rs=np.random):
+    percentages = rs.dirichlet(np.ones(count), size=size)
+    return percentages[0] if size == 1 else percentages
+
+
+def build_factor_ids(factor_count):
+    return ['factor_{}'.format(i) for i in range(1, factor_count + 1)]
+
+
+def build_index_ids(factor_count, sample_count=4):
+    index_ids = [
+        'index_{}_{}'.format(i, strength) for i in range(1, factor_count + 1) for strength in ['hi', 'lo']
+    ]
+    return index_ids + build_sample_indexes(sample_count)
+
+
+def build_sample_indexes(sample_count=4):
+    return ['sample_index_{}'.format(i) for i in range(1, sample_count + 1)] + ['index']
 
 
 def load_factors(path):
+    if store.has_factor_store(path):
+        return store.load_factor_store(path)
+    return build_factors()
+
+
+def build_factors(factor_count=13, start='20100101', end='20131231', seed=None):
+    """
+    Builds a randomized universe of factors.
+
+    Parameters
+    ----------
+    factor_count: int, optional
+        number of factors to build
+    start: str, optional
+        first month of factor returns
+    end: str, optional
+        last month of factor returns
+    seed: int, optional
+        seed for the random number generators
+
+    Returns
+    -------
+    dict
+        factor configurations keyed by factor id
+    """
     logger.info('caching factors...')
-    factor_ids = range(1, 14)
-    build_factor = lambda i: {
-        'id': 'factor_{}'.format(i),
-        'label': 'Factor {}'.format(i),
-        'description': 'Description of "Factor {}"'.format(i),
-        'index_name': 'index_{}'.format(i),
-        'rating': random.randint(1, 2400) / 100.0
-    }
-    factors = pd.DataFrame(map(build_factor, factor_ids))
-    factors = factors.to_dict(orient='records')
-    factors = {r['id']: r for r in factors}
-
-    sectors = {
-        'factor_{}'.format(i): dict_merge({
-            str(sector): pct * 10000
-            for sector, pct in zip(range(10, 61, 5), build_percentages(11))
-        }, dict(Total=10000))
-        for i in factor_ids
-    }
-    
-    possible_cols = [3, 5, 6]
-    possible_scores = [20, 25, 40, 50, 60, 75, 80]
+    factor_ids = build_factor_ids(factor_count)
+    rs = np.random.RandomState(seed)
+    ratings = rs.randint(1, 2401, size=factor_count) / 100.0
+    sector_pcts = build_percentages(len(SECTOR_IDS), size=factor_count, rs=rs) * 10000
+
+    months = pd.date_range(start, end, freq='MS')
+    months = [d.date() for d in [months[0] - pd.DateOffset(months=1)] + list(months)]
 
     def build_scores():
-        cols = possible_cols[random.randint(0,2)]
+        cols = POSSIBLE_SCORE_COLS[rs.randint(0, 3)]
         if cols == 3:
-            return {str(score): pct for score, pct in zip([0, 50, 100], build_percentages(3))}
-        random.shuffle(possible_scores)
-        return {str(score): pct for score, pct in zip([0, 100] + possible_scores[2:cols - 1], build_percentages(cols))}
-    
-    factor_scores = {'factor_{}'.format(i): build_scores() for i in factor_ids}
-    factor_score_defs = {
-        factor_id: {score: 'Rating of {}'.format(score) for score in scores}
-        for factor_id, scores in factor_scores.items()
-    }
-
-    securities = map(lambda i: 'Company {}'.format(i), range(1, 11))
-
-    def load_top_bottom():
-        random.shuffle(securities)
-        return dict(
-            top={rank: sec for rank, sec in enumerate(securities[:5])},
-            bottom={rank: sec for rank, sec in enumerate(securities[5:])}
-        )
-    
-    def load_ret_summary(factor_scores):
-        build_mean = lambda: random.randint(-100, 100) / 100.0
-        build_std = lambda: random.randint(-500, 500) / 10000.0
-        build_ir = lambda: random.randint(-2500, 2500) / 10000.0
+            scores = [0, 50, 100]
+        else:
+            scores = [0, 100] + list(rs.permutation(POSSIBLE_SCORES)[2:cols - 1])
+        return {str(score): pct for score, pct in zip(scores, build_percentages(len(scores), rs=rs))}
+
+    def load_ret_summary(scores):
+        scores = sorted(map(int, scores))
+        means = rs.randint(-100, 101, size=(2, len(scores))) / 100.0
+        stds = rs.randint(-500, 501, size=(2, len(scores))) / 10000.0
+        irs = rs.randint(-2500, 2501, size=(2, len(scores))) / 10000.0
         return [
             {
                 'name': score,
-                'sa_Mean': build_mean(), 'total_Mean': build_mean(),
-                'sa_STD': build_std(), 'total_STD': build_std(),
-                'sa_IR': build_ir(), 'total_IR': build_ir(),
+                'sa_Mean': means[0, i], 'total_Mean': means[1, i],
+                'sa_STD': stds[0, i], 'total_STD': stds[1, i],
+                'sa_IR': irs[0, i], 'total_IR': irs[1, i],
             }
-            for score in sorted(map(int, factor_scores.keys()))
+            for i, score in enumerate(scores)
         ]
 
-    def load_returns(factor_scores):
-        build_ret = lambda: random.randint(-1000, 1000) / 1000.0
-        ret_data = {}
-        suffix = 'totret_mtd_usd_mean_cumulative'
-        ret_data[suffix] = {score: [{'date': pd.Timestamp('20091201'), 'val': 0}] for score in factor_scores}
-        suffix = 'totret_mtd_usd_sect_adj_mean_cumulative'
-        ret_data[suffix] = {score: [{'date': pd.Timestamp('20091201'), 'val': 0}] for score in factor_scores}
-
-        curr_cum_rets = {
-            suffix: {score: 0 for score in factor_scores} for suffix in ret_data
+    def load_returns(scores):
+        # cumulative returns for every suffix/score in one shot: suffixes x scores x months
+        rets = rs.randint(-1000, 1001, size=(len(RETURN_SUFFIXES), len(scores), len(months) - 1)) / 1000.0
+        cum_rets = np.concatenate([np.zeros(rets.shape[:2] + (1,)), np.cumsum(rets, axis=2)], axis=2)
+        return {
+            suffix: {
+                score: [{'date': date, 'val': val} for date, val in zip(months, cum_rets[i, j])]
+                for j, score in enumerate(scores)
+            }
+            for i, suffix in enumerate(RETURN_SUFFIXES)
         }
 
-        for p in pd.period_range('20100101', '20131231', freq='M'):
-            date = pd.Timestamp(p.start_time).date()
-            for score in factor_scores:
-                for suffix in ret_data:
-                    curr_cum_rets[suffix][score] += build_ret()
-                    ret_data[suffix][score].append(
-                        {'date': date, 'val': curr_cum_rets[suffix][score]}
-                    )
-        return ret_data
-
-    def get_factor_data(factor_id):
-        return dict_merge(dict(
-            sectors=sectors.get(factor_id, {}),
-            scores=factor_scores.get(factor_id, {}),
-            score_defs=factor_score_defs.get(factor_id, {}),
-            ret_summary=load_ret_summary(factor_scores.get(factor_id, {})),
-            returns=load_returns(factor_scores.get(factor_id, {}))
-        ), load_top_bottom())
+    def load_top_bottom():
+        securities = [SECURITIES[i] for i in rs.permutation(len(SECURITIES))]
+        return dict(
+            top={rank: sec for rank, sec in enumerate(securities[:5])},
+            bottom={rank: sec for rank, sec in enumerate(securities[5:])}
+        )
 
-    factors = {k: dict_merge(v, get_factor_data(k)) for k, v in factors.items()}
+    factors = {}
+    for i, factor_id in enumerate(factor_ids):
+        factor_num = i + 1
+        scores = build_scores()
+        factors[factor_id] = dict_merge(dict(
+            id=factor_id,
+            label='Factor {}'.format(factor_num),
+            description='Description of "Factor {}"'.format(factor_num),
+            index_name='index_{}'.format(factor_num),
+            rating=ratings[i],
+            sectors=dict_merge(dict(zip(SECTOR_IDS, sector_pcts[i])), dict(Total=10000)),
+            scores=scores,
+            score_defs={score: 'Rating of {}'.format(score) for score in scores},
+            ret_summary=load_ret_summary(scores),
+            returns=load_returns(sorted(scores)),
+        ), load_top_bottom())
     logger.info('cached {} factors'.format(len(factors)))
 
     return factors
 
 
 def load_indexes(path):
+    if store.has_index_store(path):
+        return store.load_index_store(path)
+    return build_indexes()
+
+
+def build_exposures(names, dates, index_ids, rs):
+    values = rs.randint(-100, 101, size=(len(names) * len(dates), len(index_ids))) / 100.0
+    exposures = pd.DataFrame(values, columns=index_ids)
+    exposures['name'] = np.repeat(np.asarray(names, dtype=object), len(dates))
+    exposures['date'] = np.tile(dates.values, len(names))
+    return exposures
+
+
+def build_indexes(factor_count=13, sample_count=4, start='20100101', end='20171231', seed=None):
+    """
+    Builds randomized HI/LO indexes for each factor along with sample indexes & the 'index' benchmark.
+
+    Parameters
+    ----------
+    factor_count: int, optional
+        number of factors to build HI/LO indexes for
+    sample_count: int, optional
+        number of sample indexes to build
+    start: str, optional
+        first business day of index returns
+    end: str, optional
+        last business day of index returns
+    seed: int, optional
+        seed for the random number generators
+
+    Returns
+    -------
+    dict
+        barra & sector exposures, returns (cumulative, daily, annualized, excess & covariance), stats & exposure
+        tensors
+    """
     logger.info('caching indexes...')
-    
-    index_ids = map(lambda i: ['index_{}_hi'.format(i), 'index_{}_lo'.format(i)], range(1,14))
-    index_ids = [i_id for sub_ids in index_ids for i_id in sub_ids] + SAMPLE_INDEXES
-    barra_factors = map(lambda i: 'Barra Factor {}'.format(i), range(1,12))
-    build_exp = lambda: random.randint(-100, 100) / 100.0
-    years = [pd.Timestamp('{}1231'.format(year)) for year in range(2010, 2018)]
-    
-    def build_exposures(name):
-        for date in years:
-            yield dict_merge(
-                {'name': name, 'date': date},
-                {i_id: build_exp() for i_id in index_ids}
-            )
-    
-    barra = pd.concat([pd.DataFrame(build_exposures(bf_id)) for bf_id in barra_factors])
-    logger.info('cached {} barra exposures'.format(len(barra)))
- 
-    sector_ids = map(str, range(10, 61, 5))
-    sectors = pd.concat([pd.DataFrame(build_exposures(s_id)) for s_id in sector_ids])
-    logger.info('cached {} sectors exposures'.format(len(sectors)))
-
-    dates = pd.bdate_range('20100101','20171231')
-    daily_returns = map(lambda _: {i_id: random.randint(-2500, 2500) / 10000.0 for i_id in index_ids}, range(len(dates)))
-    cum_returns = [{i_id: 1 for i_id in index_ids}]
-    for i, dr in enumerate(daily_returns[:-1]):
-        cum_returns.append({i_id: dr[i_id] + cum_returns[i][i_id] for i_id in index_ids})
-    daily_returns = pd.DataFrame(daily_returns, index=dates)
-    logger.info('cached {} daily returns'.format(len(daily_returns)))
-
-    cum_returns = pd.DataFrame(cum_returns, index=dates)
-    logger.info('cached {} cumulative returns'.format(len(cum_returns)))
-
-    annualized_returns = pd.DataFrame(
-        map(lambda _: {i_id: random.randint(-1000, 1000) / 1000.0 for i_id in index_ids}, range(len(years))),
-        index=years
-    )
-    logger.info('cached {} annualized returns'.format(len(annualized_returns)))
-
-    excess_returns = pd.DataFrame(
-        map(lambda _: {i_id: random.randint(-2500, 2500) / 10000.0 for i_id in index_ids}, range(len(years))),
-        index=years
-    )
-    excess_returns.loc[:, 'index'] = 0
-    logger.info('cached {} excess returns'.format(len(excess_returns)))
+    index_ids = build_index_ids(factor_count, sample_count)
+    years = pd.date_range(start, end, freq='A')
+    dates = pd.bdate_range(start, end)
+    barra_rs, sectors_rs, daily_rs, annualized_rs, excess_rs, stats_rs = build_random_states(seed, 6)
+
+    # each block has its own random state so they can be built in parallel & still be reproducible
+    def _build_exposures(names, rs):
+        def _build():
+            df = build_exposures(names, years, index_ids, rs)
+            return df, build_exposure_tensor(df)
+        return _build
+
+    def _build_returns():
+        daily_returns = daily_rs.randint(-2500, 2501, size=(len(dates), len(index_ids))) / 10000.0
+        # cumulative returns start at 1 and accumulate every daily return but the last
+        cum_returns = 1 + np.concatenate([np.zeros((1, len(index_ids))), np.cumsum(daily_returns[:-1], axis=0)])
+        daily_returns = pd.DataFrame(daily_returns, index=dates, columns=index_ids)
+        # the index universe is fixed between cache refreshes so the covariance of the daily returns (including
+        # the 'index' benchmark) can be computed once and used for closed-form volatility & tracking error
+        covariance = daily_returns.cov()
+        return daily_returns, pd.DataFrame(cum_returns, index=dates, columns=index_ids), covariance
+
+    def _build_annualized_returns():
+        return pd.DataFrame(
+            annualized_rs.randint(-1000, 1001, size=(len(years), len(index_ids))) / 1000.0,
+            index=years, columns=index_ids
+        )
 
-    def build_stats():
-        return {
-            'annualized': random.randint(0, 100) / 100.0,
-            'compounded return': random.randint(0, 20000) / 1000.0,
-            'excess over index (annualized)': random.randint(0, 1100) / 10000.0,
-            'tracking error': random.randint(1000, 2100) / 1000.0,
-            'volatility': random.randint(0, 1600) / 1000.0,
-            'ir': random.randint(-150, 150) / 100.0
+    def _build_excess_returns():
+        excess_returns = pd.DataFrame(
+            excess_rs.randint(-2500, 2501, size=(len(years), len(index_ids))) / 10000.0,
+            index=years, columns=index_ids
+        )
+        # keep every column float so the frame is stored as a single block like the other return frames, the long
+        # exposure frames stay mixed dtype but requests read their dense tensors instead
+        excess_returns.loc[:, 'index'] = 0.0
+        return excess_returns
+
+    def _build_stats():
+        stat_ranges = [
+            ('annualized', 0, 100, 100.0),
+            ('compounded return', 0, 20000, 1000.0),
+            ('excess over index (annualized)', 0, 1100, 10000.0),
+            ('tracking error', 1000, 2100, 1000.0),
+            ('volatility', 0, 1600, 1000.0),
+            ('ir', -150, 150, 100.0),
+        ]
+        stat_vals = {
+            stat: stats_rs.randint(low, high + 1, size=len(index_ids)) / scale
+            for stat, low, high, scale in stat_ranges
         }
-    
-    stats = {i_id: build_stats() for i_id in index_ids}
-    logger.info('cached {} index stats'.format(len(stats)))
+        return {i_id: {stat: vals[i] for stat, vals in stat_vals.items()} for i, i_id in enumerate(index_ids)}
+
+    blocks = run_parallel([
+        ('barra exposures', _build_exposures(BARRA_FACTORS, barra_rs)),
+        ('sectors exposures', _build_exposures(SECTOR_IDS, sectors_rs)),
+        ('daily & cumulative returns', _build_returns),
+        ('annualized returns', _build_annualized_returns),
+        ('excess returns', _build_excess_returns),
+        ('index stats', _build_stats),
+    ])
+    barra, barra_tensor = blocks['barra exposures']
+    sectors, sectors_tensor = blocks['sectors exposures']
+    daily_returns, cum_returns, covariance = blocks['daily & cumulative returns']
+    logger.info('cached {} barra & {} sectors exposures, {} daily returns & {} index stats'.format(
+        len(barra), len(sectors), len(daily_returns), len(blocks['index stats'])
+    ))
 
     return dict(
         barra=barra,
         sectors=sectors,
-        returns=dict(cumulative=cum_returns, daily=daily_returns, annualized=annualized_returns, excess=excess_returns),
-        stats=stats
+        returns=dict(
+            cumulative=cum_returns, daily=daily_returns, annualized=blocks['annualized returns'],
+            excess=blocks['excess returns'], covariance=covariance
+        ),
+        stats=blocks['index stats'],
+        exposures=dict(sectors=sectors_tensor, barra=barra_tensor)
+    )
+
+
+def build_exposure_tensor(exposures):
+    """
+    Pivots a long-format exposures frame (date, name & one column per index) into a dense
+    dates x names x indexes array so weighted exposures can be computed without any re-indexing.
+
+    Parameters
+    ----------
+    exposures: pandas.DataFrame
+        exposures with "date" & "name" columns and a column of values for each index
+
+    Returns
+    -------
+    dict
+        values (dates x names x indexes), present (dates x names mask of populated date/name pairs)
+        and the labels for each axis (dates, names, columns)
+    """
+    exposures = exposures.set_index(['date', 'name'])
+    dates, names = exposures.index.levels
+    exposures = exposures.reindex(pd.MultiIndex.from_product([dates, names]))
+    values = exposures.values.reshape(len(dates), len(names), len(exposures.columns))
+    present = exposures.notnull().any(axis=1).values.reshape(len(dates), len(names))
+    return dict(
+        # the frame's values are a transposed view of its block so they're copied into one contiguous array
+        values=np.ascontiguousarray(np.nan_to_num(values)), present=present, dates=dates, names=names,
+        columns=exposures.columns
     )
 
-SAMPLE_INDEXES = map(lambda i: 'sample_index_{}'.format(i), range(1,5)) + ['index']
+
+SAMPLE_INDEXES = build_sample_indexes()
+
+
+def find_sample_indexes(indices):
+    """
+    Sample indexes (including the 'index' benchmark) within the index data, datasets written by
+    :mod:`dataset` can contain any number of them.
+    """
+    samples = [i_id for i_id in indices['stats'] if i_id.startswith('sample_index_')]
+    return sorted(samples, key=lambda i_id: int(i_id.split('_')[-1])) + ['index']
 
 
 def build_index_id(factors, args):
@@ -196,70 +319,166 @@ def load_weighted_values(factors, data, factor_settings):
         yield data[index] * weight
 
 
-def load_results_stats(factors, indices, factor_settings):
-    def load_stats(args):
-        factor_id, settings = args
-        index = build_index_id(factors, args)
-        if index is None:
-            return {}
-        weight = settings.get('weight', 0) / 100.0
-        stat_vals = {k: v for k, v in indices['stats'].get(index, {}).items()}
-        factor_cfg = factors[factor_id]
-        # rating should only be applied to HI "Pro" selections
-        stat_vals['rating'] = 0 if settings.get('strength') == 'LO' else factor_cfg.get('rating')
-        return {k: v * weight for k, v in stat_vals.items()}
-
-    stats = pd.DataFrame(map(load_stats, factor_settings.items())).sum().to_dict()
-    if len(stats):
-        daily_returns = pd.concat(load_weighted_values(factors, indices['returns']['daily'], factor_settings), axis=1)
-        daily_returns = daily_returns.sum(axis=1)
+def build_weight_matrix(factors, user_settings):
+    """
+    Builds a users x indexes matrix of the weights each user has assigned to the indexes backing their
+    factor selections along with the rating each user has accumulated from those selections.
+
+    Parameters
+    ----------
+    factors: dict
+        factor configurations keyed by factor id
+    user_settings: dict
+        factor settings keyed by user
+
+    Returns
+    -------
+    tuple of (pandas.DataFrame, pandas.Series)
+        weights (users x indexes) and ratings (users), users without any valid selections are excluded
+    """
+    weights, ratings = {}, {}
+    for user, factor_settings in user_settings.items():
+        user_weights = defaultdict(float)
+        rating = 0
+        for factor_id, settings in factor_settings.items():
+            index = build_index_id(factors, (factor_id, settings))
+            if index is None:
+                continue
+            weight = settings.get('weight', 0) / 100.0
+            user_weights[index] += weight
+            # rating should only be applied to HI "Pro" selections
+            if settings.get('strength') != 'LO':
+                rating += factors[factor_id].get('rating') * weight
+        if len(user_weights):
+            weights[user] = user_weights
+            ratings[user] = rating
+    weights = pd.DataFrame.from_dict(weights, orient='index').fillna(0)
+    return weights, pd.Series(ratings)
+
+
+@cache.results_memoize(cache.RESULTS_CACHE)
+def load_all_results_stats(factors, indices, user_settings):
+    """
+    Computes the weighted index stats, volatility, tracking error & IR of every user in one pass by building
+    a users x indexes weight matrix and applying it to the index stats & the covariance of the daily returns.
+
+    Parameters
+    ----------
+    factors: dict
+        factor configurations keyed by factor id
+    indices: dict
+        index data built by :meth:`load_indexes`
+    user_settings: dict
+        factor settings keyed by user
+
+    Returns
+    -------
+    dict
+        stats keyed by user, users without any valid selections will map to an empty dictionary
+    """
+    results = {user: {} for user in user_settings}
+    with timing.span('weight_matrix'):
+        weights, ratings = build_weight_matrix(factors, user_settings)
+    if not len(weights):
+        return results
+
+    with timing.span('weighted_stats'):
+        index_stats = pd.DataFrame(indices['stats']).T
+        index_stats = index_stats.reindex(weights.columns).fillna(0)
+        weighted_stats = weights.values.dot(index_stats.values)
+
+    # volatility & tracking error in closed form from the precomputed covariance matrix:
+    #   var(P) = w'Cw, var(P - B) = w'Cw - 2w'c_B + var(B)
+    with timing.span('covariance_risk'):
+        covariance = indices['returns']['covariance']
+        cov_cols = [col for col in weights.columns if col in covariance.columns]
+        cov_weights = weights[cov_cols].values
+        portfolio_variance = (cov_weights.dot(covariance.loc[cov_cols, cov_cols].values) * cov_weights).sum(axis=1)
+        benchmark_covariance = cov_weights.dot(covariance.loc[cov_cols, 'index'].values)
+        active_variance = portfolio_variance - 2 * benchmark_covariance + covariance.loc['index', 'index']
         annualization_factor = np.sqrt(252) / 100
-        stats['volatility'] = daily_returns.std() * annualization_factor
-        stats['tracking error'] = (daily_returns - indices['returns']['daily']['index']).std() * annualization_factor
+        volatility = np.sqrt(np.clip(portfolio_variance, 0, None)) * annualization_factor
+        tracking_error = np.sqrt(np.clip(active_variance, 0, None)) * annualization_factor
+
+    for i, user in enumerate(weights.index):
+        stats = dict(zip(index_stats.columns, weighted_stats[i]))
+        stats['rating'] = ratings[user]
+        stats['volatility'] = volatility[i]
+        stats['tracking error'] = tracking_error[i]
         stats['ir'] = stats['excess over index (annualized)'] / stats['tracking error']
-    return stats
+        results[user] = stats
+    return results
+
+
+def load_results_stats(factors, indices, factor_settings):
+    return load_all_results_stats(factors, indices, {'user': factor_settings})['user']
+
+
+def load_weighted_exposures(factors, tensor, factor_settings):
+    """
+    Applies a user's weights to a tensor built by :meth:`build_exposure_tensor`.
+
+    Returns
+    -------
+    dict
+        lists of date/value records keyed by exposure name or None if the user has not selected any of the
+        indexes in the tensor
+    """
+    weights, _ = build_weight_matrix(factors, {'user': factor_settings})
+    if not any(col in tensor['columns'] for col in weights.columns):
+        return None
+    weights = weights.reindex(columns=tensor['columns'], fill_value=0).values[0]
+    with timing.span('tensordot'):
+        exposures = np.tensordot(tensor['values'], weights, axes=([2], [0]))
+    with timing.span('to_records'):
+        return {
+            name: [
+                {'date': date, 'val': val}
+                for date, val, present in zip(tensor['dates'], exposures[:, i], tensor['present'][:, i]) if present
+            ]
+            for i, name in enumerate(tensor['names'])
+        }
 
 
+@cache.results_memoize(cache.RESULTS_CACHE)
 def load_user_results(factors, indices, factor_settings):
     results = dict(settings={k: dict_merge(dict(label=factors[k]['label']), v) for k, v in factor_settings.items()})
-    sectors = list(load_weighted_values(factors, indices['sectors'].set_index(['date', 'name']), factor_settings))
-    if len(sectors):
-        sectors = pd.concat(sectors, axis=1).sum(axis=1)
-        sectors.name = 'val'
-        sectors = sectors.reset_index(level='date')
-        results['sectors'] = {k: g.to_dict(orient='records') for k, g in sectors.groupby(level='name')}
-
-    barra = list(load_weighted_values(factors, indices['barra'].set_index(['date', 'name']), factor_settings))
-    if len(barra):
-        barra = pd.concat(barra, axis=1).sum(axis=1)
-        barra.name = 'val'
-        barra = barra.reset_index(level='date')
-        results['barra'] = {k: g.to_dict(orient='records') for k, g in barra.groupby(level='name')}
+    for key in ['sectors', 'barra']:
+        exposures = load_weighted_exposures(factors, indices['exposures'][key], factor_settings)
+        if exposures is not None:
+            results[key] = exposures
 
     returns = {}
     excess_returns = list(load_weighted_values(factors, indices['returns']['excess'], factor_settings))
     if len(excess_returns):
-        excess_returns = pd.concat(excess_returns, axis=1).sum(axis=1)
+        with timing.span('concat'):
+            excess_returns = pd.concat(excess_returns, axis=1).sum(axis=1)
         excess_returns.name = 'val'
         excess_returns.index.name = 'date'
-        returns['excess'] = excess_returns.reset_index().to_dict(orient='records')
+        with timing.span('to_records'):
+            returns['excess'] = excess_returns.reset_index().to_dict(orient='records')
 
     annualized_returns = list(load_weighted_values(factors, indices['returns']['annualized'], factor_settings))
     if len(annualized_returns):
-        annualized_returns = pd.concat(annualized_returns, axis=1).sum(axis=1)
+        with timing.span('concat'):
+            annualized_returns = pd.concat(annualized_returns, axis=1).sum(axis=1)
         annualized_returns.name = 'val'
         annualized_returns.index.name = 'date'
-        returns['annualized'] = annualized_returns.reset_index().to_dict(orient='records')
+        with timing.span('to_records'):
+            returns['annualized'] = annualized_returns.reset_index().to_dict(orient='records')
 
     results['returns'] = returns
     return results
 
 
+@cache.results_memoize(cache.RESULTS_CACHE)
 def load_cumulative_returns(factors, indices, factor_settings):
     cumulative_returns = list(load_weighted_values(factors, indices['returns']['cumulative'], factor_settings))
     if len(cumulative_returns):
-        cumulative_returns = pd.concat(cumulative_returns, axis=1).sum(axis=1)
+        with timing.span('concat'):
+            cumulative_returns = pd.concat(cumulative_returns, axis=1).sum(axis=1)
         cumulative_returns.name = 'val'
         cumulative_returns.index.name = 'date'
-        return cumulative_returns.reset_index().to_dict(orient='records')
+        with timing.span('to_records'):
+            return cumulative_returns.reset_index().to_dict(orient='records')
     return []
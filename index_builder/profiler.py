@@ -0,0 +1,225 @@
+"""
+On-demand request profiling.  Admins can profile a fraction of all requests and/or every request to a named
+endpoint (or path).  Captured profiles are kept in a bounded ring buffer so they can be browsed on the debug page or
+downloaded in the standard pstats format.
+
+Settings & profiles are shared by every gunicorn worker through files in a folder under the data path (see
+:meth:`init`) so a change made through whichever worker serves it applies to all of them and the debug page lists
+the profiles captured by every worker:
+
+    <path>/settings.json            sample rate & endpoint
+    <path>/profile_<id>.json        endpoint, path, duration & top functions of a captured profile
+    <path>/profile_<id>.prof        its pstats data
+
+Only one request per worker is profiled at a time since the profiler hooks the whole thread (and with gevent, every
+greenlet running on it).
+"""
+import cProfile
+import glob
+import json
+import marshal
+import os
+import pstats
+import random
+import threading
+import time
+from datetime import datetime
+from timeit import default_timer
+
+from utils import get_logger, get_mtime, mkdir_p, mtime_settled
+
+logger = get_logger()
+
+MAX_PROFILES = 20
+TOP_FUNCTIONS = 25
+SETTINGS_FILE = 'settings.json'
+DEFAULT_SETTINGS = dict(rate=0.0, endpoint=None)
+
+_state = dict(path=None, settings=dict(DEFAULT_SETTINGS), mtime=None)
+_lock = threading.Lock()
+_active = dict(profile=None, start=None)
+# marks the request (greenlet under gevent) which started the active profile so only it can stop it
+_local = threading.local()
+
+
+def init(path):
+    """
+    Sets the folder settings & profiles are shared through, it's only created once something is written to it.
+    """
+    _state.update(path=path, settings=dict(DEFAULT_SETTINGS), mtime=None)
+
+
+def _write(fname, data, mode='w'):
+    tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp_fname, mode) as f:
+        f.write(data)
+    os.rename(tmp_fname, fname)
+
+
+def get_settings():
+    """
+    Current settings, only re-read when another worker has changed them.
+    """
+    if _state['path'] is None:
+        return dict(_state['settings'])
+    fname = os.path.join(_state['path'], SETTINGS_FILE)
+    mtime = get_mtime(fname)
+    if mtime is None:
+        _state.update(settings=dict(DEFAULT_SETTINGS), mtime=None)
+    elif mtime != _state['mtime'] or not mtime_settled(mtime):
+        try:
+            with open(fname) as f:
+                settings = json.load(f)
+        except (IOError, ValueError):
+            settings = DEFAULT_SETTINGS
+        _state.update(settings=dict(DEFAULT_SETTINGS, **settings), mtime=mtime)
+    return dict(_state['settings'])
+
+
+def configure(rate=None, endpoint=None):
+    """
+    Updates the profiling settings of every worker.
+
+    Parameters
+    ----------
+    rate: float, optional
+        fraction (0-1) of all requests to profile
+    endpoint: str, optional
+        profile every request to this endpoint name (e.g. "find_user_results") or path, an empty string turns
+        endpoint profiling off
+    """
+    settings = get_settings()
+    if rate is not None:
+        settings['rate'] = min(max(float(rate), 0.0), 1.0)
+    if endpoint is not None:
+        settings['endpoint'] = endpoint or None
+    if _state['path'] is not None:
+        mkdir_p(_state['path'])
+        _write(os.path.join(_state['path'], SETTINGS_FILE), json.dumps(settings))
+    _state['settings'] = settings
+    return dict(settings)
+
+
+def _profile_fnames():
+    if _state['path'] is None:
+        return []
+    # ids are capture timestamps so sorting by id sorts newest first
+    fnames = glob.glob(os.path.join(_state['path'], 'profile_*.json'))
+    return sorted(fnames, key=lambda fname: int(os.path.basename(fname)[8:-5]), reverse=True)
+
+
+def _remove(fname):
+    for fname in [fname, fname.replace('.json', '.prof')]:
+        try:
+            os.remove(fname)
+        except OSError:
+            pass  # already removed by another worker
+
+
+def clear():
+    for fname in _profile_fnames():
+        _remove(fname)
+
+
+def list_profiles():
+    """
+    Saved profiles (without their pstats data) newest first.
+    """
+    profiles = []
+    for fname in _profile_fnames():
+        try:
+            with open(fname) as f:
+                profiles.append(json.load(f))
+        except (IOError, ValueError):
+            pass  # removed by another worker since listing
+    return profiles
+
+
+def should_profile(endpoint, path):
+    settings = get_settings()
+    named = settings['endpoint']
+    if named is not None and named in (path, endpoint, (endpoint or '').split('.')[-1]):
+        return True
+    return settings['rate'] > 0 and random.random() < settings['rate']
+
+
+def start():
+    if not _lock.acquire(False):
+        return False
+    profile = cProfile.Profile()
+    _active.update(profile=profile, start=default_timer())
+    _local.profiling = True
+    profile.enable()
+    return True
+
+
+def is_active():
+    return getattr(_local, 'profiling', False)
+
+
+def build_top_functions(stats, limit=TOP_FUNCTIONS):
+    rows = []
+    for (fname, line, func), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append(dict(
+            function='{}:{}({})'.format(fname, line, func), calls=calls, tottime=tottime, cumtime=cumtime
+        ))
+    return sorted(rows, key=lambda r: r['cumtime'], reverse=True)[:limit]
+
+
+def stop(endpoint, path):
+    """
+    Stops the active profile and saves it, dropping the oldest profiles beyond MAX_PROFILES.
+
+    Returns
+    -------
+    dict
+        the saved profile or None if nothing was being profiled
+    """
+    if not is_active():
+        return None
+    profile = _active['profile']
+    try:
+        profile.disable()
+        duration = default_timer() - _active['start']
+        profile.create_stats()
+        stats = pstats.Stats(profile)
+        entry = dict(
+            id=int(time.time() * 1e6),
+            endpoint=endpoint,
+            path=path,
+            captured=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            duration=duration,
+            top_functions=build_top_functions(stats),
+        )
+        if _state['path'] is not None:
+            try:
+                mkdir_p(_state['path'])
+                fname = os.path.join(_state['path'], 'profile_{}'.format(entry['id']))
+                _write(fname + '.prof', marshal.dumps(profile.stats), mode='wb')
+                _write(fname + '.json', json.dumps(entry))
+                for old_fname in _profile_fnames()[MAX_PROFILES:]:
+                    _remove(old_fname)
+            except (IOError, OSError) as ex:
+                logger.error('unable to save profile of {}: {}'.format(path, ex))
+        return entry
+    finally:
+        _active.update(profile=None, start=None)
+        _local.profiling = False
+        _lock.release()
+
+
+def find_profile(profile_id):
+    """
+    A saved profile along with its pstats data or None if it's not found.
+    """
+    if _state['path'] is None:
+        return None
+    fname = os.path.join(_state['path'], 'profile_{}'.format(profile_id))
+    try:
+        with open(fname + '.json') as f:
+            profile = json.load(f)
+        with open(fname + '.prof', 'rb') as f:
+            profile['data'] = f.read()
+    except (IOError, ValueError):
+        return None
+    return profile
@@ -2,12 +2,16 @@ import os
 import sys
 from flask import (Flask, redirect, request,
                    url_for, render_template,
-                   session)
+                   session, g)
 from flask_compress import Compress
 import traceback
 from getpass import getuser
 import re
+from timeit import default_timer
 
+import profiler
+import metrics
+import timing
 from utils import logger, get_factor_settings
 from views import index_builder, startup
 
@@ -67,6 +71,10 @@ rargs = sys.argv[1:]
 if rargs:
     update_app_from_command_line(app, rargs)
 
+# per-request timing spans reported in a Server-Timing header
+app.config['TIMING_SPANS'] = app.config.get('TIMING_SPANS', os.environ.get('TIMING_SPANS'))
+timing.enable(str(app.config['TIMING_SPANS']).lower() == 'true')
+
 app.jinja_env.trim_blocks = True
 app.jinja_env.lstrip_blocks = True
 app.register_blueprint(index_builder)
@@ -74,6 +82,35 @@ compress = Compress()
 compress.init_app(app)
 
 
+@app.before_request
+def start_timing():
+    g.request_start = default_timer()
+    timing.start_request()
+    if request.endpoint != 'static' and profiler.should_profile(request.endpoint, request.path):
+        profiler.start()
+
+
+@app.after_request
+def report_timing(response):
+    results = timing.end_request()
+    if results is not None:
+        response.headers['Server-Timing'] = timing.build_server_timing(results)
+        logger.info(timing.build_log_line(request.path, results))
+    metrics.record_request(
+        request.url_rule.rule if request.url_rule else 'unmatched', request.method, response.status_code,
+        default_timer() - g.request_start, response.content_length
+    )
+    metrics.flush()
+    return response
+
+
+@app.teardown_request
+def stop_profiler(exc=None):
+    # teardown runs even when a view raises so the profiler is never left enabled
+    if profiler.is_active():
+        profiler.stop(request.endpoint, request.path)
+
+
 @app.route('/')
 @app.route('/index-builder')
 @app.route('/index-builder/main')
@@ -81,6 +118,11 @@ def root():
     return redirect('/index-builder/factors')
 
 
+@app.route('/metrics')
+def find_metrics():
+    return app.response_class(metrics.render(metrics.collect()), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/favicon.ico')
 def favicon():
     return redirect(url_for('static', filename='images/favicon.ico'))
@@ -127,6 +169,7 @@ def logout():
     return redirect(url_for('login'))
 
 
+profiler.init(os.path.join(app.config['DATA_PATH'], 'profiler'))
 startup(app.config['DATA_PATH'])
 
 
@@ -0,0 +1,117 @@
+"""
+Warm-start snapshots of the loaded datasets.  After a successful load the factor, GICS & (when they aren't already
+served from the memory-mapped store, see :mod:`store`) index data are pickled under the data path so the next
+startup can read them back rather than re-running the full load.
+
+    <path>/snapshot/snapshot.json       format version, checksum of the payload & when its data was loaded
+    <path>/snapshot/snapshot.pkl        pickled datasets keyed by name
+
+A snapshot is only used if its format version matches, its checksum is valid and it was taken after the source
+data was last modified.  Bump SNAPSHOT_VERSION whenever the layout of the loaded datasets changes.
+"""
+import cPickle as pickle
+import hashlib
+import json
+import os
+
+from utils import get_logger, mkdir_p
+
+logger = get_logger()
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_DIR = 'snapshot'
+HEADER = 'snapshot.json'
+PAYLOAD = 'snapshot.pkl'
+CHUNK_SIZE = 1024 * 1024
+
+
+def build_snapshot_path(path):
+    return os.path.join(path, SNAPSHOT_DIR)
+
+
+def source_mtime(sources):
+    mtimes = [os.path.getmtime(fname) for fname in sources if os.path.exists(fname)]
+    return max(mtimes) if mtimes else 0
+
+
+def file_checksum(fname):
+    checksum = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def write_snapshot(path, datasets, loaded_at):
+    """
+    Saves loaded datasets.
+
+    Parameters
+    ----------
+    path: str
+        data path, the snapshot will be written to a "snapshot" folder within it
+    datasets: dict
+        datasets keyed by name
+    loaded_at: float
+        timestamp taken before the datasets were loaded, the snapshot is stale once any source is modified after it
+    """
+    snapshot_path = build_snapshot_path(path)
+    mkdir_p(snapshot_path)
+    # workers may be writing snapshots at the same time so each writes its own temporary files
+    tmp_payload = os.path.join(snapshot_path, '{}.{}.tmp'.format(PAYLOAD, os.getpid()))
+    with open(tmp_payload, 'wb') as f:
+        pickle.dump(datasets, f, pickle.HIGHEST_PROTOCOL)
+    header = dict(version=SNAPSHOT_VERSION, checksum=file_checksum(tmp_payload), loaded_at=loaded_at,
+                  datasets=sorted(datasets))
+    os.rename(tmp_payload, os.path.join(snapshot_path, PAYLOAD))
+    tmp_header = os.path.join(snapshot_path, '{}.{}.tmp'.format(HEADER, os.getpid()))
+    with open(tmp_header, 'w') as f:
+        json.dump(header, f)
+    os.rename(tmp_header, os.path.join(snapshot_path, HEADER))
+    logger.info('wrote snapshot of {} to {}'.format(', '.join(header['datasets']), snapshot_path))
+
+
+def load_snapshot(path, sources):
+    """
+    Loads the datasets saved by :meth:`write_snapshot`.
+
+    Parameters
+    ----------
+    path: str
+        data path
+    sources: list of str
+        files the datasets were loaded from
+
+    Returns
+    -------
+    dict
+        datasets keyed by name or None if there is no usable snapshot
+    """
+    snapshot_path = build_snapshot_path(path)
+    try:
+        with open(os.path.join(snapshot_path, HEADER)) as f:
+            header = json.load(f)
+    except (IOError, ValueError):
+        logger.info('no snapshot found in {}'.format(snapshot_path))
+        return None
+    if header.get('version') != SNAPSHOT_VERSION:
+        logger.info('ignoring snapshot with unsupported version: {}'.format(header.get('version')))
+        return None
+    if source_mtime(sources) > header['loaded_at']:
+        logger.info('ignoring snapshot older than its source data')
+        return None
+    payload = os.path.join(snapshot_path, PAYLOAD)
+    try:
+        # read once so the checksum is verified against the same bytes which are unpickled
+        with open(payload, 'rb') as f:
+            data = f.read()
+        if hashlib.sha1(data).hexdigest() != header['checksum']:
+            logger.error('ignoring snapshot with invalid checksum')
+            return None
+        datasets = pickle.loads(data)
+        del data
+    except Exception:
+        logger.exception('unable to load snapshot from {}'.format(snapshot_path))
+        return None
+    logger.info('loaded snapshot of {} from {}'.format(', '.join(sorted(datasets)), snapshot_path))
+    return datasets
@@ -0,0 +1,216 @@
+"""
+On-disk columnar layout for the index data built by :meth:`model.load_indexes`.  Each block of values is saved as
+a column-major .npy file (so every index's series is one contiguous run of floats) along with a shared date axis
+and is memory-mapped read-only on load.  This lets every gunicorn worker share the same page-cache pages rather
+than holding its own copy of each frame.
+
+    <path>/indexes/manifest.json        columns, date axes, exposure names & index stats
+    <path>/indexes/axis_<n>.npy         datetime64[ns] date axes shared between blocks
+    <path>/indexes/<block>.npy          dates x indexes (returns) or dates x names x indexes (exposures)
+
+Factor data (nested dictionaries & lists served as-is to the front-end) is kept in a pickle alongside it.
+
+    <path>/factors.pkl
+"""
+
+import cPickle as pickle
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from utils import get_logger, mkdir_p
+
+logger = get_logger()
+
+STORE_VERSION = 1
+STORE_DIR = 'indexes'
+MANIFEST = 'manifest.json'
+FACTORS_FILE = 'factors.pkl'
+RETURN_BLOCKS = ['daily', 'cumulative', 'annualized', 'excess']
+EXPOSURE_BLOCKS = ['sectors', 'barra']
+
+
+def build_store_path(path):
+    return os.path.join(path, STORE_DIR)
+
+
+def has_index_store(path):
+    return os.path.isfile(os.path.join(build_store_path(path), MANIFEST))
+
+
+def _save(store_path, fname, values):
+    # write to a temporary file and rename so workers which still have the previous version memory-mapped keep
+    # reading the old inode rather than a half-written file
+    tmp_fname = os.path.join(store_path, '{}.tmp'.format(fname))
+    with open(tmp_fname, 'wb') as f:
+        np.save(f, values)
+    os.rename(tmp_fname, os.path.join(store_path, fname))
+
+
+def write_index_store(indices, path):
+    """
+    Converts index data in the DataFrame layout returned by :meth:`model.load_indexes` into the memory-mapped
+    columnar format.
+
+    Parameters
+    ----------
+    indices: dict
+        index data built by :meth:`model.load_indexes`
+    path: str
+        data path, the store will be written to a "indexes" folder within it
+    """
+    store_path = build_store_path(path)
+    mkdir_p(store_path)
+    axes = []
+
+    def save_axis(dates):
+        dates = np.asarray(dates, dtype='datetime64[ns]')
+        for i, axis in enumerate(axes):
+            if len(axis) == len(dates) and (axis == dates).all():
+                return 'axis_{}.npy'.format(i)
+        fname = 'axis_{}.npy'.format(len(axes))
+        axes.append(dates)
+        _save(store_path, fname, dates)
+        return fname
+
+    manifest = dict(version=STORE_VERSION, returns={}, exposures={}, stats=indices['stats'])
+    for block in RETURN_BLOCKS:
+        df = indices['returns'][block]
+        fname = '{}.npy'.format(block)
+        _save(store_path, fname, np.asfortranarray(df.values, dtype='float64'))
+        manifest['returns'][block] = dict(values=fname, dates=save_axis(df.index), columns=list(df.columns))
+
+    covariance = indices['returns']['covariance']
+    _save(store_path, 'covariance.npy', covariance.values)
+    manifest['returns']['covariance'] = dict(values='covariance.npy', columns=list(covariance.columns))
+
+    for block in EXPOSURE_BLOCKS:
+        tensor = indices['exposures'][block]
+        fname, present_fname = '{}.npy'.format(block), '{}_present.npy'.format(block)
+        _save(store_path, fname, np.asfortranarray(tensor['values'], dtype='float64'))
+        _save(store_path, present_fname, tensor['present'])
+        manifest['exposures'][block] = dict(
+            values=fname, present=present_fname, dates=save_axis(tensor['dates']),
+            names=list(tensor['names']), columns=list(tensor['columns'])
+        )
+
+    tmp_manifest = os.path.join(store_path, '{}.tmp'.format(MANIFEST))
+    with open(tmp_manifest, 'w') as f:
+        json.dump(manifest, f)
+    os.rename(tmp_manifest, os.path.join(store_path, MANIFEST))
+    logger.info('wrote index store to {}'.format(store_path))
+
+
+def exposure_frame(tensor):
+    """
+    Rebuilds the long-format (date, name & one column per index) exposures frame from a tensor.
+    """
+    dates, names = tensor['dates'], tensor['names']
+    values = tensor['values'].reshape(len(dates) * len(names), len(tensor['columns']))
+    df = pd.DataFrame(values, columns=tensor['columns'])
+    df['date'] = np.repeat(dates.values, len(names))
+    df['name'] = np.tile(np.asarray(names, dtype=object), len(dates))
+    return df[tensor['present'].reshape(-1)].reset_index(drop=True)
+
+
+def load_index_store(path):
+    """
+    Loads index data from the columnar format written by :meth:`write_index_store`.  All values are
+    memory-mapped read-only so they are shared between processes through the page cache.
+
+    Returns
+    -------
+    dict
+        index data in the same layout as :meth:`model.load_indexes`
+    """
+    store_path = build_store_path(path)
+    with open(os.path.join(store_path, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != STORE_VERSION:
+        raise ValueError('unsupported index store version: {}'.format(manifest.get('version')))
+
+    axes = {}
+
+    def load_axis(fname):
+        if fname not in axes:
+            axes[fname] = pd.DatetimeIndex(np.load(os.path.join(store_path, fname)))
+        return axes[fname]
+
+    def load_values(fname):
+        return np.load(os.path.join(store_path, fname), mmap_mode='r')
+
+    def load_labels(labels):
+        # JSON hands back unicode labels, keep them consistent with the str labels used elsewhere
+        return pd.Index(map(str, labels))
+
+    returns = {}
+    for block in RETURN_BLOCKS:
+        spec = manifest['returns'][block]
+        returns[block] = pd.DataFrame(
+            load_values(spec['values']), index=load_axis(spec['dates']), columns=load_labels(spec['columns']),
+            copy=False
+        )
+    spec = manifest['returns']['covariance']
+    returns['covariance'] = pd.DataFrame(
+        load_values(spec['values']), index=load_labels(spec['columns']), columns=load_labels(spec['columns']),
+        copy=False
+    )
+
+    exposures = {}
+    for block in EXPOSURE_BLOCKS:
+        spec = manifest['exposures'][block]
+        exposures[block] = dict(
+            values=load_values(spec['values']), present=load_values(spec['present']),
+            dates=load_axis(spec['dates']), names=load_labels(spec['names']), columns=load_labels(spec['columns'])
+        )
+
+    indices = dict(
+        returns=returns,
+        stats={str(k): {str(stat): v for stat, v in stats.items()} for k, stats in manifest['stats'].items()},
+        exposures=exposures,
+    )
+    for block in EXPOSURE_BLOCKS:
+        indices[block] = exposure_frame(exposures[block])
+    logger.info('loaded index store from {}'.format(store_path))
+    return indices
+
+
+def has_factor_store(path):
+    return os.path.isfile(os.path.join(path, FACTORS_FILE))
+
+
+def write_factor_store(factors, path):
+    mkdir_p(path)
+    fname = os.path.join(path, FACTORS_FILE)
+    tmp_fname = '{}.tmp'.format(fname)
+    with open(tmp_fname, 'wb') as f:
+        pickle.dump(factors, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_fname, fname)
+    logger.info('wrote {} factors to {}'.format(len(factors), fname))
+
+
+def load_factor_store(path):
+    fname = os.path.join(path, FACTORS_FILE)
+    with open(fname, 'rb') as f:
+        factors = pickle.load(f)
+    logger.info('loaded {} factors from {}'.format(len(factors), fname))
+    return factors
+
+
+def main(args=None):
+    """
+    Converts the index data built by :meth:`model.build_indexes` into the columnar store under the path passed
+    on the command-line (defaults to the DATA_PATH environment variable).
+    """
+    import model
+
+    args = sys.argv[1:] if args is None else args
+    path = args[0] if len(args) else os.environ['DATA_PATH']
+    write_index_store(model.build_indexes(), path)
+
+
+if __name__ == '__main__':
+    main()
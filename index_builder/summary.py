@@ -0,0 +1,195 @@
+"""
+Per-factor & per-strength aggregates of the locked users' factor settings (sum of weights, number of selections &
+reason counts) backing the summary page.  Rather than rescanning every user on each request the aggregates are
+updated one user at a time as the user settings store reports changes (see
+:meth:`users.UserSettingsStore.add_listener`) so serving the summary only has to read them.
+The number of locked & unlocked users shown on every page is served from them as well.
+:meth:`SummaryAggregates.check` rebuilds them from scratch to verify they haven't drifted.
+"""
+import threading
+from collections import defaultdict
+
+import utils
+
+logger = utils.get_logger()
+
+STRENGTHS = ('HI', 'LO')
+# adding & removing float weights leaves rounding residue in the running sums
+WEIGHT_TOLERANCE = 1e-6
+
+
+def normalize_factors(user, factors):
+    """
+    Factor selections which can be aggregated.  Selections without a valid strength or with a non-numeric weight are
+    skipped & missing weights or reasons are treated as empty (as :func:`model.load_weighted_values` does), so a
+    malformed entry never leaves a user partially aggregated.
+    """
+    normalized = {}
+    for factor_id, inputs in (factors or {}).items():
+        inputs = inputs if isinstance(inputs, dict) else {}
+        weight = inputs.get('weight', 0)
+        if inputs.get('strength') not in STRENGTHS or isinstance(weight, bool) \
+                or not isinstance(weight, (int, long, float)):
+            logger.error('skipping invalid selection of {} by {}: {}'.format(factor_id, user, inputs))
+            continue
+        normalized[factor_id] = dict(inputs, weight=weight, reasons=list(inputs.get('reasons') or []))
+    return normalized
+
+
+def build_factor_aggregates():
+    return {strength: dict(weight=0, count=0, reasons=defaultdict(int), selections={}) for strength in STRENGTHS}
+
+
+class ArchiveAggregates(object):
+    """
+    Aggregates of a single archive (or the current users).
+    """
+
+    def __init__(self):
+        self.users = {}  # user -> factors if they're locked, otherwise None
+        self.locked_users = 0
+        self.factors = defaultdict(build_factor_aggregates)
+
+    def add(self, user, factor_settings):
+        factors = normalize_factors(user, factor_settings.get('factors')) if factor_settings.get('locked') else None
+        self.remove(user)
+        if factors is None:
+            self.users[user] = None
+            return
+        self.users[user] = factors
+        self.locked_users += 1
+        for factor_id, inputs in factors.items():
+            agg = self.factors[factor_id][inputs['strength']]
+            agg['weight'] += inputs['weight']
+            agg['count'] += 1
+            for r_id in inputs['reasons']:
+                agg['reasons'][r_id] += 1
+            agg['selections'][user] = inputs
+
+    def remove(self, user):
+        factors = self.users.pop(user, None)
+        if factors is not None:
+            self.locked_users -= 1
+        for factor_id, inputs in (factors or {}).items():
+            agg = self.factors[factor_id][inputs['strength']]
+            agg['weight'] -= inputs['weight']
+            agg['count'] -= 1
+            for r_id in inputs['reasons']:
+                agg['reasons'][r_id] -= 1
+                if not agg['reasons'][r_id]:
+                    del agg['reasons'][r_id]
+            agg['selections'].pop(user, None)
+
+    def to_dict(self):
+        aggregates = {}
+        for factor_id, strengths in self.factors.items():
+            for strength, agg in strengths.items():
+                if agg['count']:
+                    aggregates[(factor_id, strength)] = dict(
+                        weight=agg['weight'], count=agg['count'], reasons=dict(agg['reasons']),
+                        users=sorted(agg['selections'])
+                    )
+        return dict(users=self.users, locked_users=self.locked_users, factors=aggregates)
+
+    def matches(self, other):
+        """
+        Whether two archives' aggregates are the same, allowing for rounding residue in the sums of weights.
+        """
+        current, other = self.to_dict(), other.to_dict()
+        weights = {key: agg.pop('weight') for key, agg in current['factors'].items()}
+        other_weights = {key: agg.pop('weight') for key, agg in other['factors'].items()}
+        return current == other and all(
+            abs(weight - other_weights[key]) <= WEIGHT_TOLERANCE for key, weight in weights.items()
+        )
+
+
+class SummaryAggregates(object):
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._archives = defaultdict(ArchiveAggregates)
+        store.add_listener(self.update)
+
+    def reset(self):
+        with self._lock:
+            self._archives.clear()
+
+    def update(self, archive, user, factor_settings):
+        with self._lock:
+            if factor_settings is None:
+                self._archives[archive].remove(user)
+            else:
+                self._archives[archive].add(user, factor_settings)
+
+    def user_counts(self, archive=None):
+        """
+        Number of locked & unlocked users, only checking the store for changes from other processes.
+        """
+        self.store.sync(archive)
+        with self._lock:
+            aggregates = self._archives[archive]
+            return dict(locked=aggregates.locked_users, unlocked=len(aggregates.users) - aggregates.locked_users)
+
+    def summarize(self, factors, archive=None):
+        """
+        Summary of the locked users' selections for each factor.
+
+        Parameters
+        ----------
+        factors: dict
+            factors keyed by id, see :meth:`model.build_factors`
+        archive: str, optional
+            archive to summarize, defaults to the current users
+
+        Returns
+        -------
+        dict
+            selections, average weights & percentage of users selecting each reason by strength keyed by factor id
+        """
+        self.store.sync(archive)
+        with self._lock:
+            aggregates = self._archives[archive]
+            total_users = aggregates.locked_users
+            summary = {}
+            for factor_id, factor in factors.items():
+                factor_aggregates = aggregates.factors.get(factor_id) or build_factor_aggregates()
+                summary[factor_id] = dict(
+                    label=factor['label'],
+                    selections={
+                        strength: [
+                            utils.dict_merge(inputs, dict(user=user))
+                            for user, inputs in sorted(agg['selections'].items())
+                        ] for strength, agg in factor_aggregates.items()
+                    },
+                    avg={
+                        strength: (agg['weight'] * 1.0) / total_users if total_users else 0
+                        for strength, agg in factor_aggregates.items()
+                    },
+                    ethical_wt=dict(HI=0, LO=0),
+                    reason_avg={
+                        strength: {r_id: ((total * 1.0) / agg['count']) * 100 for r_id, total in agg['reasons'].items()}
+                        for strength, agg in factor_aggregates.items()
+                    },
+                )
+        return summary
+
+    def check(self, archive=None):
+        """
+        Rebuilds an archive's aggregates from scratch, replacing them if they've drifted.
+
+        Returns
+        -------
+        bool
+            True if the aggregates were consistent
+        """
+        self.store.sync(archive)
+        rebuilt = ArchiveAggregates()
+        for user, factor_settings, _ in self.store.get_all(archive):
+            rebuilt.add(user, factor_settings)
+        with self._lock:
+            consistent = rebuilt.matches(self._archives[archive])
+            if not consistent:
+                logger.error('rebuilt inconsistent summary aggregates of {}'.format(archive or 'current users'))
+                self._archives[archive] = rebuilt
+        return consistent
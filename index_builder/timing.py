@@ -0,0 +1,123 @@
+"""
+Lightweight per-request timing spans.  Code on the hot paths wraps its steps in ``with timing.span('name'):`` and
+memoized lookups record hits & misses with :meth:`count`.  When enabled the server collects these for every request
+and reports them in a Server-Timing response header & a structured log line.
+
+When disabled (the default) :meth:`span` hands back a shared no-op context manager so the cost is one global lookup.
+"""
+import json
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from timeit import default_timer
+
+# under gevent's monkey-patching this is greenlet-local so concurrent requests in a worker don't mix their timings,
+# when preloading gunicorn_config.py patches before the app is imported so this holds there too
+_local = threading.local()
+_enabled = False
+
+INVALID_NAME_CHARS = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def enable(enabled=True):
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled():
+    return _enabled
+
+
+class _NoopSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span(object):
+    __slots__ = ('name', 'timings', 'start')
+
+    def __init__(self, name, timings):
+        self.name = name
+        self.timings = timings
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *args):
+        self.timings[self.name] += default_timer() - self.start
+        return False
+
+
+def _current():
+    if not _enabled:
+        return None
+    return getattr(_local, 'request', None)
+
+
+def span(name):
+    """
+    Context manager recording the time spent within it under `name`.  Repeated spans with the same name within a
+    request are summed.
+    """
+    request = _current()
+    if request is None:
+        return NOOP_SPAN
+    return Span(name, request['timings'])
+
+
+def count(name, amount=1):
+    request = _current()
+    if request is not None:
+        request['counters'][name] += amount
+
+
+def start_request():
+    if _enabled:
+        _local.request = dict(start=default_timer(), timings=defaultdict(float), counters=defaultdict(int))
+
+
+def end_request():
+    """
+    Stops collecting for the current request.
+
+    Returns
+    -------
+    dict
+        total duration, span timings (seconds) & counters or None if nothing was being collected
+    """
+    request = getattr(_local, 'request', None)
+    _local.request = None
+    if request is None:
+        return None
+    return dict(
+        total=default_timer() - request['start'],
+        timings=OrderedDict(sorted(request['timings'].items())),
+        counters=OrderedDict(sorted(request['counters'].items())),
+    )
+
+
+def _metric_name(name):
+    return INVALID_NAME_CHARS.sub('_', name)
+
+
+def build_server_timing(results):
+    metrics = ['total;dur={:.1f}'.format(results['total'] * 1000)]
+    metrics += ['{};dur={:.1f}'.format(_metric_name(k), v * 1000) for k, v in results['timings'].items()]
+    metrics += ['{};desc="{}"'.format(_metric_name(k), v) for k, v in results['counters'].items()]
+    return ', '.join(metrics)
+
+
+def build_log_line(path, results):
+    return 'request timings: {}'.format(json.dumps(dict(
+        path=path,
+        total_ms=round(results['total'] * 1000, 3),
+        spans_ms={k: round(v * 1000, 3) for k, v in results['timings'].items()},
+        counters=results['counters'],
+    ), sort_keys=True))
@@ -0,0 +1,390 @@
+"""
+Storage for users' factor settings, selected with the USER_STORE environment variable (see :meth:`build_store`).
+
+yaml (default)
+    one YAML file per user under the users folder, archives are folders alongside it (users_<archive>).  Parsed
+    settings are snapshotted in memory so requests don't list & parse the users' files each time.  Folders are only
+    re-listed when their mtime changes, and every save replaces a user's file through a rename (see
+    :meth:`utils.dump_yaml`) so any save, from any worker, updates it.  When a folder is re-listed only the files
+    whose mtimes have changed are parsed again.  Files are also re-checked every FULL_CHECK_INTERVAL seconds to pick
+    up edits made in place, and anything modified within utils.RACY_WINDOW seconds of a check is never trusted since
+    another change in the same mtime tick would go unnoticed.
+sqlite
+    a single SQLite database in WAL mode so the gunicorn workers can read while another writes.  Settings, locked
+    flags, last update times & archive tags are stored in one table so bulk reads like "all locked users in archive
+    X" are a single indexed query.  SQLite's own wait on a locked database sleeps in C, which would stall every
+    greenlet in a gevent worker, so it's kept short & queries are retried with a (monkey-patched) sleep instead.
+    The first time it's opened any existing YAML users & archives are copied into it, this can also be run by hand:
+
+        python -m index_builder.users --db /path/to/users.db
+
+Both notify listeners of changes to users' settings (see :meth:`UserSettingsStore.add_listener`), which is how the
+aggregates in :mod:`summary` are kept up to date.
+"""
+import argparse
+import copy
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import utils
+
+logger = utils.get_logger()
+
+BACKENDS = ('yaml', 'sqlite')
+SETTINGS_EXT = '.yaml'
+FULL_CHECK_INTERVAL = 30
+# seconds sqlite waits on a locked database itself before its query is retried
+BUSY_TIMEOUT = 0.05
+MAX_RETRY_DELAY = 0.5
+NEXT_VERSION = 'SELECT COALESCE(MAX(version), 0) + 1 FROM user_settings'
+
+
+def default_settings():
+    return dict(factors={}, locked=False)
+
+
+class UserSettingsStore(object):
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """
+        Registers a function called with (archive, user, factor settings) whenever a user's settings are saved or
+        are found to have been changed by another process, the settings are None once a user has been removed from
+        an archive.  Register listeners before anything is read so they see every user.
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, archive, user, factor_settings):
+        for listener in self._listeners:
+            listener(archive or None, user, factor_settings)
+
+
+class YamlUserSettingsStore(UserSettingsStore):
+    """
+    User factor settings stored as one YAML file per user in the users folder or one of its archives.
+    """
+
+    def __init__(self, users_path=None):
+        """
+        Parameters
+        ----------
+        users_path: str, optional
+            folder of the current users, archives are folders alongside it.  Defaults to utils.USERS_PATH
+        """
+        super(YamlUserSettingsStore, self).__init__()
+        self.users_path = users_path
+        self._folders = {}
+        self._scanned = {}  # folder each archive's users were last reported from
+
+    def build_users_path(self, archive=None):
+        users_path = self.users_path or utils.USERS_PATH
+        if archive:
+            return '{}_{}'.format(users_path, archive)
+        return users_path
+
+    def reset(self):
+        with self._lock:
+            self._folders.clear()
+            self._scanned.clear()
+
+    def _scan(self, archive=None):
+        """
+        Returns
+        -------
+        :class:`collections.OrderedDict`
+            (mtime, factor settings) keyed by user
+        """
+        now = time.time()
+        users_path = self.build_users_path(archive)
+        dir_mtime = utils.get_mtime(users_path)
+        folder = self._folders.get(users_path)
+        scanned = self._scanned.get(archive)
+        if scanned is not None and scanned != users_path:
+            # the users folder has moved (e.g. utils.USERS_PATH changed) so the users reported from the old one are
+            # gone & every user in the new one is reported, even if its folder was scanned before
+            for user in self._folders[scanned]['users']:
+                self._notify(archive, user, None)
+            folder = None
+        if folder is not None and folder['mtime'] == dir_mtime and utils.mtime_settled(dir_mtime, now) \
+                and now - folder['checked'] < FULL_CHECK_INTERVAL:
+            return folder['users']
+
+        previous = folder['users'] if folder is not None else {}
+        users = OrderedDict()
+        for fname in sorted(os.listdir(users_path)) if dir_mtime is not None else []:
+            user, ext = os.path.splitext(fname)
+            if ext != SETTINGS_EXT or fname.startswith('.'):
+                continue
+            path = os.path.join(users_path, fname)
+            mtime = utils.get_mtime(path)
+            cached = previous.get(user)
+            if cached is not None and cached[0] == mtime and utils.mtime_settled(mtime, now):
+                users[user] = cached
+            else:
+                users[user] = mtime, utils.load_yaml(path) or default_settings()
+                self._notify(archive, user, users[user][1])
+        for user in previous:
+            if user not in users:
+                self._notify(archive, user, None)
+        self._folders[users_path] = dict(mtime=dir_mtime, checked=now, users=users)
+        self._scanned[archive] = users_path
+        return users
+
+    def sync(self, archive=None):
+        """
+        Picks up changes made by other processes, notifying listeners of them.
+        """
+        with self._lock:
+            self._scan(archive)
+
+    def get_all(self, archive=None, locked_only=False):
+        """
+        Every user's factor settings, these are shared so they must not be modified.
+
+        Returns
+        -------
+        list of tuple
+            (user, factor settings, timestamp of the user's last update)
+        """
+        with self._lock:
+            users = self._scan(archive)
+            return [
+                (user, settings, mtime) for user, (mtime, settings) in users.items()
+                if not locked_only or settings['locked']
+            ]
+
+    def get(self, user, archive=None):
+        with self._lock:
+            entry = self._scan(archive).get(user)
+        if entry is None:
+            return default_settings()
+        return copy.deepcopy(entry[1])
+
+    def exists(self, user, archive=None):
+        with self._lock:
+            return user in self._scan(archive)
+
+    def save(self, user, factor_settings):
+        users_path = self.build_users_path()
+        utils.mkdir_p(users_path)
+        fname = os.path.join(users_path, '{}{}'.format(user, SETTINGS_EXT))
+        utils.dump_yaml(factor_settings, fname)
+        with self._lock:
+            folder = self._folders.get(users_path)
+            if folder is not None:
+                folder['users'][user] = utils.get_mtime(fname), copy.deepcopy(factor_settings)
+                self._notify(None, user, folder['users'][user][1])
+
+    def archive(self, name):
+        # the new users folder's mtime will differ so its next scan reports the archived users as removed
+        os.rename(self.build_users_path(), self.build_users_path(name))
+        utils.mkdir_p(self.build_users_path())
+
+    def archives(self):
+        parent, prefix = os.path.split(self.build_users_path())
+        prefix += '_'
+        return [fname[len(prefix):] for fname in os.listdir(parent) if fname.startswith(prefix)]
+
+
+class SqliteUserSettingsStore(UserSettingsStore):
+    """
+    User factor settings stored in a SQLite database, the current users are stored under an empty archive.  Every
+    write stamps the rows it touches with the next version so changes can be picked up incrementally.
+    """
+
+    def __init__(self, fname, timeout=30):
+        """
+        Parameters
+        ----------
+        fname: str
+            database file
+        timeout: float, optional
+            seconds to keep retrying queries while another process holds the database's lock
+        """
+        super(SqliteUserSettingsStore, self).__init__()
+        self.fname = fname
+        self.timeout = timeout
+        self._local = threading.local()
+        self._synced = {}
+        self._retry(lambda conn: conn.executescript('''
+            CREATE TABLE IF NOT EXISTS user_settings (
+                archive TEXT NOT NULL,
+                user TEXT NOT NULL,
+                settings TEXT NOT NULL,
+                locked INTEGER NOT NULL,
+                last_update REAL NOT NULL,
+                version INTEGER NOT NULL,
+                PRIMARY KEY (archive, user)
+            );
+            CREATE INDEX IF NOT EXISTS user_settings_locked ON user_settings (archive, locked);
+            CREATE INDEX IF NOT EXISTS user_settings_version ON user_settings (archive, version);
+        '''))
+
+    def _connect(self):
+        # connections can't be shared across threads or forked workers
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.fname, timeout=BUSY_TIMEOUT)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _retry(self, func):
+        """
+        Runs func with this thread's connection, retrying for up to `timeout` seconds while the database is locked.
+        Results should be fetched within func, writes made within a transaction are rolled back before a retry.
+        """
+        deadline = time.time() + self.timeout
+        delay = BUSY_TIMEOUT
+        while True:
+            try:
+                return func(self._connect())
+            except sqlite3.OperationalError as ex:
+                if 'locked' not in str(ex) or time.time() >= deadline:
+                    raise
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    def reset(self):
+        with self._lock:
+            self._synced.clear()
+
+    def sync(self, archive=None):
+        """
+        Picks up changes made by other processes (or threads), notifying listeners of them.
+        """
+        archive = archive or ''
+        with self._lock:
+            synced = self._synced.setdefault(archive, dict(version=0, users=set()))
+            version, count = self._retry(lambda conn: conn.execute(
+                'SELECT MAX(version), COUNT(*) FROM user_settings WHERE archive = ?', (archive,)
+            ).fetchone())
+            if (version or 0) == synced['version'] and count == len(synced['users']):
+                return
+            rows = self._retry(lambda conn: conn.execute(
+                'SELECT user, settings FROM user_settings WHERE archive = ? AND version > ?',
+                (archive, synced['version'])
+            ).fetchall())
+            for user, settings in rows:
+                synced['users'].add(user)
+                self._notify(archive, user, json.loads(settings))
+            if count != len(synced['users']):
+                rows = self._retry(lambda conn: conn.execute(
+                    'SELECT user FROM user_settings WHERE archive = ?', (archive,)
+                ).fetchall())
+                users = {user for user, in rows}
+                for user in synced['users'] - users:
+                    self._notify(archive, user, None)
+                synced['users'] = users
+            synced['version'] = version or 0
+
+    def get_all(self, archive=None, locked_only=False):
+        query = 'SELECT user, settings, last_update FROM user_settings WHERE archive = ?'
+        if locked_only:
+            query += ' AND locked = 1'
+        rows = self._retry(lambda conn: conn.execute(query + ' ORDER BY user', (archive or '',)).fetchall())
+        return [(user, json.loads(settings), last_update) for user, settings, last_update in rows]
+
+    def get(self, user, archive=None):
+        row = self._retry(lambda conn: conn.execute(
+            'SELECT settings FROM user_settings WHERE archive = ? AND user = ?', (archive or '', user)
+        ).fetchone())
+        return json.loads(row[0]) if row else default_settings()
+
+    def exists(self, user, archive=None):
+        return self._retry(lambda conn: conn.execute(
+            'SELECT 1 FROM user_settings WHERE archive = ? AND user = ?', (archive or '', user)
+        ).fetchone()) is not None
+
+    def _insert(self, conn, archive, user, factor_settings, last_update, replace=True):
+        return conn.execute(
+            'INSERT OR {} INTO user_settings VALUES (?, ?, ?, ?, ?, ({}))'.format(
+                'REPLACE' if replace else 'IGNORE', NEXT_VERSION
+            ),
+            (archive or '', user, json.dumps(factor_settings), int(bool(factor_settings.get('locked'))), last_update)
+        )
+
+    def _write(self, func):
+        def _transaction(conn):
+            with conn:
+                return func(conn)
+        return self._retry(_transaction)
+
+    def save(self, user, factor_settings):
+        self._write(lambda conn: self._insert(conn, None, user, factor_settings, time.time()))
+        self.sync()
+
+    def archive(self, name):
+        self._write(lambda conn: conn.execute(
+            'UPDATE user_settings SET archive = ?, version = ({}) WHERE archive = ?'.format(NEXT_VERSION), (name, '')
+        ))
+
+    def archives(self):
+        rows = self._retry(lambda conn: conn.execute(
+            "SELECT DISTINCT archive FROM user_settings WHERE archive != '' ORDER BY 1"
+        ).fetchall())
+        return [archive for archive, in rows]
+
+    def migrate(self, source, force=False):
+        """
+        Copies the current users & archives of another store into this one.  Unless forced this is skipped once the
+        database holds any settings, users already in the database are never overwritten.
+
+        Returns
+        -------
+        int
+            number of users' settings copied
+        """
+        if not force and self._retry(lambda conn: conn.execute('SELECT 1 FROM user_settings LIMIT 1').fetchone()):
+            return 0
+        users = [
+            (archive, user, factor_settings, last_update or time.time())
+            for archive in [None] + source.archives() for user, factor_settings, last_update in source.get_all(archive)
+        ]
+        count = self._write(lambda conn: sum(
+            self._insert(conn, archive, user, factor_settings, last_update, replace=False).rowcount
+            for archive, user, factor_settings, last_update in users
+        ))
+        logger.info('migrated settings of {} users into {}'.format(count, self.fname))
+        return count
+
+
+def build_store(backend, users_path=None, db_fname=None):
+    """
+    Parameters
+    ----------
+    backend: str
+        one of BACKENDS
+    users_path: str, optional
+        folder of the current YAML users (see :class:`YamlUserSettingsStore`), defaults to utils.USERS_PATH
+    db_fname: str, optional
+        SQLite database, defaults to utils.USER_DB_FNAME.  It's seeded with the YAML users under `users_path`
+    """
+    if backend == 'yaml':
+        return YamlUserSettingsStore(users_path)
+    if backend == 'sqlite':
+        store = SqliteUserSettingsStore(db_fname or utils.USER_DB_FNAME)
+        store.migrate(YamlUserSettingsStore(users_path))
+        return store
+    raise ValueError('unsupported user settings store: {}, expecting one of {}'.format(backend, ', '.join(BACKENDS)))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Copy YAML user settings & archives into a SQLite database')
+    parser.add_argument('--db', default=utils.USER_DB_FNAME, help='database file (defaults to $USER_DB)')
+    parser.add_argument('--force', action='store_true', help='copy even if the database already holds settings')
+    args = parser.parse_args(sys.argv[1:] if args is None else args)
+    SqliteUserSettingsStore(args.db).migrate(YamlUserSettingsStore(), force=args.force)
+
+
+if __name__ == '__main__':
+    main()
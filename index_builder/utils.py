@@ -4,7 +4,17 @@ import os
 import sys
 import logging as log
 import yaml
+import threading
 import time
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+import timing
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader, SafeDumper
 
 log.basicConfig(format="%(asctime)s - %(levelname)-8s - %(message)s", level=log.DEBUG)
 for handler in log.getLogger().handlers:
@@ -54,6 +64,17 @@ def get_int_arg(r, name, default=None):
             return default
 
 
+def get_float_arg(r, name, default=None):
+    val = r.args.get(name)
+    if val is None or val == '':
+        return default
+    else:
+        try:
+            return float(val)
+        except:
+            return default
+
+
 def get_bool_arg(r, name):
     return r.args.get(name, 'false').lower() == 'true'
 
@@ -142,18 +163,164 @@ def mkdir_p(path):
     except Exception as ex:
         logger.error(ex)
 
+SMAPS_FIELDS = ['Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty']
+
+
+_parallel = threading.local()
+
+
+def _native_threadpool():
+    """
+    gevent's pool of native threads when threading has been monkey-patched (in a gevent worker threads would
+    otherwise be greenlets taking turns on one core), None when it hasn't.
+    """
+    try:
+        from gevent import get_hub, monkey
+    except ImportError:
+        return None
+    if monkey.is_module_patched('threading'):
+        return get_hub().threadpool
+    return None
+
+
+def run_native(func, *args, **kwargs):
+    """
+    Runs a CPU-bound function on one of gevent's native threads (see :meth:`_native_threadpool`) so the worker's
+    other greenlets keep being served while it runs, only the calling greenlet waits on it.  Without gevent (or
+    when already running on one of its native threads) it's run in the calling thread.
+    """
+    native_pool = _native_threadpool()
+    if native_pool is None or getattr(_parallel, 'active', False):
+        return func(*args, **kwargs)
+
+    def _run():
+        _parallel.active = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _parallel.active = False
+
+    return native_pool.apply(_run)
+
+
+def run_parallel(tasks, processes=None):
+    """
+    Runs independent tasks in threads, numpy & file I/O release the GIL so loads overlap on multi-core hosts.
+    Each task's time is logged.
+
+    Parameters
+    ----------
+    tasks: list of tuple
+        (name, function taking no arguments)
+    processes: int, optional
+        number of threads, defaults to one per task
+
+    Returns
+    -------
+    dict
+        results keyed by task name, the first exception raised by a task is re-raised
+    """
+    def _run(name, func):
+        active, _parallel.active = getattr(_parallel, 'active', False), True
+        start = time.time()
+        try:
+            return func()
+        finally:
+            _parallel.active = active
+            logger.info('{} finished in {:.3f}s'.format(name, time.time() - start))
+
+    native_pool = _native_threadpool()
+    if len(tasks) < 2 or (native_pool is not None and getattr(_parallel, 'active', False)):
+        # gevent's pool can't be used from its own threads so nested tasks run in the calling thread
+        return {name: _run(name, func) for name, func in tasks}
+    if native_pool is not None:
+        pending = [(name, native_pool.spawn(_run, name, func)) for name, func in tasks]
+        return {name: result.get() for name, result in pending}
+    pool = ThreadPool(processes or len(tasks))
+    try:
+        pending = [(name, pool.apply_async(_run, (name, func))) for name, func in tasks]
+        return {name: result.get() for name, result in pending}
+    finally:
+        pool.close()
+        pool.join()
+
+
+def process_memory(pid='self'):
+    """
+    Summarizes the memory of a process from /proc/<pid>/smaps_rollup (or smaps on older kernels).  Pages still
+    shared with other processes (such as copy-on-write pages inherited from the gunicorn master when preloading)
+    are reported separately from the pages private to the process.
+
+    Parameters
+    ----------
+    pid: int or str, optional
+        process id, defaults to the current process
+
+    Returns
+    -------
+    dict
+        rss, pss, shared & private sizes in bytes
+    """
+    fname = '/proc/{}/smaps_rollup'.format(pid)
+    if not os.path.isfile(fname):
+        fname = '/proc/{}/smaps'.format(pid)
+    totals = defaultdict(int)
+    with open(fname) as f:
+        for line in f:
+            field, _, val = line.partition(':')
+            if field in SMAPS_FIELDS:
+                totals[field] += int(val.split()[0]) * 1024
+    return dict(
+        rss=totals['Rss'],
+        pss=totals['Pss'],
+        shared=totals['Shared_Clean'] + totals['Shared_Dirty'],
+        private=totals['Private_Clean'] + totals['Private_Dirty']
+    )
+
 DATA_PATH = os.path.join(os.path.dirname(__file__), 'data')
-USERS_PATH = os.path.join(DATA_PATH, 'users')  # build folder structure if it doesn't exist
-mkdir_p(USERS_PATH)
+
+
+def build_user_data_paths(environ):
+    """
+    Users folder & SQLite database: $USERS_PATH & $USER_DB, otherwise under the app's data path ($DATA_PATH) when
+    it's set so a dataset written there by :mod:`dataset` is served along with its users, falling back to the
+    package's data folder.
+    """
+    path = environ.get('DATA_PATH') or DATA_PATH
+    return (
+        environ.get('USERS_PATH') or os.path.join(path, 'users'),
+        environ.get('USER_DB') or os.path.join(path, 'users.db'),
+    )
+
+
+USERS_PATH, USER_DB_FNAME = build_user_data_paths(os.environ)
+mkdir_p(USERS_PATH)  # build folder structure if it doesn't exist
 APP_SETTINGS_FNAME = os.path.join(DATA_PATH, 'app_settings.yaml')
 
 
+RACY_WINDOW = 2
+
+
+def get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def mtime_settled(mtime, now=None):
+    """
+    Whether a file's contents can be trusted not to have changed while its mtime stays the same, anything modified
+    within RACY_WINDOW seconds could still be changed again without its mtime moving on.
+    """
+    return mtime is not None and (now or time.time()) - mtime > RACY_WINDOW
+
+
+USER_STORE_BACKEND = os.environ.get('USER_STORE', 'yaml')
+
+
 def find_available_archives():
-    archives = []
-    for fname in os.listdir(DATA_PATH):
-        if fname.startswith('users_'):
-            archives.append(fname.replace('users_', ''))
-    return archives
+    return get_user_store().archives()
 
 
 def build_users_path(archive=None):
@@ -166,20 +333,72 @@ def build_factor_settings_file_path(user, archive=None):
     return os.path.join(build_users_path(archive), '{}.yaml'.format(user))
 
 
+class YamlLoader(SafeLoader):
+    """
+    Safe loader (using libyaml when it's available) which also accepts the ``!!python/unicode`` tags python 2's
+    :meth:`yaml.dump` writes, files can be rewritten without them using :meth:`compact_yaml`.
+    """
+
+
+YamlLoader.add_constructor(u'tag:yaml.org,2002:python/unicode', lambda loader, node: loader.construct_scalar(node))
+
+
 def dump_yaml(data, fname):
-    with open(fname, "w+") as f:
-        yaml.safe_dump(data, f, default_flow_style=False, allow_unicode=True)
+    # write to a temporary file & rename so readers never see a partially written file and the folder's mtime
+    # changes with every save (see :mod:`users`)
+    tmp_fname = os.path.join(os.path.dirname(fname), '.{}.{}.tmp'.format(os.path.basename(fname), os.getpid()))
+    with open(tmp_fname, "w+") as f:
+        yaml.dump(data, f, Dumper=SafeDumper, default_flow_style=False, allow_unicode=True)
+    os.rename(tmp_fname, fname)
 
 
 def load_yaml(fname):
     if os.path.isfile(fname):
-        with open(fname) as f:
-            return yaml.load(f)
+        with timing.span('yaml_load'), open(fname) as f:
+            return yaml.load(f, Loader=YamlLoader)
     return None
 
 
+def compact_yaml(fname):
+    """
+    One-time rewrite of a YAML file without any ``!!python/*`` tags so the plain safe loader can parse it (and
+    libyaml can parse it much faster), e.g. gics_mappings.yaml which was written with every key & value tagged.
+    """
+    dump_yaml(load_yaml(fname), fname)
+
+
+USER_STORE = None
+SUMMARY_AGGREGATES = None
+
+
+def set_user_store(store):
+    """
+    Serves users' settings from another store (e.g. a benchmark's synthetic users), None reverts to the configured
+    store the next time it's used.
+    """
+    global USER_STORE, SUMMARY_AGGREGATES
+    import summary  # this imports this module so it can't be imported at the top
+
+    # created before anything is read from the store so the aggregates see every user
+    SUMMARY_AGGREGATES = summary.SummaryAggregates(store) if store is not None else None
+    USER_STORE = store
+
+
+def get_user_store():
+    if USER_STORE is None:
+        import users  # this imports this module so it can't be imported at the top
+
+        set_user_store(users.build_store(USER_STORE_BACKEND))
+    return USER_STORE
+
+
+def get_summary_aggregates():
+    get_user_store()
+    return SUMMARY_AGGREGATES
+
+
 def dump_factor_settings(user, factor_settings):
-    dump_yaml(factor_settings, build_factor_settings_file_path(user))
+    get_user_store().save(user, factor_settings)
 
 
 def get_all_user_factors(locked=True, archive=None):
@@ -188,47 +407,65 @@ def get_all_user_factors(locked=True, archive=None):
 
 
 def get_all_user_factor_settings(locked=True, include_last_update=False, archive=None):
-    users_path = build_users_path(archive)
-    for fname in os.listdir(users_path):
-        user, _ = os.path.splitext(fname)
-        factor_settings = get_factor_settings(user)
-        if not locked or factor_settings['locked']:
-            if include_last_update:
-                last_update = time.ctime(os.path.getmtime(os.path.join(users_path, fname)))
-                yield user, factor_settings, last_update
-            else:
-                yield user, factor_settings
+    for user, factor_settings, last_update in get_user_store().get_all(archive, locked_only=locked):
+        if include_last_update:
+            yield user, factor_settings, time.ctime(last_update) if last_update is not None else None
+        else:
+            yield user, factor_settings
+
+
+def build_archive_name(tag=None):
+    current_timestamp = pd.Timestamp('now').strftime('%Y%m%d%H%M%S')
+    if tag is not None:
+        return '{}_{}'.format('_'.join(tag.split(" ")), current_timestamp)
+    return current_timestamp
 
 
 def archive_all_user_factor_settings(tag=None):
     try:
-        current_timestamp = pd.Timestamp('now').strftime('%Y%m%d%H%M%S')
-        if tag is not None:
-            tag = '_'.join(tag.split(" "))
-            os.rename(USERS_PATH, USERS_PATH.replace('users', 'users_{}_{}'.format(tag, current_timestamp)))
-        else:
-            os.rename(USERS_PATH, USERS_PATH.replace('users', 'users_{}'.format(current_timestamp)))
-        mkdir_p(USERS_PATH)
+        get_user_store().archive(build_archive_name(tag))
     except Exception as ex:
         logger.error(ex)
 
 
+def user_exists(user):
+    return get_user_store().exists(user)
+
+
 def get_user_counts():
-    user_counts = dict(locked=0, unlocked=0)
-    for _, factor_settings in get_all_user_factor_settings(locked=False):
-        user_counts['locked'] += int(factor_settings['locked'])
-        user_counts['unlocked'] += int(not factor_settings['locked'])
-    return user_counts
+    return get_summary_aggregates().user_counts()
 
 
 def get_factor_settings(user, archive=None):
-    fname = build_factor_settings_file_path(user, archive=archive)
-    return load_yaml(fname) or dict(factors={}, locked=False)
+    return get_user_store().get(user, archive)
+
+
+APP_SETTINGS = dict(mtime=None, settings=None)
 
 
 def get_app_settings():
-    return load_yaml(APP_SETTINGS_FNAME) or dict(summary_viewable=False)
+    # only re-read when another worker has saved them (or they were saved too recently to trust the mtime)
+    mtime = get_mtime(APP_SETTINGS_FNAME)
+    if APP_SETTINGS['settings'] is None or APP_SETTINGS['mtime'] != mtime or not mtime_settled(mtime):
+        APP_SETTINGS.update(mtime=mtime, settings=load_yaml(APP_SETTINGS_FNAME) or dict(summary_viewable=False))
+    return dict(APP_SETTINGS['settings'])
 
 
 def dump_app_settings(settings):
     dump_yaml(settings, APP_SETTINGS_FNAME)
+    APP_SETTINGS.update(mtime=get_mtime(APP_SETTINGS_FNAME), settings=dict(settings))
+
+
+def main(args=None):
+    """
+    Rewrites the YAML files passed on the command-line using :meth:`compact_yaml`.
+
+        python -m index_builder.utils index_builder/data/gics_mappings.yaml
+    """
+    for fname in sys.argv[1:] if args is None else args:
+        compact_yaml(fname)
+        logger.info('rewrote {}'.format(fname))
+
+
+if __name__ == '__main__':
+    main()
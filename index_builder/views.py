@@ -4,14 +4,19 @@ import os
 import re
 from datetime import datetime, timedelta
 import subprocess
+import threading
+import time
 from pympler.asizeof import asizeof
 from pympler.util import stringutils
-from operator import itemgetter
 import yaml
-from collections import defaultdict
 import traceback
 
 import cache
+import metrics
+import profiler
+import snapshot
+import store
+import timing
 import utils as utils
 import model as model
 import auth as auth
@@ -20,6 +25,10 @@ logger = utils.get_logger()
 
 index_builder = Blueprint('index_builder', __name__, url_prefix='/index-builder')
 
+GICS_MAPPINGS_FILE = os.path.join(os.path.dirname(__file__), 'data', 'gics_mappings.yaml')
+# seconds requests will wait on another request's in-flight load of the same data before giving up
+LOAD_TIMEOUT = float(os.environ.get('LOAD_TIMEOUT', 300))
+
 
 def startup(path):
     logger.info('pytest: {}, flask: {}, gunicorn: {}'.format(
@@ -28,21 +37,190 @@ def startup(path):
     # when running flask in debug it spins up two instances, we only want this code
     # run during startup of the second instance
     if not utils.running_with_pytest() and (utils.running_with_flask() or utils.running_with_gunicorn()):
-        load_gics_mappings()
-        load_factors(path)
+        cache.init_generations(path)
+        if not warm_start(path):
+            loaded_at = time.time()
+            factors, indices, gics = build_datasets(path, trigger='startup')
+            cache.swap_values(build_dataset_entries(path, factors, indices, gics))
+            save_snapshot(path, loaded_at, factors, indices, gics)
+        metrics.flush(force=True)
+
+
+def snapshot_sources(path):
+    return [
+        os.path.join(path, store.FACTORS_FILE),
+        os.path.join(store.build_store_path(path), store.MANIFEST),
+        GICS_MAPPINGS_FILE,
+    ]
+
+
+def warm_start(path):
+    """
+    Primes the caches from the snapshot saved after the last successful load.
+
+    Returns
+    -------
+    bool
+        False if there was no usable snapshot
+    """
+    with metrics.time_load('snapshot', 'startup'):
+        datasets = snapshot.load_snapshot(path, snapshot_sources(path))
+    if datasets is None:
+        return False
+    entries = [(cache.GICS_CACHE, [], datasets['gics']), (cache.FACTOR_CACHE, [path], datasets['factors'])]
+    if 'indexes' in datasets:
+        entries.append((cache.INDEXES_CACHE, [path], datasets['indexes']))
+    cache.swap_values(entries)
+    with metrics.time_load('indexes', 'startup'):
         load_indexes(path)
-        pass
+    return True
+
+
+def save_snapshot(path, loaded_at, factors, indices, gics):
+    """
+    Returns
+    -------
+    bool
+        True if the snapshot was written
+    """
+    datasets = dict(factors=factors, gics=gics)
+    if not store.has_index_store(path):
+        # indexes loaded from the store are memory-mapped which is already cheaper than reading a snapshot
+        datasets['indexes'] = indices
+    try:
+        snapshot.write_snapshot(path, datasets, loaded_at)
+        return True
+    except Exception:
+        logger.exception('unable to write snapshot to {}'.format(path))
+        return False
+
+
+def build_datasets(path, trigger='refresh'):
+    """
+    Loads fresh copies of the factor, index & GICS data in parallel without touching the cached copies.
+    """
+    def _timed(dataset, func):
+        def _load():
+            with metrics.time_load(dataset, trigger):
+                return func()
+        return dataset, _load
+
+    datasets = utils.run_parallel([
+        _timed('factors', lambda: model.load_factors(path)),
+        _timed('indexes', lambda: model.load_indexes(path)),
+        _timed('gics', read_gics_mappings),
+    ])
+    return datasets['factors'], datasets['indexes'], datasets['gics']
+
+
+def build_dataset_entries(path, factors, indices, gics):
+    return [
+        (cache.FACTOR_CACHE, [path], factors),
+        (cache.INDEXES_CACHE, [path], indices),
+        (cache.GICS_CACHE, [], gics),
+    ]
 
 
-@index_builder.route('/force-refresh')
-def refresh_cached_data():
-    cache.clear_all_caches()
+def validate_datasets(factors, indices, gics):
+    if not factors:
+        raise ValueError('no factors were loaded')
+    missing = [k for k in ['returns', 'stats', 'exposures'] if k not in indices]
+    if missing:
+        raise ValueError('index data is missing: {}'.format(', '.join(missing)))
+    if indices['returns']['daily'].empty:
+        raise ValueError('no index returns were loaded')
+    missing = sorted(set(indices['returns']['daily'].columns) - set(indices['stats']))
+    if missing:
+        raise ValueError('stats are missing for indexes: {}'.format(', '.join(missing)))
+    if not gics:
+        raise ValueError('no GICS mappings were loaded')
 
-    load_factors(app.config['DATA_PATH'])
-    load_indexes(app.config['DATA_PATH'])
-    load_gics_mappings()
 
-    return jsonify(results=[])
+# generation of the datasets this worker is serving, its background reload & snapshot write (if any)
+_datasets = dict(generation=None, reload=None, snapshot=None)
+
+
+def publish_datasets():
+    """
+    Tells the other workers to load the datasets this one has just refreshed, called once they've been snapshotted.
+    """
+    _datasets['generation'] = cache.DATASETS_GENERATION.bump()
+
+
+def snapshot_datasets(path, loaded_at, factors, indices, gics):
+    # pickling the datasets is CPU-bound so it's run on a native thread under gevent
+    if utils.run_native(save_snapshot, path, loaded_at, factors, indices, gics):
+        publish_datasets()
+    else:
+        # other workers would reload the previous snapshot, they pick up the new data on their next refresh
+        logger.error('not publishing refreshed datasets to other workers without a snapshot of them')
+
+
+def reload_datasets(path, generation):
+    """
+    Loads the datasets another worker has refreshed, preferring the snapshot it saved, & swaps them in.  The current
+    datasets keep being served while this runs.
+    """
+    try:
+        with metrics.time_load('snapshot', 'reload'):
+            datasets = utils.run_native(snapshot.load_snapshot, path, snapshot_sources(path))
+        if datasets is None:
+            factors, indices, gics = build_datasets(path, trigger='reload')
+        else:
+            factors, gics = datasets['factors'], datasets['gics']
+            indices = datasets.get('indexes')
+            if indices is None:
+                with metrics.time_load('indexes', 'reload'):
+                    indices = utils.run_native(model.load_indexes, path)
+        validate_datasets(factors, indices, gics)
+        cache.swap_values(build_dataset_entries(path, factors, indices, gics))
+    except Exception:
+        logger.exception('unable to reload datasets refreshed by another worker')
+    finally:
+        _datasets['generation'] = generation
+
+
+@index_builder.before_app_request
+def check_datasets():
+    """
+    Starts reloading the datasets in the background when another worker has refreshed them.
+    """
+    generation = cache.DATASETS_GENERATION.get()
+    if _datasets['generation'] is None:
+        _datasets['generation'] = generation
+    if generation == _datasets['generation'] or (_datasets['reload'] is not None and _datasets['reload'].is_alive()):
+        return
+    # a thread is a greenlet under gevent, the loads themselves run on native threads
+    thread = _datasets['reload'] = threading.Thread(
+        target=reload_datasets, args=(app.config['DATA_PATH'], generation), name='datasets-reload'
+    )
+    thread.daemon = True
+    thread.start()
+
+
+@index_builder.route('/force-refresh')
+def refresh_cached_data():
+    """
+    Builds the new datasets off to the side & validates them before swapping them into the caches.  Requests
+    keep being served from the current data while this runs and those in-flight finish with the data they
+    started on, which is released once they're done.  The snapshot is written in the background after responding,
+    the other workers then load the new datasets from it (see :meth:`check_datasets`).
+    """
+    try:
+        path = app.config['DATA_PATH']
+        loaded_at = time.time()
+        factors, indices, gics = build_datasets(path)
+        validate_datasets(factors, indices, gics)
+        cache.swap_values(build_dataset_entries(path, factors, indices, gics))
+        thread = _datasets['snapshot'] = threading.Thread(
+            target=snapshot_datasets, args=(path, loaded_at, factors, indices, gics), name='datasets-snapshot'
+        )
+        thread.daemon = True
+        thread.start()
+        return jsonify(results=[], version=list(cache.dataset_version()))
+    except Exception as ex:
+        logger.info(ex)
+        return jsonify(dict(error=str(ex), traceback=str(traceback.format_exc())))
 
 
 @index_builder.route('/clear-cache')
@@ -53,11 +231,15 @@ def clear_cache():
     return jsonify(results=[])
 
 
-@cache.custom_memoize(cache.GICS_CACHE)
+def read_gics_mappings():
+    with open(GICS_MAPPINGS_FILE) as f:
+        return yaml.load(f, Loader=utils.YamlLoader)
+
+
+@cache.custom_memoize(cache.GICS_CACHE, single_flight=True, timeout=LOAD_TIMEOUT)
 def load_gics_mappings():
     logger.info('caching gics mappings...')
-    with open(os.path.join(os.path.dirname(__file__), 'data', 'gics_mappings.yaml')) as f:
-        return yaml.load(f)
+    return read_gics_mappings()
 
 
 @index_builder.route('/gics-mappings')
@@ -85,29 +267,53 @@ def system_uptime():
         return timedelta(seconds=uptime_seconds)
 
 
-def cache_info():
+def format_cache_key(key):
+    args = (key or [[]])[0] or []
+    return ', '.join(str(arg) for arg in (args if isinstance(args, tuple) else key) if arg is not None)
+
+
+def cache_info(deep=False):
+    """
+    Sizes & statistics of the in-memory caches.  Sizes are the estimates taken when each value was cached,
+    `deep` also recounts every value with :meth:`pympler.asizeof.asizeof` which can take seconds on large frames.
+    Values it can't size (e.g. arrays memory-mapped from the index store) fall back to :meth:`cache.estimate_size`
+    and record why under "deep_size_error".
+    """
 
     def _process_cache(c):
         items = []
-        for k in c._cache.keys():
-            expiration, insert_time, data = c._cache[k]
-            size = stringutils.pp(asizeof(data))
+        total_deep_size = 0
+        for k, (expiration, insert_time, data) in c._cache.items():
             item = {
-                'key': ', '.join(filter(None, (k or [[]])[0] or [])), 'expiration': expiration,
-                'saved': insert_time, 'size': size
+                'key': format_cache_key(k), 'expiration': expiration, 'saved': insert_time,
+                'size': stringutils.pp(c.size(k))
             }
+            if deep:
+                try:
+                    deep_size = asizeof(data)
+                    item['deep_size'] = stringutils.pp(deep_size)
+                except Exception as ex:
+                    deep_size = cache.estimate_size(data)
+                    item['deep_size'] = '{} (estimated)'.format(stringutils.pp(deep_size))
+                    item['deep_size_error'] = str(ex)
+                total_deep_size += deep_size
             items.append(item)
 
-        return {
-            'total_size': stringutils.pp(asizeof(c._cache)),
+        info = {
+            'total_size': stringutils.pp(c.total_bytes),
             'total_items': len(c._cache),
+            'stats': dict(c.stats, load_time='{:.3f}s'.format(c.stats['load_time'])),
             'items': items
         }
+        if deep:
+            info['total_deep_size'] = stringutils.pp(total_deep_size)
+        return info
 
     caches = [
         ('FACTOR_CACHE', cache.FACTOR_CACHE),
         ('INDEXES_CACHE', cache.INDEXES_CACHE),
         ('GICS_CACHE', cache.GICS_CACHE),
+        ('RESULTS_CACHE', cache.RESULTS_CACHE),
     ]
     caches = {name: _process_cache(c) for name, c in caches}
     return caches
@@ -123,36 +329,67 @@ def display_debug():
         r'commit <a href="https://github.com/aschonfeld/index_builder/commits/\1">\1</a>',
         commit_message)
 
-    caches = cache_info()
+    deep = utils.get_bool_arg(request, 'deep')
+    caches = cache_info(deep=deep)
     return render_template(
         'index_builder/debug.html',
         commit_message=commit_message,
         process_uptime=process_uptime(),
         system_uptime=system_uptime(),
+        process_memory={k: stringutils.pp(v) for k, v in utils.process_memory().items()},
         environ=os.environ,
         wsgi_settings=dict(request.environ),
         page='debug',
         caches=caches,
+        deep=deep,
+        profiler_settings=profiler.get_settings(),
+        profiles=profiler.list_profiles(),
         users=list(utils.get_all_user_factor_settings(locked=False, include_last_update=True))
     )
 
 
-@cache.custom_memoize(cache.FACTOR_CACHE)
+@index_builder.route('/profiler')
+@auth.requires_auth
+@auth.requires_admin
+def configure_profiler():
+    if utils.get_bool_arg(request, 'clear'):
+        profiler.clear()
+    settings = profiler.configure(
+        rate=utils.get_float_arg(request, 'rate'), endpoint=request.args.get('endpoint')
+    )
+    return jsonify(settings=settings, profiles=len(profiler.list_profiles()))
+
+
+@index_builder.route('/profiler/<int:profile_id>')
+@auth.requires_auth
+@auth.requires_admin
+def download_profile(profile_id):
+    profile = profiler.find_profile(profile_id)
+    if profile is None:
+        return jsonify(error='profile {} not found'.format(profile_id)), 404
+    response = app.response_class(profile['data'], mimetype='application/octet-stream')
+    response.headers['Content-Disposition'] = 'attachment; filename=profile_{}.prof'.format(profile_id)
+    return response
+
+
+@cache.custom_memoize(cache.FACTOR_CACHE, single_flight=True, timeout=LOAD_TIMEOUT)
 def load_factors(path):
     return model.load_factors(path)
 
 
 def get_factors():
-    return load_factors(app.config['DATA_PATH'])
+    with timing.span('get_factors'):
+        return load_factors(app.config['DATA_PATH'])
 
 
-@cache.custom_memoize(cache.INDEXES_CACHE)
+@cache.custom_memoize(cache.INDEXES_CACHE, single_flight=True, timeout=LOAD_TIMEOUT)
 def load_indexes(path):
     return model.load_indexes(path)
 
 
 def get_indexes():
-    return load_indexes(app.config['DATA_PATH'])
+    with timing.span('get_indexes'):
+        return load_indexes(app.config['DATA_PATH'])
 
 
 @index_builder.route('/factor-options')
@@ -254,20 +491,21 @@ def archive_user_settings():
 def find_sample_indexes():
     try:
         indices = get_indexes()
+        sample_indexes = model.find_sample_indexes(indices)
         samples = dict(
-            stats={k: v for k, v in indices['stats'].items() if k in model.SAMPLE_INDEXES},
+            stats={k: v for k, v in indices['stats'].items() if k in sample_indexes},
             returns=dict(excess={}, annualized={}),
             sectors={},
             barra={}
         )
         for ret_type in ['excess', 'annualized']:
-            for sample in model.SAMPLE_INDEXES:
+            for sample in sample_indexes:
                 sample_rets = indices['returns'][ret_type][sample]
                 sample_rets.name = 'val'
                 sample_rets.index.name = 'date'
                 samples['returns'][ret_type][sample] = sample_rets.reset_index().to_dict(orient='records')
 
-        for sample in model.SAMPLE_INDEXES:
+        for sample in sample_indexes:
             for key, df in {key: df for key, df in indices.items() if key in ['sectors', 'barra']}.items():
                 if sample in df.columns:
                     samples[key][sample] = {
@@ -275,7 +513,8 @@ def find_sample_indexes():
                         for k, g in df[['name', 'date', sample]].rename(columns={sample: 'val'}).groupby('name')
                     }
 
-        return jsonify(samples)
+        with timing.span('jsonify'):
+            return jsonify(samples)
     except Exception as ex:
         logger.info(ex)
         return jsonify(dict(error=str(ex), traceback=str(traceback.format_exc())))
@@ -289,29 +528,32 @@ def find_results_stats():
         is_admin = current_user == 'admin'
         indices = get_indexes()
         factors = get_factors()
-        user_settings = {
-            user: factor_settings
-            for user, factor_settings in utils.get_all_user_factor_settings(locked=False if is_admin else True, archive=archive)
-        }
+        with timing.span('user_settings'):
+            user_settings = {
+                user: factor_settings
+                for user, factor_settings in utils.get_all_user_factor_settings(
+                    locked=False if is_admin else True, archive=archive
+                )
+            }
         unlocked = [user for user, settings in user_settings.items() if not settings['locked']]
         user_settings = {user: settings.get('factors', {}) for user, settings in user_settings.items() if settings['locked']}
+        # results are memoized so they must not be modified in place
         user_results = {
-            user: dict(stats=model.load_results_stats(factors, indices, factor_settings))
-            for user, factor_settings in user_settings.items()
+            user: dict(stats=utils.dict_merge(stats, dict(unlockable=True)) if is_admin else stats)
+            for user, stats in model.load_all_results_stats(factors, indices, user_settings).items()
         }
-        for user, result in user_results.items():
-            if is_admin:
-                result['stats']['unlockable'] = True
 
+        sample_indexes = model.find_sample_indexes(indices)
         results = dict(
             users=user_results,
             samples=dict(
-                stats={k: v for k, v in indices['stats'].items() if k in model.SAMPLE_INDEXES},
+                stats={k: v for k, v in indices['stats'].items() if k in sample_indexes},
             ),
             unlocked=unlocked,
             archives=utils.find_available_archives() if is_admin else []
         )
-        return jsonify(results)
+        with timing.span('jsonify'):
+            return jsonify(results)
     except Exception as ex:
         logger.info(ex)
         return jsonify(dict(error=str(ex), traceback=str(traceback.format_exc())))
@@ -326,7 +568,8 @@ def find_user_results():
         factors = get_factors()
         factor_settings = utils.get_factor_settings(user, archive=archive)
         results = model.load_user_results(factors, indices, factor_settings.get('factors', {}))
-        return jsonify(results)
+        with timing.span('jsonify'):
+            return jsonify(results)
     except Exception as ex:
         logger.info(ex)
         return jsonify(dict(error=str(ex), traceback=str(traceback.format_exc())))
@@ -348,7 +591,8 @@ def find_cumulative_returns():
                 sample_rets.name = 'val'
                 sample_rets.index.name = 'date'
                 cum_returns[sample] = sample_rets.reset_index().to_dict(orient='records')
-        return jsonify(cum_returns)
+        with timing.span('jsonify'):
+            return jsonify(cum_returns)
     except Exception as ex:
         logger.info(ex)
         return jsonify(dict(error=str(ex), traceback=str(traceback.format_exc())))
@@ -361,43 +605,30 @@ def find_summary_data():
         archive = utils.get_str_arg(request, 'archive')
         current_user = session.get('username')
         is_admin = current_user == 'admin'
-        summary = {}
-        for factor_id, factor in factors.items():
-            summary[factor_id] = dict(
-                label=factor['label'],
-                selections=dict(HI=[], LO=[]),
-                avg=dict(HI=0, LO=0),
-                ethical_wt=dict(HI=0, LO=0),
-                reason_avg=dict(HI={}, LO={}),
-            )
-
-        users = list(utils.get_all_user_factors(archive=archive))
-        for user, factor_settings in users:
-            for factor_id, inputs in factor_settings.items():
-                summary[factor_id]['selections'][inputs['strength']].append(utils.dict_merge(inputs, dict(user=user)))
-        total_users = len(users)
-        for factor in summary.values():
-            for strength, selections in factor['selections'].items():
-                factor['avg'][strength] = (sum(map(itemgetter('weight'), selections)) * 1.0) / total_users
-                reason_avg = defaultdict(int)
-                total_reason_users = len(selections)
-                for s in selections:
-                    for r_id in s['reasons']:
-                        reason_avg[r_id] += 1
-                factor['reason_avg'][strength] = {
-                    r_id: ((total * 1.0) / total_reason_users) * 100
-                    for r_id, total in reason_avg.items()
-                }
-
-        return jsonify(dict(
-            data=summary,
-            archives=utils.find_available_archives() if is_admin else []
-        ))
+        with timing.span('summary'):
+            summary = utils.get_summary_aggregates().summarize(factors, archive=archive)
+
+        with timing.span('jsonify'):
+            return jsonify(dict(
+                data=summary,
+                archives=utils.find_available_archives() if is_admin else []
+            ))
     except Exception as ex:
         logger.info(ex)
         return jsonify(dict(error=str(ex), traceback=str(traceback.format_exc())))
 
 
+@index_builder.route('/check-summary')
+@auth.requires_auth
+@auth.requires_admin
+def check_summary():
+    """
+    Rebuilds the summary aggregates from scratch, reporting whether they had drifted from the users' settings.
+    """
+    archive = utils.get_str_arg(request, 'archive')
+    return jsonify(dict(consistent=utils.get_summary_aggregates().check(archive)))
+
+
 PREEXISTING_USER = (
     "You are re-opening a session for the user <strong>{}</strong>.<br/>"
     "If you haven't logged in before please logout and create a new username."
@@ -408,8 +639,7 @@ def load_page(page_name):
     prev_page = request.referrer
     warning = None
     if (prev_page or '').endswith('login'):
-        pre_existing_user = os.path.isfile(utils.build_factor_settings_file_path(session['username']))
-        if pre_existing_user:
+        if utils.user_exists(session['username']):
             warning = PREEXISTING_USER.format(session['username'])
     return render_template(
         'index_builder/{}.html'.format(page_name),
@@ -1,3 +1,8 @@
+import pytest
+import os
+import shutil
+import tempfile
+from contextlib import nested
 from mock import patch
 
 pytest_plugins = ['tests.fixtures']
@@ -9,6 +14,39 @@ pytest_plugins = ['tests.fixtures']
 patch('flask.session', {'logged_in': True, 'username': 'test'}).start()
 
 
+@pytest.fixture(autouse=True)
+def reset_user_store():
+    # user settings are snapshotted in memory so tests mocking the users' files need to start from scratch
+    import index_builder.utils as utils
+
+    utils.get_user_store().reset()
+    utils.get_summary_aggregates().reset()
+    yield
+    utils.get_user_store().reset()
+    utils.get_summary_aggregates().reset()
+
+
+@pytest.fixture()
+def data_path():
+    """
+    Temporary data path, removed afterwards.  The users' settings (YAML folder & SQLite database) are kept under
+    it too so tests never touch the application's users.
+    """
+    import index_builder.utils as utils
+
+    path = tempfile.mkdtemp()
+    try:
+        with nested(
+            patch('index_builder.utils.DATA_PATH', path),
+            patch('index_builder.utils.USERS_PATH', os.path.join(path, 'users')),
+            patch('index_builder.utils.USER_DB_FNAME', os.path.join(path, 'users.db')),
+        ):
+            utils.mkdir_p(utils.build_users_path())
+            yield path
+    finally:
+        shutil.rmtree(path)
+
+
 def pytest_configure(config):
     import sys
     sys._called_from_test = True
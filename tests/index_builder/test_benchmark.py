@@ -0,0 +1,66 @@
+import pytest
+import os
+import shutil
+import tempfile
+import mock
+from contextlib import nested
+
+import index_builder.benchmark as benchmark
+import index_builder.cache as cache
+import index_builder.users as users
+import index_builder.utils as utils
+
+
+@pytest.mark.unit
+def test_compare():
+    baseline = [
+        dict(case='a', users=1, factors=1, days=1, median=1.0),
+        dict(case='b', users=1, factors=1, days=1, median=1.0),
+        dict(case='c', users=1, factors=1, days=1, median=0),
+    ]
+    results = [
+        dict(case='a', users=1, factors=1, days=1, median=1.1),
+        dict(case='b', users=1, factors=1, days=1, median=1.5),
+        dict(case='c', users=1, factors=1, days=1, median=1.5),
+        dict(case='d', users=1, factors=1, days=1, median=1.5),
+    ]
+    regressions = benchmark.compare(results, baseline, threshold=0.2)
+    assert [r['case'] for r in regressions] == ['b']
+    assert regressions[0]['baseline'] == 1.0
+    assert regressions[0]['ratio'] == 1.5
+
+
+@pytest.mark.unit
+def test_reset_state():
+    store, aggregates = mock.Mock(), mock.Mock()
+    with nested(
+        mock.patch('index_builder.utils.get_user_store', mock.Mock(return_value=store)),
+        mock.patch('index_builder.utils.get_summary_aggregates', mock.Mock(return_value=aggregates)),
+        mock.patch('index_builder.cache.RESULTS_CACHE', mock.Mock()),
+    ):
+        benchmark.reset_state()
+        cache.RESULTS_CACHE.clear.assert_called_once_with()
+    store.reset.assert_called_once_with()
+    aggregates.reset.assert_called_once_with()
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('backend', users.BACKENDS)
+def test_main(unittest, backend):
+    path = tempfile.mkdtemp()
+    store = utils.get_user_store()
+    try:
+        fname = os.path.join(path, 'baseline.json')
+        args = ['--users', '3', '--factors', '4', '--days', '300', '--repeat', '1']
+        with mock.patch('index_builder.utils.USER_STORE_BACKEND', backend):
+            assert benchmark.main(args + ['--save', fname]) == 0
+        results = benchmark.load_results(fname)
+        unittest.assertEquals(sorted(r['case'] for r in results), sorted([
+            'load_all_results_stats', 'load_results_stats', 'load_user_results', 'load_cumulative_returns',
+            'user_settings_scan', 'find_results_stats', 'find_summary_data', 'find_sample_indexes'
+        ]))
+        assert benchmark.main(args + ['--compare', fname, '--threshold', '1000']) == 0
+        assert utils.get_user_store() is not store and utils.get_user_store().__class__ is store.__class__, \
+            'should go back to the configured store'
+    finally:
+        shutil.rmtree(path)
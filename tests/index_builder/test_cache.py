@@ -5,6 +5,12 @@ from collections import namedtuple
 from decorator import decorator
 from dateutil import rrule
 import datetime as dt
+import os
+import sys
+import numpy as np
+import pandas as pd
+import threading
+import time
 
 import index_builder.cache as cache
 
@@ -110,3 +116,296 @@ def test_expiry_cache(unittest):
     assert len(ec) == 0
 
 
+@pytest.mark.unit
+def test_settings_hash():
+    assert cache.settings_hash(dict(a=1, b=dict(c=[1, 2]))) == cache.settings_hash(dict(b=dict(c=[1, 2]), a=1))
+    assert cache.settings_hash(dict(a=1)) != cache.settings_hash(dict(a=2))
+
+
+@pytest.mark.unit
+def test_custom_memoize_dict_args():
+    calls = []
+
+    @cache.custom_memoize(cache.ExpiryCache(cache.PROD_SCHEDULE))
+    def load(settings, extra=None):
+        calls.append(settings)
+        return len(calls)
+
+    assert load(dict(a=1, b=2)) == 1
+    assert load(dict(b=2, a=1)) == 1
+    assert load(dict(a=1), extra=dict(b=2)) == 2
+    assert load(dict(a=1), extra=dict(b=2)) == 2
+    assert len(calls) == 2
+
+
+@pytest.mark.unit
+def test_results_memoize():
+    results_cache = cache.ExpiryCache(cache.PROD_SCHEDULE, max_entries=2)
+    calls = []
+
+    @cache.results_memoize(results_cache)
+    def load_results(factors, indices, factor_settings):
+        calls.append(factor_settings)
+        return len(calls)
+
+    factors, indices = {}, {}
+    assert load_results(factors, indices, dict(factor_1=dict(weight=100))) == 1
+    assert load_results(factors, indices, dict(factor_1=dict(weight=100))) == 1
+    assert load_results(factors, indices, dict(factor_2=dict(weight=100))) == 2
+    assert load_results(factors, {}, dict(factor_2=dict(weight=100))) == 3, 'should key on the dataset'
+    assert len(results_cache) == 2
+    assert load_results(factors, indices, dict(factor_1=dict(weight=100))) == 4, 'should evict least recently used'
+
+    with mock.patch('index_builder.cache.dataset_version', mock.Mock(return_value=(-1, -1))):
+        assert load_results(factors, indices, dict(factor_1=dict(weight=100))) == 5, 'should key on dataset version'
+
+
+@pytest.mark.unit
+def test_expiry_cache_dependents():
+    results_cache = cache.ExpiryCache(cache.PROD_SCHEDULE)
+    data_cache = cache.ExpiryCache(cache.PROD_SCHEDULE, dependents=[results_cache])
+    results_cache['test'] = 'result'
+    version = data_cache.version
+    data_cache['test'] = 'data'
+    assert data_cache.version > version
+    assert not len(results_cache), 'should clear dependent caches when data changes'
+
+
+@pytest.mark.unit
+def test_expiry_cache_max_entries():
+    ec = cache.ExpiryCache(cache.PROD_SCHEDULE, max_entries=2)
+    ec['a'] = 1
+    ec['b'] = 2
+    ec['a']
+    ec['c'] = 3
+    assert sorted(ec._cache.keys()) == ['a', 'c']
+    assert ec.stats == dict(hits=1, misses=0, evictions=1, loads=0, load_time=0.0)
+
+    with pytest.raises(KeyError):
+        ec['b']
+    assert ec.stats['misses'] == 1
+    ec.reset_stats()
+    assert ec.stats == dict(hits=0, misses=0, evictions=0, loads=0, load_time=0.0)
+
+
+@pytest.mark.unit
+def test_estimate_size():
+    values = np.zeros((100, 10))
+    assert cache.estimate_size(values) == 8000
+    df = pd.DataFrame(values)
+    assert cache.estimate_size(df) >= 8000
+    assert cache.estimate_size(dict(a=values, b=[values, df])) > 16000
+
+    records = [dict(a=1, b='test')] * 1000
+    assert cache.estimate_size(records) == sys.getsizeof(records) + 1000 * cache.estimate_size(records[0])
+
+
+@pytest.mark.unit
+def test_expiry_cache_max_bytes():
+    ec = cache.ExpiryCache(cache.PROD_SCHEDULE, max_bytes=20000)
+    ec['a'] = np.zeros(1000)
+    ec['b'] = np.zeros(1000)
+    assert ec.total_bytes == 16000
+    ec['a']
+    ec['c'] = np.zeros(1000)
+    assert sorted(ec._cache.keys()) == ['a', 'c'], 'should evict the least recently used entry'
+    assert ec.total_bytes == 16000
+    assert ec.stats['evictions'] == 1
+
+    ec['d'] = np.zeros(5000)
+    assert list(ec._cache.keys()) == ['d'], 'should keep the latest entry even if it is over the limit'
+    assert ec.size('d') == ec.total_bytes == 40000
+    del ec['d']
+    assert ec.total_bytes == 0
+
+
+@pytest.mark.unit
+def test_load_stats():
+    ec = cache.ExpiryCache(cache.PROD_SCHEDULE)
+
+    @cache.custom_memoize(ec)
+    def load(path):
+        time.sleep(0.01)
+        return path
+
+    load('a')
+    load('a')
+    load('b')
+    assert ec.stats['loads'] == 2
+    assert ec.stats['load_time'] >= 0.02
+    assert ec.stats['hits'] == 1
+
+
+def _run_concurrently(func, count=5):
+    results = []
+
+    def _call():
+        try:
+            results.append(func())
+        except Exception as ex:
+            results.append(ex)
+
+    threads = [threading.Thread(target=_call) for _ in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+@pytest.mark.unit
+def test_custom_memoize_single_flight():
+    calls = []
+
+    @cache.custom_memoize(cache.ExpiryCache(cache.PROD_SCHEDULE), single_flight=True)
+    def load(path):
+        calls.append(path)
+        time.sleep(0.2)
+        return dict(path=path)
+
+    results = _run_concurrently(lambda: load('path'))
+    assert calls == ['path'], 'should only compute the value once'
+    assert all(r is results[0] for r in results)
+    assert not cache._flights
+
+    @cache.custom_memoize(cache.ExpiryCache(cache.PROD_SCHEDULE), single_flight=True)
+    def load_error(path):
+        calls.append(path)
+        time.sleep(0.2)
+        raise ValueError('bad data')
+
+    calls[:] = []
+    results = _run_concurrently(lambda: load_error('path'))
+    assert calls == ['path']
+    assert all(isinstance(r, ValueError) and str(r) == 'bad data' for r in results), \
+        'should propagate the error to every caller'
+    assert not len(load_error._cache), 'should not cache errors'
+
+    @cache.custom_memoize(cache.ExpiryCache(cache.PROD_SCHEDULE), single_flight=True, timeout=0.05)
+    def load_slow(path):
+        time.sleep(0.3)
+        return path
+
+    results = _run_concurrently(lambda: load_slow('path'), count=3)
+    assert results.count('path') == 1
+    assert sum(isinstance(r, cache.SingleFlightTimeout) for r in results) == 2
+    assert load_slow('path') == 'path'
+
+
+def _expire(ec, key, ago):
+    _, insert_time, value = ec._cache[key]
+    ec._cache[key] = dt.datetime.now() - ago, insert_time, value
+
+
+@pytest.mark.unit
+def test_expiry_cache_stale_while_revalidate():
+    ec = cache.ExpiryCache(cache.PROD_SCHEDULE, stale_while_revalidate=True, max_stale=dt.timedelta(hours=1))
+    ec['a'] = 1
+    assert not ec.is_stale('a')
+    _expire(ec, 'a', dt.timedelta(minutes=5))
+    assert ec['a'] == 1, 'should serve stale values'
+    assert ec.is_stale('a')
+    _expire(ec, 'a', dt.timedelta(hours=2))
+    with pytest.raises(KeyError):
+        ec['a']
+
+    calls = []
+    started, finish = threading.Event(), threading.Event()
+
+    @cache.custom_memoize(ec)
+    def load(path):
+        calls.append(path)
+        if len(calls) > 1:
+            started.set()
+            finish.wait(5)
+        return len(calls)
+
+    assert load('path') == 1
+    _expire(ec, cache.create_memory_cache_key(['path']), dt.timedelta(minutes=5))
+    assert load('path') == 1, 'should serve the stale value while it is rebuilt'
+    started.wait(5)
+    assert load('path') == 1
+    assert len(cache._refreshes) == 1, 'should only rebuild once'
+    refresh = list(cache._refreshes.values())[0]
+    finish.set()
+    refresh.join(5)
+    assert load('path') == 2, 'should swap in the rebuilt value'
+    assert calls == ['path', 'path']
+
+
+@pytest.mark.unit
+def test_revalidate_on_native_threads():
+    from multiprocessing.pool import ThreadPool
+
+    ec = cache.ExpiryCache(cache.PROD_SCHEDULE, stale_while_revalidate=True)
+    threads = []
+
+    @cache.custom_memoize(ec)
+    def load(path):
+        threads.append(threading.current_thread().name)
+        return len(threads)
+
+    assert load('path') == 1
+    _expire(ec, cache.create_memory_cache_key(['path']), dt.timedelta(minutes=5))
+    pool = ThreadPool(1)
+    try:
+        # stand-in for gevent's pool of native threads in a monkey-patched worker
+        with mock.patch('index_builder.utils._native_threadpool', mock.Mock(return_value=pool)):
+            assert load('path') == 1
+            refresh = list(cache._refreshes.values())[0]
+            refresh.join(5)
+    finally:
+        pool.close()
+        pool.join()
+    assert load('path') == 2
+    assert threads[1] not in (threads[0], refresh.name), 'should rebuild on the native threadpool'
+
+
+def _generation_worker(fname, ready, refreshed, results):
+    generations = cache.SharedGenerations(['TEST_CACHE'], fname)
+    ec = cache.ExpiryCache(cache.PROD_SCHEDULE, generation=generations.slot('TEST_CACHE'))
+    ec['data'] = 'old'
+    ready.set()
+    refreshed.wait(5)
+    try:
+        results.put(ec['data'])
+    except KeyError:
+        results.put('cleared')
+
+
+@pytest.mark.unit
+def test_shared_generations():
+    import multiprocessing
+    import shutil
+    import tempfile
+
+    path = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(path, 'cache_generations')
+        refreshed, results = multiprocessing.Event(), multiprocessing.Queue()
+        workers = []
+        for _ in range(3):
+            ready = multiprocessing.Event()
+            worker = multiprocessing.Process(target=_generation_worker, args=(fname, ready, refreshed, results))
+            worker.start()
+            assert ready.wait(5)
+            workers.append(worker)
+
+        generations = cache.SharedGenerations(['TEST_CACHE'])
+        assert generations.get('TEST_CACHE') == 0, 'should not share generations until given a file'
+        generations.init(fname)
+        ec = cache.ExpiryCache(cache.PROD_SCHEDULE, generation=generations.slot('TEST_CACHE'))
+        ec['data'] = 'old'
+        ec.invalidate()
+        assert not len(ec)
+        assert generations.get('TEST_CACHE') == 1
+        ec['data'] = 'new'
+        assert ec['data'] == 'new', 'should not clear entries added after its own invalidation'
+
+        refreshed.set()
+        assert sorted(results.get(timeout=5) for _ in workers) == ['cleared'] * 3, \
+            'should clear the cache in every worker'
+        for worker in workers:
+            worker.join(5)
+    finally:
+        shutil.rmtree(path)
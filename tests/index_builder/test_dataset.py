@@ -0,0 +1,61 @@
+import pytest
+import os
+import mock
+
+import index_builder.dataset as dataset
+import index_builder.model as model
+import index_builder.utils as utils
+
+
+@pytest.mark.unit
+def test_build_user_settings(unittest):
+    factor_ids = model.build_factor_ids(10)
+    user_settings = dataset.build_user_settings(factor_ids, 20, seed=1)
+    assert len(user_settings) == 20
+    for settings in user_settings.values():
+        assert 1 <= len(settings['factors']) <= 5
+        assert sum(s['weight'] for s in settings['factors'].values()) == 100
+        for factor_id, s in settings['factors'].items():
+            assert factor_id in factor_ids
+            assert len(s['reasons']) and all(r in dataset.REASONS[s['strength']] for r in s['reasons'])
+    unittest.assertEquals(user_settings, dataset.build_user_settings(factor_ids, 20, seed=1))
+
+
+@pytest.mark.unit
+def test_write_dataset(unittest, data_path):
+    users_path = os.path.join(data_path, 'users')
+    dataset.main([
+        '--path', data_path, '--factors', '20', '--samples', '6', '--days', '600', '--users', '15',
+        '--users-path', users_path, '--seed', '1'
+    ])
+    factors = model.load_factors(data_path)
+    assert len(factors) == 20
+    indexes = model.load_indexes(data_path)
+    assert len(indexes['returns']['daily']) == 600
+    assert len(model.find_sample_indexes(indexes)) == 7
+    assert len(os.listdir(users_path)) == 15
+    settings = utils.load_yaml(os.path.join(users_path, 'user_1.yaml'))
+    assert sum(s['weight'] for s in settings['factors'].values()) == 100
+
+    user_settings = {
+        user: utils.load_yaml(os.path.join(users_path, '{}.yaml'.format(user)))['factors']
+        for user in ['user_{}'.format(i) for i in range(1, 16)]
+    }
+    results = model.load_all_results_stats(factors, indexes, user_settings)
+    assert all(len(stats) for stats in results.values())
+
+    with mock.patch('index_builder.dataset.write_user_settings') as write_user_settings:
+        dataset.write_dataset(data_path, factor_count=2, sample_count=1, days=600, user_count=1)
+        assert write_user_settings.call_args[0][1].users_path == users_path, \
+            'should not write to the application\'s users'
+
+    sqlite_path = os.path.join(data_path, 'sqlite')
+    with mock.patch('index_builder.utils.USER_STORE_BACKEND', 'sqlite'):
+        dataset.write_dataset(sqlite_path, factor_count=2, sample_count=1, days=600, user_count=3, seed=1)
+        store = dataset.build_user_store(sqlite_path)
+    assert store.fname == os.path.join(sqlite_path, 'users.db')
+    assert [u for u, _, _ in store.get_all()] == ['user_1', 'user_2', 'user_3'], 'should save users to the store'
+
+    with mock.patch('sys.stderr'):
+        with pytest.raises(SystemExit):
+            dataset.main(['--path', ''])
@@ -0,0 +1,53 @@
+import pytest
+import imp
+import os
+import shutil
+import tempfile
+import mock
+
+import index_builder
+
+CONFIG_FNAME = os.path.join(os.path.dirname(index_builder.__file__), 'gunicorn_config.py')
+
+
+def load_config(**environ):
+    environ.setdefault('METRICS_DIR', '/tmp/metrics')
+    with mock.patch.dict(os.environ, environ):
+        os.environ.pop('CREATED_METRICS_DIR', None)
+        return imp.load_source('gunicorn_config', CONFIG_FNAME)
+
+
+@pytest.mark.unit
+def test_preload_monkey_patches():
+    monkey = mock.Mock()
+    with mock.patch.dict('sys.modules', {'gevent': mock.Mock(monkey=monkey), 'gevent.monkey': monkey}):
+        assert not load_config(PRELOAD_APP='false').preload_app
+        assert not monkey.patch_all.called, 'gevent workers patch themselves when the app is not preloaded'
+
+        assert load_config(PRELOAD_APP='true').preload_app
+        assert monkey.patch_all.called, 'should patch before the preloaded app creates its thread locals'
+
+
+@pytest.mark.unit
+def test_on_exit_removes_created_metrics_dir():
+    with mock.patch.dict(os.environ, {}):
+        os.environ.pop('METRICS_DIR', None)
+        os.environ.pop('CREATED_METRICS_DIR', None)
+        config = imp.load_source('gunicorn_config', CONFIG_FNAME)
+        path = os.environ['METRICS_DIR']
+        assert os.path.isdir(path)
+
+        config = imp.load_source('gunicorn_config', CONFIG_FNAME)
+        assert os.environ['METRICS_DIR'] == path, 'reloading the config should keep the same folder'
+        config.on_exit(mock.Mock(reexec_pid=1234))
+        assert os.path.isdir(path), 'should be left for the re-executed master'
+        config.on_exit(mock.Mock(reexec_pid=0))
+        assert not os.path.exists(path)
+
+    path = tempfile.mkdtemp()
+    try:
+        with mock.patch.dict(os.environ, dict(METRICS_DIR=path)):
+            load_config(METRICS_DIR=path).on_exit(mock.Mock(reexec_pid=0))
+        assert os.path.isdir(path), 'should not remove a folder that was passed in'
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,114 @@
+import pytest
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import mock
+
+import index_builder.metrics as metrics
+import index_builder.views as views
+from index_builder.server import app
+
+
+@pytest.fixture()
+def metrics_dir():
+    path = tempfile.mkdtemp()
+    metrics.reset()
+    with mock.patch.dict(os.environ, {'METRICS_DIR': path}):
+        yield path
+    metrics.reset()
+    shutil.rmtree(path)
+
+
+@pytest.mark.unit
+def test_render():
+    metrics.reset()
+    metrics.inc('index_builder_requests_total', route='/test', method='GET', status='200')
+    metrics.inc('index_builder_requests_total', route='/test', method='GET', status='200')
+    metrics.observe('index_builder_request_duration_seconds', 0.02, route='/test')
+    metrics.observe('index_builder_request_duration_seconds', 20, route='/test')
+    output = metrics.render(metrics.merge([metrics.snapshot()]))
+    metrics.reset()
+
+    assert '# TYPE index_builder_requests_total counter' in output
+    assert 'index_builder_requests_total{method="GET",route="/test",status="200"} 2' in output
+    assert 'index_builder_request_duration_seconds_bucket{route="/test",le="0.01"} 0' in output
+    assert 'index_builder_request_duration_seconds_bucket{route="/test",le="0.025"} 1' in output
+    assert 'index_builder_request_duration_seconds_bucket{route="/test",le="10"} 1' in output
+    assert 'index_builder_request_duration_seconds_bucket{route="/test",le="+Inf"} 2' in output
+    assert 'index_builder_request_duration_seconds_sum{route="/test"} 20.02' in output
+    assert 'index_builder_request_duration_seconds_count{route="/test"} 2' in output
+    assert 'index_builder_cache_hits_total{cache="FACTOR_CACHE"} 0' in output
+
+
+@pytest.mark.unit
+def test_aggregation(metrics_dir):
+    other_worker = dict(
+        index_builder_requests_total=[[[['method', 'GET'], ['route', '/test'], ['status', '200']], 3]],
+        index_builder_worker_rss_bytes=[[[['pid', '1']], 100]],
+    )
+    with open(os.path.join(metrics_dir, 'worker_1.json'), 'w') as f:
+        json.dump(other_worker, f)
+    metrics.inc('index_builder_requests_total', route='/test', method='GET', status='200')
+
+    merged = metrics.collect()
+    assert merged['index_builder_requests_total'][(('method', 'GET'), ('route', '/test'), ('status', '200'))] == 4
+    assert len(merged['index_builder_worker_rss_bytes']) == 2, 'should report memory for each worker'
+    assert os.path.isfile(os.path.join(metrics_dir, 'worker_{}.json'.format(os.getpid())))
+
+    metrics.retire_worker(1)
+    assert not os.path.isfile(os.path.join(metrics_dir, 'worker_1.json'))
+    merged = metrics.collect()
+    assert merged['index_builder_requests_total'][(('method', 'GET'), ('route', '/test'), ('status', '200'))] == 4, \
+        'should keep counts from retired workers'
+    assert len(merged['index_builder_worker_rss_bytes']) == 1, 'should drop memory of retired workers'
+
+
+@pytest.mark.unit
+def test_start_flusher(metrics_dir):
+    fname = os.path.join(metrics_dir, 'worker_{}.json'.format(os.getpid()))
+    metrics.start_flusher(interval=0.01)
+    try:
+        metrics.start_flusher(interval=0.01)
+        assert len([t for t in threading.enumerate() if t.name == 'metrics-flusher']) == 1, \
+            'should only start one flusher per process'
+        metrics.inc('index_builder_requests_total', route='/test', method='GET', status='200')
+        for _ in range(100):
+            if 'index_builder_requests_total' in metrics._read(fname):
+                break
+            time.sleep(0.01)
+        assert 'index_builder_requests_total' in metrics._read(fname), 'should flush without further requests'
+    finally:
+        metrics.stop_flusher()
+    assert not [t for t in threading.enumerate() if t.name == 'metrics-flusher']
+
+
+@pytest.mark.unit
+def test_metrics_endpoint(metrics_dir):
+    with app.test_client() as c:
+        c.get('/index-builder/factor-options')
+        c.get('/index-builder/gics-mappings')
+        c.get('/index-builder/gics-mappings')
+        response = c.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    output = response.data
+    assert 'index_builder_requests_total{method="GET",route="/index-builder/gics-mappings",status="200"} 2' in output
+    assert 'index_builder_response_size_bytes_count{route="/index-builder/factor-options"} 1' in output
+    assert 'index_builder_cache_hits_total{cache="GICS_CACHE"}' in output
+    assert 'index_builder_worker_rss_bytes{{pid="{}"}}'.format(os.getpid()) in output
+
+
+@pytest.mark.unit
+def test_time_load(metrics_dir):
+    with mock.patch('index_builder.views.read_gics_mappings'), mock.patch('index_builder.views.model.load_factors'), \
+            mock.patch('index_builder.views.model.load_indexes'), mock.patch('index_builder.views.validate_datasets'), \
+            mock.patch('index_builder.views.cache.swap_values'), mock.patch('index_builder.views.save_snapshot'):
+        app.test_client().get('/index-builder/force-refresh')
+        views._datasets['snapshot'].join(5)
+    merged = metrics.collect()
+    assert sorted(dict(k)['dataset'] for k in merged['index_builder_data_load_seconds']) == [
+        'factors', 'gics', 'indexes'
+    ]
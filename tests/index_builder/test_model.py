@@ -2,6 +2,7 @@ import pytest
 import os
 import mock
 import pandas as pd
+import numpy as np
 
 import index_builder.model as model
 
@@ -19,7 +20,12 @@ def test_load_indexes(unittest):
 
     path = os.path.join(__file__, '..', 'index_builder/data')
     indexes = model.load_indexes(path)
-    assert len(indexes) == 4
+    assert len(indexes) == 5
+
+    daily = indexes['returns']['daily']
+    covariance = indexes['returns']['covariance']
+    assert 'index' in covariance.columns
+    np.testing.assert_array_almost_equal(covariance.values, daily.cov().values)
 
 
 @pytest.mark.unit
@@ -39,10 +45,114 @@ def test_load_results_stats(unittest):
         assert model.load_results_stats(None, None, {'factor_1': {'weight': 50}}) == {}
 
 
+@pytest.mark.unit
+def test_load_user_results(unittest):
+    path = os.path.join(__file__, '..', 'index_builder/data')
+    factors = model.load_factors(path)
+    indices = model.load_indexes(path)
+    factor_settings = dict(
+        factor_1=dict(strength='HI', weight=40),
+        factor_2=dict(strength='LO', weight=60),
+    )
+    results = model.load_user_results(factors, indices, factor_settings)
+    for key in ['sectors', 'barra']:
+        expected = pd.concat(
+            model.load_weighted_values(factors, indices[key].set_index(['date', 'name']), factor_settings), axis=1
+        ).sum(axis=1)
+        unittest.assertEquals(sorted(results[key]), sorted(expected.index.levels[1]))
+        for name, records in results[key].items():
+            expected_vals = expected.xs(name, level='name')
+            unittest.assertEquals([r['date'] for r in records], list(expected_vals.index))
+            np.testing.assert_array_almost_equal([r['val'] for r in records], expected_vals.values)
+
+    results = model.load_user_results(factors, indices, {})
+    assert 'sectors' not in results and 'barra' not in results
+
+
 def test_load_cumulative_returns(unittest):
     with mock.patch('index_builder.model.build_index_id', mock.Mock(return_value=None)):
         assert model.load_cumulative_returns(
             None,
             {'returns': {'cumulative': None}},
             {'factor_1': {'weight': 50}}
-        ) == []
\ No newline at end of file
+        ) == []
+
+
+@pytest.mark.unit
+def test_load_all_results_stats(unittest):
+    path = os.path.join(__file__, '..', 'index_builder/data')
+    factors = model.load_factors(path)
+    indices = model.load_indexes(path)
+    user_settings = {
+        'user_1': dict(
+            factor_1=dict(strength='HI', weight=40),
+            factor_2=dict(strength='LO', weight=60),
+        ),
+        'user_2': dict(factor_3=dict(strength='HI', weight=100)),
+        'user_3': {},
+    }
+    results = model.load_all_results_stats(factors, indices, user_settings)
+    assert results['user_3'] == {}
+
+    daily = indices['returns']['daily']
+    annualization_factor = np.sqrt(252) / 100
+    for user in ['user_1', 'user_2']:
+        stats = results[user]
+        daily_returns = pd.concat(
+            model.load_weighted_values(factors, daily, user_settings[user]), axis=1
+        ).sum(axis=1)
+        np.testing.assert_almost_equal(stats['volatility'], daily_returns.std() * annualization_factor)
+        np.testing.assert_almost_equal(
+            stats['tracking error'], (daily_returns - daily['index']).std() * annualization_factor
+        )
+        np.testing.assert_almost_equal(stats['ir'], stats['excess over index (annualized)'] / stats['tracking error'])
+        single_stats = model.load_results_stats(factors, indices, user_settings[user])
+        unittest.assertEquals(sorted(stats), sorted(single_stats))
+        for k, v in stats.items():
+            np.testing.assert_almost_equal(v, single_stats[k])
+
+    expected_rating = factors['factor_1']['rating'] * 0.4
+    np.testing.assert_almost_equal(results['user_1']['rating'], expected_rating)
+    expected_annualized = sum(
+        indices['stats']['{}_{}'.format(factors[f_id]['index_name'], s['strength'].lower())]['annualized'] * s['weight']
+        for f_id, s in user_settings['user_1'].items()
+    ) / 100.0
+    np.testing.assert_almost_equal(results['user_1']['annualized'], expected_annualized)
+
+
+@pytest.mark.unit
+def test_build_factors(unittest):
+    factors = model.build_factors(factor_count=5, start='20100101', end='20101231', seed=1)
+    assert len(factors) == 5
+    returns = factors['factor_5']['returns']['totret_mtd_usd_mean_cumulative']
+    assert sorted(returns) == sorted(factors['factor_5']['scores'])
+    assert all(len(rets) == 13 for rets in returns.values())
+    assert all(rets[0]['val'] == 0 for rets in returns.values())
+    unittest.assertEquals(factors, model.build_factors(factor_count=5, start='20100101', end='20101231', seed=1))
+
+
+@pytest.mark.unit
+def test_build_indexes(unittest):
+    indexes = model.build_indexes(factor_count=5, sample_count=2, start='20100101', end='20111231', seed=1)
+    index_ids = model.build_index_ids(5, 2)
+    assert len(index_ids) == 13
+    daily = indexes['returns']['daily']
+    cumulative = indexes['returns']['cumulative']
+    unittest.assertEquals(sorted(daily.columns), sorted(index_ids))
+    assert len(daily) == len(pd.bdate_range('20100101', '20111231'))
+    assert len(indexes['returns']['annualized']) == 2
+    np.testing.assert_array_almost_equal(cumulative.values[1:], 1 + daily.values[:-1].cumsum(axis=0))
+    assert (cumulative.values[0] == 1).all()
+    unittest.assertEquals(sorted(indexes['stats']), sorted(index_ids))
+
+    same_seed = model.build_indexes(factor_count=5, sample_count=2, start='20100101', end='20111231', seed=1)
+    pd.util.testing.assert_frame_equal(daily, same_seed['returns']['daily'])
+    pd.util.testing.assert_frame_equal(indexes['barra'], same_seed['barra'])
+
+    # the frames & tensors read on every request are single float blocks so preloaded pages stay shared
+    for name, df in indexes['returns'].items():
+        assert len(df._data.blocks) == 1, '{} returns should be stored as one block'.format(name)
+        assert df.values.dtype == np.float64
+    for name, tensor in indexes['exposures'].items():
+        assert tensor['values'].dtype == np.float64 and tensor['values'].flags['C_CONTIGUOUS'], \
+            '{} exposures should be one contiguous array'.format(name)
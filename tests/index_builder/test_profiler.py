@@ -0,0 +1,114 @@
+import pytest
+import json
+import marshal
+import os
+import shutil
+import tempfile
+import mock
+
+import index_builder.profiler as profiler
+from index_builder.server import app
+from tests.testing_tools import MockDict
+
+ADMIN_SESSION = MockDict(dict(logged_in=True, username='admin'))
+
+
+@pytest.fixture()
+def clean_profiler():
+    path = tempfile.mkdtemp()
+    original_path = profiler._state['path']
+    profiler.init(os.path.join(path, 'profiler'))
+    yield path
+    profiler.init(original_path)
+    shutil.rmtree(path)
+
+
+@pytest.mark.unit
+def test_should_profile(clean_profiler):
+    assert not profiler.should_profile('index_builder.find_factor_options', '/index-builder/factor-options')
+
+    profiler.configure(endpoint='find_factor_options')
+    assert profiler.should_profile('index_builder.find_factor_options', '/index-builder/factor-options')
+    assert not profiler.should_profile('index_builder.find_factor_data', '/index-builder/factor-data')
+
+    profiler.configure(endpoint='/index-builder/factor-data')
+    assert profiler.should_profile('index_builder.find_factor_data', '/index-builder/factor-data')
+
+    assert profiler.configure(rate=5, endpoint='') == dict(rate=1.0, endpoint=None)
+    assert profiler.should_profile('index_builder.find_factor_data', '/index-builder/factor-data')
+
+
+@pytest.mark.unit
+def test_ring_buffer(clean_profiler):
+    assert profiler.stop('test', '/test') is None, 'should not save anything when nothing is being profiled'
+    for _ in range(profiler.MAX_PROFILES + 5):
+        assert profiler.start()
+        assert not profiler.start(), 'should only profile one request at a time'
+        sorted(range(1000))
+        profile = profiler.stop('test', '/test')
+    profiles = profiler.list_profiles()
+    assert len(profiles) == profiler.MAX_PROFILES
+    assert profiles[0] == profile, 'should list the newest profiles first'
+    saved = profiler.find_profile(profile['id'])
+    assert saved['top_functions'] == profile['top_functions']
+    assert profiler.find_profile(1) is None
+    assert len(profile['top_functions']) <= profiler.TOP_FUNCTIONS
+    assert any('sorted' in row['function'] for row in profile['top_functions'])
+    assert isinstance(marshal.loads(saved['data']), dict)
+
+
+@pytest.mark.unit
+def test_shared_across_workers(clean_profiler):
+    profiler.configure(rate=0.5, endpoint='find_factor_options')
+    assert profiler.start()
+    profile = profiler.stop('test', '/test')
+
+    # another worker sharing the same data path
+    with mock.patch.dict(profiler._state, dict(settings=dict(profiler.DEFAULT_SETTINGS), mtime=None)):
+        assert profiler.get_settings() == dict(rate=0.5, endpoint='find_factor_options')
+        assert [p['id'] for p in profiler.list_profiles()] == [profile['id']]
+        profiler.clear()
+    assert profiler.list_profiles() == []
+
+
+@pytest.mark.unit
+def test_stopped_when_view_raises(clean_profiler):
+    profiler.configure(endpoint='find_factor_options')
+    with mock.patch('index_builder.views.get_factors', mock.Mock(side_effect=Exception('failed'))):
+        with app.test_client() as c:
+            c.get('/index-builder/factor-options')
+    assert not profiler.is_active(), 'should stop profiling requests which raise'
+    assert [p['path'] for p in profiler.list_profiles()] == ['/index-builder/factor-options']
+
+
+@pytest.mark.unit
+def test_profiled_requests(clean_profiler):
+    with app.test_client() as c:
+        response = c.get('/index-builder/profiler', query_string=dict(endpoint='find_factor_options'))
+        assert response.status_code == 302, 'should only be available to admins'
+
+        with c.session_transaction() as sess:
+            sess['username'] = 'admin'  # read by the debug template
+
+        with mock.patch('index_builder.auth.session', ADMIN_SESSION):
+            response = c.get('/index-builder/profiler', query_string=dict(endpoint='find_factor_options'))
+            assert json.loads(response.data)['settings'] == dict(rate=0.0, endpoint='find_factor_options')
+
+            c.get('/index-builder/factor-options')
+            c.get('/index-builder/gics-mappings')
+            assert [p['path'] for p in profiler.list_profiles()] == ['/index-builder/factor-options']
+
+            profile_id = profiler.list_profiles()[0]['id']
+            response = c.get('/index-builder/profiler/{}'.format(profile_id))
+            assert response.headers['Content-Disposition'] == 'attachment; filename=profile_{}.prof'.format(
+                profile_id
+            )
+            assert isinstance(marshal.loads(response.data), dict)
+            assert c.get('/index-builder/profiler/0').status_code == 404
+
+            response = c.get('/index-builder/debug')
+            assert response.status_code == 200
+            assert '/index-builder/profiler/{}'.format(profile_id) in response.data
+
+            response = c.get('/index-builder/profiler', query_string=dict(clear='true'))
+            assert json.loads(response.data)['profiles'] == 0
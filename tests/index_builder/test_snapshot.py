@@ -0,0 +1,62 @@
+import pytest
+import os
+import time
+import mock
+import pandas as pd
+
+import index_builder.cache as cache
+import index_builder.model as model
+import index_builder.snapshot as snapshot
+import index_builder.views as views
+
+
+@pytest.mark.unit
+def test_snapshot(data_path):
+    source = os.path.join(data_path, 'source.yaml')
+    with open(source, 'w') as f:
+        f.write('test')
+    assert snapshot.load_snapshot(data_path, [source]) is None
+
+    datasets = dict(factors=dict(factor_1=dict(label='Factor 1')), gics=dict(sectors=[]))
+    snapshot.write_snapshot(data_path, datasets, time.time() + 1)
+    assert snapshot.load_snapshot(data_path, [source]) == datasets
+    assert snapshot.load_snapshot(data_path, [os.path.join(data_path, 'missing.yaml')]) == datasets
+
+    payload = os.path.join(snapshot.build_snapshot_path(data_path), snapshot.PAYLOAD)
+    with mock.patch('index_builder.snapshot.open', mock.Mock(side_effect=open), create=True) as mock_open:
+        assert snapshot.load_snapshot(data_path, [source]) == datasets
+    assert [c[0][0] for c in mock_open.call_args_list].count(payload) == 1, 'should only read the payload once'
+
+    with mock.patch('index_builder.snapshot.SNAPSHOT_VERSION', 2):
+        assert snapshot.load_snapshot(data_path, [source]) is None, 'should ignore snapshots from other versions'
+
+    snapshot.write_snapshot(data_path, datasets, time.time() - 60)
+    assert snapshot.load_snapshot(data_path, [source]) is None, 'should ignore snapshots older than their sources'
+
+    snapshot.write_snapshot(data_path, datasets, time.time() + 1)
+    with open(os.path.join(snapshot.build_snapshot_path(data_path), snapshot.PAYLOAD), 'ab') as f:
+        f.write('corrupt')
+    assert snapshot.load_snapshot(data_path, [source]) is None, 'should ignore snapshots with invalid checksums'
+
+
+@pytest.mark.unit
+def test_warm_start(data_path):
+    factors, indices, gics = model.build_factors(), model.build_indexes(), dict(sectors=[])
+    assert not views.warm_start(data_path)
+    views.save_snapshot(data_path, time.time(), factors, indices, gics)
+    try:
+        with mock.patch('index_builder.views.model.load_indexes') as load_indexes:
+            assert views.warm_start(data_path)
+            assert not load_indexes.called, 'should load indexes from the snapshot'
+            assert views.load_factors(data_path) == factors
+            loaded = views.load_indexes(data_path)
+            pd.util.testing.assert_frame_equal(loaded['returns']['daily'], indices['returns']['daily'])
+            assert loaded['stats'] == indices['stats']
+            assert views.load_gics_mappings() == gics
+    finally:
+        cache.clear_all_caches()
+
+    with mock.patch('index_builder.views.store.has_index_store', mock.Mock(return_value=True)):
+        views.save_snapshot(data_path, time.time(), factors, indices, gics)
+    assert sorted(snapshot.load_snapshot(data_path, [])) == ['factors', 'gics'], \
+        'should not snapshot indexes served from the store'
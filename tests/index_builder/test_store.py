@@ -0,0 +1,60 @@
+import pytest
+import numpy as np
+import pandas as pd
+
+import index_builder.model as model
+import index_builder.store as store
+
+
+def is_memory_mapped(values):
+    while isinstance(values, np.ndarray):
+        if isinstance(values, np.memmap):
+            return True
+        values = values.base
+    return False
+
+
+@pytest.mark.unit
+def test_index_store(unittest, data_path):
+    assert not store.has_index_store(data_path)
+    indices = model.build_indexes()
+    store.write_index_store(indices, data_path)
+    assert store.has_index_store(data_path)
+
+    loaded = model.load_indexes(data_path)
+    unittest.assertEquals(sorted(loaded), sorted(indices))
+    unittest.assertEquals(loaded['stats'], indices['stats'])
+    for block in store.RETURN_BLOCKS + ['covariance']:
+        pd.util.testing.assert_frame_equal(
+            loaded['returns'][block], indices['returns'][block], check_names=False, check_dtype=False
+        )
+    assert is_memory_mapped(loaded['returns']['daily'].values), 'returns should be memory-mapped'
+
+    for block in store.EXPOSURE_BLOCKS:
+        cols = sorted(indices[block].columns)
+        pd.util.testing.assert_frame_equal(
+            loaded[block][cols].set_index(['date', 'name']).sort_index(),
+            indices[block][cols].set_index(['date', 'name']).sort_index(),
+        )
+        tensor = loaded['exposures'][block]
+        assert is_memory_mapped(tensor['values']), 'exposures should be memory-mapped'
+        np.testing.assert_array_equal(tensor['values'], indices['exposures'][block]['values'])
+
+    factors = model.load_factors(data_path)
+    factor_settings = dict(factor_1=dict(strength='HI', weight=40), factor_2=dict(strength='LO', weight=60))
+    unittest.assertEquals(
+        model.load_user_results(factors, loaded, factor_settings),
+        model.load_user_results(factors, indices, factor_settings)
+    )
+
+    store.write_index_store(indices, data_path)
+    assert store.has_index_store(data_path), 'should be able to overwrite a store'
+
+
+@pytest.mark.unit
+def test_index_store_version(unittest, data_path):
+    store.write_index_store(model.build_indexes(), data_path)
+    with open(store.build_store_path(data_path) + '/manifest.json', 'w') as f:
+        f.write('{"version": -1}')
+    with pytest.raises(ValueError):
+        store.load_index_store(data_path)
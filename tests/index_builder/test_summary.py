@@ -0,0 +1,124 @@
+import pytest
+import os
+import mock
+
+import index_builder.summary as summary
+import index_builder.users as users
+import index_builder.utils as utils
+
+FACTORS = dict(factor_1=dict(label='Factor 1'), factor_2=dict(label='Factor 2'))
+
+
+def build_settings(locked=True, **factors):
+    return dict(
+        factors={
+            factor_id: dict(weight=weight, strength=strength, reasons=reasons)
+            for factor_id, (weight, strength, reasons) in factors.items()
+        },
+        locked=locked
+    )
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('backend', users.BACKENDS)
+def test_summarize(data_path, backend):
+    store = users.build_store(backend)
+    aggregates = summary.SummaryAggregates(store)
+    assert aggregates.summarize(FACTORS)['factor_1']['avg'] == dict(HI=0, LO=0)
+
+    store.save('test1', build_settings(factor_1=(40, 'HI', ['ethics', 'demand']), factor_2=(60, 'LO', ['ethics'])))
+    store.save('test2', build_settings(factor_1=(20, 'HI', ['ethics'])))
+    store.save('test3', build_settings(locked=False, factor_1=(100, 'LO', ['demand'])))
+    data = aggregates.summarize(FACTORS)
+    assert data['factor_1']['label'] == 'Factor 1'
+    assert [s['user'] for s in data['factor_1']['selections']['HI']] == ['test1', 'test2']
+    assert data['factor_1']['selections']['LO'] == []
+    assert data['factor_1']['avg'] == dict(HI=30, LO=0)
+    assert data['factor_1']['reason_avg'] == dict(HI=dict(ethics=100, demand=50), LO={})
+    assert data['factor_2']['avg'] == dict(HI=0, LO=30)
+
+    assert aggregates.user_counts() == dict(locked=2, unlocked=1)
+
+    store.save('test1', build_settings(locked=False))
+    assert aggregates.user_counts() == dict(locked=1, unlocked=2)
+    data = aggregates.summarize(FACTORS)
+    assert data['factor_1']['avg'] == dict(HI=20, LO=0), 'should drop unlocked users'
+    assert data['factor_1']['reason_avg']['HI'] == dict(ethics=100)
+    assert data['factor_2']['selections']['LO'] == []
+    assert aggregates.check()
+
+    store.archive('test')
+    assert aggregates.user_counts() == dict(locked=0, unlocked=0)
+    assert aggregates.summarize(FACTORS)['factor_1']['selections']['HI'] == []
+    assert aggregates.summarize(FACTORS, archive='test')['factor_1']['avg'] == dict(HI=20, LO=0)
+
+
+@pytest.mark.unit
+def test_other_processes(data_path):
+    store = users.build_store('yaml')
+    aggregates = summary.SummaryAggregates(store)
+    store.save('test1', build_settings(factor_1=(40, 'HI', ['ethics'])))
+    assert aggregates.summarize(FACTORS)['factor_1']['avg'] == dict(HI=40, LO=0)
+
+    # another worker's save only reaches this process through the users folder
+    utils.dump_yaml(build_settings(factor_1=(10, 'LO', ['demand'])), utils.build_factor_settings_file_path('test1'))
+    utils.dump_yaml(build_settings(factor_1=(20, 'LO', ['demand'])), utils.build_factor_settings_file_path('test2'))
+    assert aggregates.summarize(FACTORS)['factor_1']['avg'] == dict(HI=0, LO=15)
+
+
+@pytest.mark.unit
+def test_users_path_changed(data_path):
+    store = users.build_store('yaml')
+    aggregates = summary.SummaryAggregates(store)
+    for i in range(3):
+        store.save('test{}'.format(i), build_settings(factor_1=(40, 'HI', ['ethics'])))
+    assert aggregates.user_counts() == dict(locked=3, unlocked=0)
+
+    users_path = os.path.join(data_path, 'other_users')
+    utils.mkdir_p(users_path)
+    with mock.patch('index_builder.utils.USERS_PATH', users_path):
+        store.save('test1', build_settings(factor_1=(20, 'LO', ['demand'])))
+        assert aggregates.user_counts() == dict(locked=1, unlocked=0), 'should drop the old folder\'s users'
+        assert aggregates.summarize(FACTORS)['factor_1']['avg'] == dict(HI=0, LO=20)
+        assert aggregates.check()
+    assert aggregates.user_counts() == dict(locked=3, unlocked=0), 'should report the users of the folder again'
+    assert aggregates.check()
+
+
+@pytest.mark.unit
+def test_partial_selections(data_path):
+    store = users.build_store('yaml')
+    aggregates = summary.SummaryAggregates(store)
+    settings = build_settings(factor_1=(40, 'HI', ['ethics']), factor_2=(60, 'LO', ['ethics']))
+    settings['factors']['bad_weight'] = dict(strength='HI', weight='heavy')
+    del settings['factors']['factor_1']['strength']
+    del settings['factors']['factor_2']['reasons']
+    store.save('test1', settings)
+    data = aggregates.summarize(FACTORS)
+    assert data['factor_1']['avg'] == dict(HI=0, LO=0), 'should skip selections without a strength'
+    assert data['factor_2']['avg'] == dict(HI=0, LO=60)
+    assert aggregates.user_counts() == dict(locked=1, unlocked=0)
+
+    store.save('test1', build_settings(locked=False))
+    assert aggregates.summarize(FACTORS)['factor_2']['avg'] == dict(HI=0, LO=0)
+    assert aggregates.user_counts() == dict(locked=0, unlocked=1)
+    assert aggregates.check()
+
+
+@pytest.mark.unit
+def test_check(data_path):
+    store = users.build_store('yaml')
+    aggregates = summary.SummaryAggregates(store)
+    store.save('test1', build_settings(factor_1=(40, 'HI', ['ethics'])))
+    assert aggregates.check()
+
+    aggregates.update(None, 'test2', build_settings(factor_1=(60, 'HI', ['ethics'])))
+    assert aggregates.summarize(FACTORS)['factor_1']['avg'] == dict(HI=50, LO=0)
+    assert not aggregates.check()
+    assert aggregates.summarize(FACTORS)['factor_1']['avg'] == dict(HI=40, LO=0), 'should rebuild the aggregates'
+    assert aggregates.check()
+
+    for weight in [0.1, 0.2, 0.7]:
+        store.save('test2', build_settings(factor_1=(weight, 'HI', ['ethics'])))
+    store.save('test2', build_settings(locked=False))
+    assert aggregates.check(), 'should allow for rounding residue in the weights'
@@ -0,0 +1,91 @@
+import pytest
+import json
+import threading
+import mock
+
+import index_builder.timing as timing
+from index_builder.server import app
+from tests.testing_tools import TEST_FACTOR_SETTINGS
+
+
+@pytest.fixture()
+def enabled_timing():
+    timing.enable(True)
+    yield
+    timing.enable(False)
+    timing.end_request()
+
+
+@pytest.mark.unit
+def test_disabled():
+    assert not timing.is_enabled()
+    timing.start_request()
+    assert timing.span('test') is timing.NOOP_SPAN
+    with timing.span('test'):
+        timing.count('test')
+    assert timing.end_request() is None
+
+
+@pytest.mark.unit
+def test_spans(enabled_timing):
+    assert timing.span('test') is timing.NOOP_SPAN, 'should not record outside of a request'
+    timing.start_request()
+    with timing.span('test'):
+        pass
+    with timing.span('test'):
+        pass
+    with timing.span('other span'):
+        timing.count('memo_hit')
+        timing.count('memo_hit')
+    results = timing.end_request()
+    assert list(results['timings']) == ['other span', 'test']
+    assert results['counters'] == {'memo_hit': 2}
+    assert results['total'] >= sum(results['timings'].values())
+
+    header = timing.build_server_timing(results)
+    assert header.startswith('total;dur=')
+    assert 'other_span;dur=' in header
+    assert 'memo_hit;desc="2"' in header
+    log_line = json.loads(timing.build_log_line('/test', results).replace('request timings: ', ''))
+    assert log_line['path'] == '/test'
+    assert sorted(log_line['spans_ms']) == ['other span', 'test']
+
+
+@pytest.mark.unit
+def test_server_timing_header(enabled_timing):
+    with mock.patch('index_builder.views.utils.get_factor_settings', mock.Mock(return_value=TEST_FACTOR_SETTINGS)):
+        response = app.test_client().get('/index-builder/user-results', query_string=dict(user='Test User'))
+    assert response.status_code == 200
+    header = response.headers['Server-Timing']
+    for metric in ['total', 'get_indexes', 'get_factors', 'jsonify']:
+        assert '{};dur='.format(metric) in header
+
+    timing.enable(False)
+    response = app.test_client().get('/index-builder/factor-options')
+    assert 'Server-Timing' not in response.headers
+
+
+@pytest.mark.unit
+def test_interleaved_requests(enabled_timing):
+    started, finish = threading.Event(), threading.Event()
+    responses = {}
+
+    def _get_factor_settings(user, archive=None):
+        if user == 'first':
+            started.set()
+            finish.wait(5)
+        return TEST_FACTOR_SETTINGS
+
+    def _get(user):
+        responses[user] = app.test_client().get('/index-builder/user-results', query_string=dict(user=user))
+
+    with mock.patch('index_builder.views.utils.get_factor_settings', mock.Mock(side_effect=_get_factor_settings)):
+        first = threading.Thread(target=_get, args=('first',))
+        first.start()
+        assert started.wait(5)
+        _get('second')  # starts & finishes while the first request is in flight
+        finish.set()
+        first.join(5)
+    for user in ['first', 'second']:
+        assert 'get_indexes;dur=' in responses[user].headers.get('Server-Timing', ''), \
+            'should keep the timings of each request separate'
@@ -0,0 +1,137 @@
+import pytest
+import os
+import threading
+import time
+import mock
+
+import index_builder.users as users
+import index_builder.utils as utils
+
+
+def backdate(path, seconds=60):
+    mtime = time.time() - seconds
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.mark.unit
+def test_yaml_store(data_path):
+    store = users.YamlUserSettingsStore()
+    users_path = utils.build_users_path()
+    assert store.get_all(archive='missing') == []
+    assert store.get('test1') == users.default_settings()
+
+    for user in ['test1', 'test2']:
+        store.save(user, dict(factors={}, locked=user == 'test1'))
+        backdate(os.path.join(users_path, '{}.yaml'.format(user)))
+    with open(os.path.join(users_path, 'notes.txt'), 'w') as f:
+        f.write('not a user')
+    backdate(users_path)
+
+    with mock.patch('index_builder.users.utils.load_yaml', mock.Mock(wraps=utils.load_yaml)) as load_yaml:
+        assert [(u, s['locked']) for u, s, _ in store.get_all()] == [('test1', True), ('test2', False)]
+        assert load_yaml.call_count == 2
+        assert [u for u, _, _ in store.get_all(locked_only=True)] == ['test1']
+        store.get('test1')
+        assert load_yaml.call_count == 2, 'should serve unchanged folders from memory'
+
+        store.save('test3', dict(factors={}, locked=False))
+        assert len(store.get_all()) == 3
+        assert load_yaml.call_count == 3, 'should only parse files which have changed'
+
+    settings = store.get('test1')
+    settings['locked'] = False
+    assert store.get('test1')['locked'], 'should not share settings with callers'
+
+
+@pytest.mark.unit
+def test_sqlite_store(data_path):
+    store = users.SqliteUserSettingsStore(os.path.join(data_path, 'users.db'))
+    assert store._connect().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert store.get_all() == []
+    assert store.get('test1') == users.default_settings()
+
+    store.save('test1', dict(factors={'factor_1': 100}, locked=True))
+    store.save('test2', dict(factors={}, locked=False))
+    assert [(u, s['locked']) for u, s, _ in store.get_all()] == [('test1', True), ('test2', False)]
+    assert [u for u, _, _ in store.get_all(locked_only=True)] == ['test1']
+    assert store.get('test1') == dict(factors={'factor_1': 100}, locked=True)
+
+    store.archive('test')
+    assert store.get_all() == []
+    assert store.archives() == ['test']
+    assert [u for u, _, _ in store.get_all(archive='test', locked_only=True)] == ['test1']
+    assert store.get('test1', archive='test')['factors'] == {'factor_1': 100}
+
+
+@pytest.mark.unit
+def test_sqlite_locked(data_path):
+    import sqlite3
+
+    fname = os.path.join(data_path, 'users.db')
+    store = users.SqliteUserSettingsStore(fname, timeout=1)
+    other = sqlite3.connect(fname, isolation_level=None, check_same_thread=False)
+    other.execute('BEGIN IMMEDIATE')  # another worker's write
+    commit = threading.Timer(0.3, other.execute, args=('COMMIT',))
+    commit.start()
+
+    # sqlite's own wait sleeps in C so it gives up quickly & the store waits on the lock with a (gevent-patchable)
+    # sleep instead
+    start = time.time()
+    store.save('test1', dict(factors={}, locked=True))
+    commit.join()
+    assert time.time() - start >= 0.3, 'should wait for the lock to be released'
+    assert [u for u, _, _ in store.get_all()] == ['test1']
+
+    other.execute('BEGIN IMMEDIATE')
+    store.timeout = 0.1
+    with pytest.raises(sqlite3.OperationalError):
+        store.save('test2', dict(factors={}, locked=True))
+    other.execute('COMMIT')
+
+
+@pytest.mark.unit
+def test_migrate(data_path):
+    yaml_store = users.YamlUserSettingsStore()
+    yaml_store.save('test1', dict(factors={'factor_1': 100}, locked=True))
+    yaml_store.archive('test')
+    yaml_store.save('test2', dict(factors={}, locked=False))
+
+    store = users.SqliteUserSettingsStore(os.path.join(data_path, 'users.db'))
+    assert store.migrate(yaml_store) == 2
+    assert [u for u, _, _ in store.get_all()] == ['test2']
+    assert store.get('test1', archive='test') == dict(factors={'factor_1': 100}, locked=True)
+    _, _, last_update = store.get_all()[0]
+    assert last_update == os.path.getmtime(os.path.join(utils.build_users_path(), 'test2.yaml')), \
+        'should keep when users last updated their settings'
+
+    yaml_store.save('test3', dict(factors={}, locked=False))
+    assert store.migrate(yaml_store) == 0, 'should only migrate into an empty database'
+    assert store.migrate(yaml_store, force=True) == 1, 'should not overwrite existing settings'
+    assert len(store.get_all()) == 2
+
+
+@pytest.mark.unit
+def test_build_store(data_path):
+    yaml_store = users.YamlUserSettingsStore()
+    yaml_store.save('test1', dict(factors={}, locked=True))
+    assert isinstance(users.build_store('yaml'), users.YamlUserSettingsStore)
+    store = users.build_store('sqlite')
+    assert [u for u, _, _ in store.get_all()] == ['test1'], 'should migrate existing YAML settings'
+    with pytest.raises(ValueError):
+        users.build_store('csv')
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('backend', users.BACKENDS)
+def test_archives(data_path, backend):
+    store = users.build_store(backend)
+    with mock.patch('index_builder.utils.USER_STORE', store):
+        utils.dump_factor_settings('test', dict(factors={'factor_1': 100}, locked=True))
+        utils.archive_all_user_factor_settings('test')
+        archive, = utils.find_available_archives()
+        assert archive.startswith('test_')
+        assert utils.get_factor_settings('test', archive=archive) == dict(factors={'factor_1': 100}, locked=True), \
+            'should read settings from the archive'
+        assert [u for u, _ in utils.get_all_user_factor_settings(archive=archive)] == ['test']
+        assert utils.get_factor_settings('test') == users.default_settings()
+        assert list(utils.get_all_user_factor_settings(locked=False)) == []
@@ -4,8 +4,11 @@ from collections import namedtuple
 from contextlib import nested
 import pandas as pd
 import numpy as np
+import threading
 import time
 import datetime
+import os
+import yaml
 
 import index_builder.utils as utils
 from tests.testing_tools import TEST_FACTOR_SETTINGS
@@ -100,18 +103,17 @@ def test_build_users_path():
 
 
 @pytest.mark.unit
-def test_get_all_users(unittest):
-    def mock_get_factor_settings(user):
-        user_ct = int(user.replace('test', ''))
-        if user_ct % 2 == 0:
-            return TEST_FACTOR_SETTINGS
-        return utils.dict_merge(TEST_FACTOR_SETTINGS, dict(locked=True))
+def test_get_all_users(unittest, tmpdir):
+    users_path = str(tmpdir.join('users'))
+    with mock.patch('index_builder.utils.USERS_PATH', users_path):
+        for archive in [None, 'test']:
+            utils.mkdir_p(utils.build_users_path(archive))
+            for i in range(3):
+                factor_settings = TEST_FACTOR_SETTINGS if i % 2 == 0 else utils.dict_merge(
+                    TEST_FACTOR_SETTINGS, dict(locked=True)
+                )
+                utils.dump_yaml(factor_settings, utils.build_factor_settings_file_path('test{}'.format(i), archive))
 
-    with nested(
-        mock.patch('os.listdir', mock.Mock(return_value=['test{}.yaml'.format(i) for i in range(3)])),
-        mock.patch('index_builder.utils.get_factor_settings', mock_get_factor_settings),
-        mock.patch('os.path.getmtime', mock.Mock(return_value=time.time()))
-    ):
         assert 1 == len(list(utils.get_all_user_factors()))
         assert 3 == len(list(utils.get_all_user_factors(locked=False)))
         assert 1 == len(list(utils.get_all_user_factors(archive='test')))
@@ -141,3 +143,105 @@ def test_dict_merge():
     assert utils.dict_merge(dict(a=1), dict(a=2, b=2)) == dict(a=2, b=2)
 
 
+@pytest.mark.unit
+def test_process_memory():
+    memory = utils.process_memory()
+    assert memory['rss'] > 0
+    assert memory['rss'] == memory['shared'] + memory['private']
+
+    smaps = [
+        '00400000-0040b000 r-xp 00000000 08:01 1 /bin/cat\n',
+        'Rss:                 100 kB\n',
+        'Shared_Clean:         60 kB\n',
+        'Shared_Dirty:         10 kB\n',
+        'Private_Clean:        20 kB\n',
+        'Private_Dirty:        10 kB\n',
+    ]
+    with nested(
+        mock.patch('os.path.isfile', mock.Mock(return_value=False)),
+        mock.patch('__builtin__.open', mock.mock_open())
+    ) as (_, mock_open):
+        mock_open.return_value.__iter__ = lambda self: iter(smaps * 2)
+        memory = utils.process_memory(1)
+        assert mock_open.call_args[0][0] == '/proc/1/smaps'
+        assert memory == dict(rss=200 * 1024, pss=0, shared=140 * 1024, private=60 * 1024)
+
+
+@pytest.mark.unit
+def test_run_parallel():
+    thread_ids = set()
+
+    def _task(val):
+        def _run():
+            time.sleep(0.05)
+            thread_ids.add(threading.current_thread().ident)
+            return val
+        return _run
+
+    results = utils.run_parallel([('a', _task(1)), ('b', _task(2)), ('c', _task(3))])
+    assert results == dict(a=1, b=2, c=3)
+    assert len(thread_ids) == 3, 'should run each task in its own thread'
+
+    def _error():
+        raise ValueError('bad data')
+
+    thread_count = threading.active_count()
+    with pytest.raises(ValueError):
+        utils.run_parallel([('a', _task(1)), ('error', _error)])
+    assert threading.active_count() == thread_count, 'should not leave pool threads running'
+
+
+@pytest.mark.unit
+def test_compact_yaml(tmpdir):
+    fname = str(tmpdir.join('test.yaml'))
+    with open(fname, 'w') as f:
+        f.write("!!python/unicode '10': !!python/unicode 'Energy'\n!!python/unicode '15': !!python/unicode 'Materials'\n")
+    assert utils.load_yaml(fname) == {'10': 'Energy', '15': 'Materials'}
+
+    utils.compact_yaml(fname)
+    with open(fname) as f:
+        contents = f.read()
+    assert '!!' not in contents
+    assert utils.load_yaml(fname) == {'10': 'Energy', '15': 'Materials'}
+
+    with open(fname, 'w') as f:
+        f.write('!!python/object/apply:os.system [echo unsafe]\n')
+    with pytest.raises(yaml.constructor.ConstructorError):
+        utils.load_yaml(fname)
+
+
+@pytest.mark.unit
+def test_app_settings(tmpdir):
+    fname = str(tmpdir.join('app_settings.yaml'))
+    with nested(
+        mock.patch('index_builder.utils.APP_SETTINGS_FNAME', fname),
+        mock.patch('index_builder.utils.APP_SETTINGS', dict(mtime=None, settings=None)),
+    ):
+        assert utils.get_app_settings() == dict(summary_viewable=False)
+        utils.dump_app_settings(dict(summary_viewable=True))
+        mtime = time.time() - 60
+        os.utime(fname, (mtime, mtime))
+        assert utils.get_app_settings() == dict(summary_viewable=True)
+
+        with mock.patch('index_builder.utils.load_yaml', mock.Mock(wraps=utils.load_yaml)) as load_yaml:
+            utils.get_app_settings()['summary_viewable'] = False
+            assert utils.get_app_settings() == dict(summary_viewable=True)
+            assert not load_yaml.called, 'should serve unchanged settings from memory'
+
+            # saved by another worker
+            with open(fname, 'w') as f:
+                f.write('summary_viewable: false\n')
+            assert utils.get_app_settings() == dict(summary_viewable=False)
+            assert load_yaml.called
+
+
+@pytest.mark.unit
+def test_build_user_data_paths():
+    assert utils.build_user_data_paths({}) == (
+        os.path.join(utils.DATA_PATH, 'users'), os.path.join(utils.DATA_PATH, 'users.db')
+    )
+    assert utils.build_user_data_paths(dict(DATA_PATH='/data')) == ('/data/users', '/data/users.db'), \
+        'should serve the users of a dataset written to the data path'
+    assert utils.build_user_data_paths(dict(DATA_PATH='/data', USERS_PATH='/users', USER_DB='/users.db')) == (
+        '/users', '/users.db'
+    )
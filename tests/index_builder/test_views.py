@@ -4,9 +4,15 @@ import mock
 from contextlib import nested
 import flask
 import pandas as pd
-from collections import namedtuple
+from pympler.util import stringutils
 
 from index_builder.server import app
+import index_builder.cache as cache
+import index_builder.summary as summary
+import index_builder.model as model
+import index_builder.store as index_store
+import index_builder.users as users
+import index_builder.utils as utils
 import index_builder.views as views
 from index_builder.model import SAMPLE_INDEXES
 from index_builder.utils import dict_merge, USERS_PATH, DATA_PATH
@@ -19,12 +25,21 @@ def test_startup(unittest):
         mock.patch('index_builder.views.utils.running_with_pytest', mock.Mock(return_value=False)),
         mock.patch('index_builder.views.utils.running_with_flask', mock.Mock(return_value=True)),
         mock.patch('index_builder.views.utils.running_with_gunicorn', mock.Mock(return_value=False)),
-        mock.patch('index_builder.views.load_gics_mappings'),
-        mock.patch('index_builder.views.load_factors'),
-        mock.patch('index_builder.views.load_indexes')
-    ) as (_, _, _, load_gics, load_factors, load_indexes):
+        mock.patch('index_builder.views.read_gics_mappings'),
+        mock.patch('index_builder.views.model.load_factors'),
+        mock.patch('index_builder.views.model.load_indexes'),
+        mock.patch('index_builder.views.cache.swap_values'),
+        mock.patch('index_builder.views.cache.init_generations'),
+        mock.patch('index_builder.views.snapshot.load_snapshot', mock.Mock(return_value=None)),
+        mock.patch('index_builder.views.save_snapshot')
+    ) as (_, _, _, load_gics, load_factors, load_indexes, swap_values, init_generations, _, save_snapshot):
         views.startup('path')
+        init_generations.assert_called_once_with('path')
         assert all((load_gics.called, load_factors.called, load_indexes.called)), 'should load data when running flask'
+        entries, _ = swap_values.call_args
+        assert [e[2] for e in entries[0]] == [load_factors.return_value, load_indexes.return_value,
+                                              load_gics.return_value], 'should cache the loaded data'
+        assert save_snapshot.called, 'should save a snapshot of the loaded data'
 
     with nested(
         mock.patch('index_builder.views.utils.running_with_pytest', mock.Mock(return_value=True)),
@@ -43,17 +58,87 @@ def test_startup(unittest):
 
 @pytest.mark.unit
 def test_refresh_cached_data(unittest):
+    path = app.config['DATA_PATH']
+    old_factors, old_indices = views.load_factors(path), views.load_indexes(path)
+    version = cache.dataset_version()
+    new_factors, new_indices = dict(old_factors), dict(old_indices)
     with nested(
-        mock.patch('index_builder.views.cache.clear_all_caches', mock.Mock(return_value=True)),
-        mock.patch('index_builder.views.load_gics_mappings'),
-        mock.patch('index_builder.views.load_factors'),
-        mock.patch('index_builder.views.load_indexes')
-    ) as (clear_caches, load_gics, load_factors, load_indexes):
-        app.test_client().get('/index-builder/force-refresh')
-        unittest.assertTrue(
-            all((clear_caches.called, load_gics.called, load_factors.called, load_indexes.called)),
-            'should reload data and clear cache'
-        )
+        mock.patch('index_builder.views.cache.clear_all_caches'),
+        mock.patch('index_builder.views.model.load_factors', mock.Mock(return_value=new_factors)),
+        mock.patch('index_builder.views.model.load_indexes', mock.Mock(return_value=new_indices)),
+        mock.patch('index_builder.views.save_snapshot'),
+    ) as (clear_caches, _, _, save_snapshot):
+        response = app.test_client().get('/index-builder/force-refresh')
+        assert 'error' not in json.loads(response.data)
+        assert not clear_caches.called, 'should not clear caches before the new data is loaded'
+        views._datasets['snapshot'].join(5)
+        assert save_snapshot.called, 'should save a snapshot in the background'
+    assert views.load_factors(path) is new_factors
+    assert views.load_indexes(path) is new_indices
+    assert cache.dataset_version() != version, 'should swap in a new dataset version'
+    assert old_factors is not new_factors
+
+    with mock.patch('index_builder.views.model.load_factors', mock.Mock(return_value={})):
+        response = app.test_client().get('/index-builder/force-refresh')
+        unittest.assertEqual(json.loads(response.data)['error'], 'no factors were loaded')
+    assert views.load_factors(path) is new_factors, 'should keep the current data when the new data is invalid'
+
+    bad_indices = dict(new_indices, stats={})
+    with mock.patch('index_builder.views.model.load_indexes', mock.Mock(return_value=bad_indices)):
+        response = app.test_client().get('/index-builder/force-refresh')
+        assert json.loads(response.data)['error'].startswith('stats are missing for indexes')
+    assert views.load_indexes(path) is new_indices
+
+
+@pytest.mark.unit
+def test_snapshot_datasets():
+    with nested(
+        mock.patch('index_builder.views.save_snapshot', mock.Mock(return_value=False)),
+        mock.patch('index_builder.views.publish_datasets'),
+    ) as (save_snapshot, publish_datasets):
+        views.snapshot_datasets('path', 0, {}, {}, {})
+        assert not publish_datasets.called, 'should not have other workers reload a stale snapshot'
+        save_snapshot.return_value = True
+        views.snapshot_datasets('path', 0, {}, {}, {})
+        assert publish_datasets.called
+
+
+@pytest.mark.unit
+def test_reload_datasets():
+    path = app.config['DATA_PATH']
+    factors, indices, gics = views.load_factors(path), views.load_indexes(path), views.load_gics_mappings()
+    new_factors, new_indices = dict(factors), dict(indices)
+    generation = mock.Mock(get=mock.Mock(return_value=1), bump=mock.Mock(return_value=1))
+    with nested(
+        mock.patch('index_builder.views.cache.DATASETS_GENERATION', generation),
+        mock.patch.dict(views._datasets, dict(generation=0, reload=None)),
+        mock.patch('index_builder.views.snapshot.load_snapshot', mock.Mock(
+            return_value=dict(factors=new_factors, gics=gics)
+        )),
+        mock.patch('index_builder.views.model.load_indexes', mock.Mock(return_value=new_indices)),
+        mock.patch('index_builder.views.build_datasets'),
+    ) as (_, _, _, _, build_datasets):
+        app.test_client().get('/index-builder/factor-options')
+        views._datasets['reload'].join(5)
+        assert views._datasets['generation'] == 1
+        assert not build_datasets.called, 'should load the snapshot saved by the refreshing worker'
+        assert views.load_factors(path) is new_factors
+        assert views.load_indexes(path) is new_indices
+
+        reload = views._datasets['reload']
+        app.test_client().get('/index-builder/factor-options')
+        assert views._datasets['reload'] is reload, 'should only reload once per refresh'
+
+    with nested(
+        mock.patch('index_builder.views.cache.DATASETS_GENERATION', generation),
+        mock.patch.dict(views._datasets, dict(generation=0, reload=None)),
+        mock.patch('index_builder.views.snapshot.load_snapshot', mock.Mock(return_value=None)),
+        mock.patch('index_builder.views.build_datasets', mock.Mock(return_value=(factors, indices, gics))),
+    ) as (_, _, _, build_datasets):
+        app.test_client().get('/index-builder/factor-options')
+        views._datasets['reload'].join(5)
+        assert build_datasets.called, 'should rebuild the datasets when there is no usable snapshot'
+        assert views.load_factors(path) is factors
 
 
 @pytest.mark.unit
@@ -109,15 +194,17 @@ def test_save_factor_settings(unittest):
         with nested(
                 mock.patch('index_builder.views.session', {'username': 'test', 'factor_settings': {}}),
                 mock.patch('__builtin__.open'),
-                mock.patch('yaml.safe_dump')
-        ) as (_, mock_open, yaml_dump):
+                mock.patch('yaml.dump'),
+                mock.patch('os.rename')
+        ) as (_, mock_open, yaml_dump, mock_rename):
             response = c.get(
                 '/index-builder/save-factor-settings',
                 query_string=dict(factor_settings=json.dumps({'factor': False}))
             )
             assert response.status_code == 200
-            args, _ = mock_open.call_args
-            assert args[0].endswith('index_builder/data/users/test.yaml')
+            args, _ = mock_rename.call_args
+            assert args[0] == mock_open.call_args[0][0], 'should write to a temporary file'
+            assert args[1].endswith('index_builder/data/users/test.yaml')
             args, _ = yaml_dump.call_args
             unittest.assertEquals(args[0], {'locked': False, 'factors': {u'factor': False}}, 'should dump updated settings')
 
@@ -139,13 +226,14 @@ def test_lock_factor_settings(unittest):
         with nested(
             mock.patch('index_builder.views.session', session),
             mock.patch('__builtin__.open'),
-            mock.patch('yaml.safe_dump'),
+            mock.patch('yaml.dump'),
+            mock.patch('os.rename'),
             mock.patch('index_builder.views.redirect', mock.Mock(return_value=json.dumps(dict(success=True)))),
-        ) as (_, mock_open, yaml_dump, mock_redirect):
+        ) as (_, mock_open, yaml_dump, mock_rename, mock_redirect):
             response = c.get('/index-builder/lock-factor-settings')
             assert response.status_code == 200
-            args, _ = mock_open.call_args
-            assert args[0].endswith('index_builder/data/users/test.yaml')
+            args, _ = mock_rename.call_args
+            assert args[1].endswith('index_builder/data/users/test.yaml')
             args, _ = yaml_dump.call_args
             unittest.assertEquals(args[0], {'locked': True, 'factors': factor_settings}, 'should dump updated settings')
             assert mock_redirect.called
@@ -161,7 +249,7 @@ def test_lock_factor_settings(unittest):
             mock.patch('index_builder.views.session', session),
             mock.patch('index_builder.views.flash'),
             mock.patch('__builtin__.open'),
-            mock.patch('yaml.safe_dump'),
+            mock.patch('yaml.dump'),
             mock.patch('index_builder.views.redirect', mock.Mock(return_value=json.dumps(dict(success=True)))),
         ) as (_, mock_flash, mock_open, yaml_dump, mock_redirect):
             response = c.get('/index-builder/lock-factor-settings')
@@ -300,16 +388,25 @@ def test_load_user_results(unittest):
 
 
 @pytest.mark.unit
-def test_find_summary_data(unittest):
-    with mock.patch(
-            'index_builder.views.utils.get_all_user_factors',
-            mock.Mock(return_value=[('TestUser', TEST_FACTOR_SETTINGS['factors'])])
+def test_find_summary_data(unittest, tmpdir):
+    store = users.YamlUserSettingsStore()
+    aggregates = summary.SummaryAggregates(store)
+    with nested(
+        mock.patch('index_builder.utils.USERS_PATH', str(tmpdir)),
+        mock.patch('index_builder.views.utils.get_summary_aggregates', mock.Mock(return_value=aggregates)),
     ):
+        store.save('TestUser', dict_merge(TEST_FACTOR_SETTINGS, dict(locked=True)))
         response = app.test_client().get('/index-builder/summary-data')
         assert response.status_code == 200
         assert response.content_type == 'application/json'
         response_data = json.loads(response.data)
         assert 'error' not in response_data
+        unittest.assertEquals(response_data['data']['factor_2']['avg'], dict(HI=20, LO=0))
+        unittest.assertEquals(response_data['data']['factor_1']['reason_avg']['HI'], dict(futureRet=100, riskReduce=100))
+
+        with mock.patch('index_builder.auth.session', MockDict(dict(logged_in=True, username='admin'))):
+            response = app.test_client().get('/index-builder/check-summary')
+        assert json.loads(response.data) == dict(consistent=True)
 
     with mock.patch('index_builder.views.get_factors', mock.Mock(side_effect=Exception())):
         response = app.test_client().get('/index-builder/summary-data')
@@ -485,21 +582,64 @@ def test_auth():
 
 
 @pytest.mark.unit
-def test_load_page():
+@pytest.mark.parametrize('backend', users.BACKENDS)
+def test_load_page(data_path, backend):
     with app.test_request_context():
-        req = namedtuple('req', 'referrer')
         with nested(
-            mock.patch('index_builder.views.request', mock.Mock(return_value=req('login'))),
+            mock.patch('index_builder.views.request', mock.Mock(referrer='/login')),
             mock.patch('index_builder.views.session', MockDict(dict(username='test'))),
-            mock.patch('os.path.isfile', mock.Mock(return_value=True)),
-            mock.patch('index_builder.utils.get_user_counts', mock.Mock(return_value=dict(locked=0, unlocked=0))),
+            mock.patch('index_builder.utils.USER_STORE_BACKEND', backend),
+            mock.patch('index_builder.utils.USER_STORE', None),
+            mock.patch('index_builder.utils.SUMMARY_AGGREGATES', None),
             mock.patch('index_builder.utils.get_app_settings', mock.Mock(return_value=dict(summary_viewable=False))),
             mock.patch('index_builder.views.render_template'),
-        ) as (_, _, _, _, _, mock_render):
+        ) as (_, _, _, _, _, _, mock_render):
             views.load_page('factors')
             args, kwargs = mock_render.call_args
             assert args[0] == 'index_builder/factors.html'
             assert kwargs['page'] == 'factors'
             assert 'user_counts' in kwargs
             assert 'app_settings' in kwargs
-            assert kwargs['warning'] == views.PREEXISTING_USER.format('test')
\ No newline at end of file
+            assert kwargs['warning'] is None, 'should not warn new users'
+
+            utils.dump_factor_settings('test', dict(factors={}, locked=False))
+            views.load_page('factors')
+            _, kwargs = mock_render.call_args
+            assert kwargs['warning'] == views.PREEXISTING_USER.format('test'), \
+                'should warn users already in the {} store'.format(backend)
+
+
+@pytest.mark.unit
+def test_cache_info():
+    with mock.patch('index_builder.views.cache.RESULTS_CACHE', cache.ExpiryCache(cache.PROD_SCHEDULE)) as results:
+        results[('load_all_results_stats', 1, 2, (0, 0), 'abc')] = [1, 2, 3]
+        info = views.cache_info()['RESULTS_CACHE']
+        assert info['total_items'] == 1
+        assert info['items'][0]['key'] == 'load_all_results_stats, 1, 2, (0, 0), abc'
+        assert info['stats']['load_time'] == '0.000s'
+        with mock.patch('index_builder.views.asizeof', mock.Mock(return_value=1024)) as mock_asizeof:
+            assert 'deep_size' not in views.cache_info()['RESULTS_CACHE']['items'][0]
+            assert not mock_asizeof.called, 'should only run asizeof on request'
+            info = views.cache_info(deep=True)['RESULTS_CACHE']
+            assert info['items'][0]['deep_size'] == info['total_deep_size'] == stringutils.pp(1024)
+    assert views.format_cache_key(cache.create_memory_cache_key(['path'])) == 'path'
+
+    with mock.patch('index_builder.auth.session', MockDict(dict(logged_in=True, username='test'))):
+        response = app.test_client().get('/index-builder/debug', query_string=dict(deep='true'))
+    assert response.status_code == 200
+    assert 'Deep Size' in response.data
+
+
+@pytest.mark.unit
+def test_cache_info_index_store(data_path):
+    index_store.write_index_store(model.build_indexes(), data_path)
+    indexes = model.load_indexes(data_path)
+    with mock.patch('index_builder.views.cache.INDEXES_CACHE', cache.ExpiryCache(cache.PROD_SCHEDULE)) as c:
+        c[cache.create_memory_cache_key([data_path])] = indexes
+        item, = views.cache_info(deep=True)['INDEXES_CACHE']['items']
+        assert item['deep_size'].endswith('(estimated)'), 'should estimate values asizeof cannot size'
+        assert 'deep_size_error' in item
+
+        with mock.patch('index_builder.auth.session', MockDict(dict(logged_in=True, username='test'))):
+            response = app.test_client().get('/index-builder/debug', query_string=dict(deep='true'))
+        assert response.status_code == 200